@@ -0,0 +1,242 @@
+"""
+Append-only archive of raw gateway notifications.
+
+With IPN_ARCHIVE_DIR set, IPN views decorated with archived() append every
+request they receive -- gateway, view, path, headers and raw body -- to
+the archive before handling it. Archived notifications can be replayed
+through the views with the hiicart_replay command, e.g. to repair carts
+after a handler bug, or to test and time handlers with real traffic.
+
+Each process writes its own segment files, named
+<started>-<host>-<pid>-<n>.seg, and starts a new segment after
+IPN_ARCHIVE_SEGMENT_SIZE bytes of notifications. A segment is a raw
+deflate stream of records: a 4-byte header length, a 4-byte body length,
+a JSON header and the body. The stream is sync-flushed after each record,
+so a record is written out before its request is handled, and fully
+flushed every INDEX_INTERVAL records, so reading can start there without
+what came before. Those points are listed in the segment's .idx file, one
+"<record> <offset> <received>" line each, letting readers skip to a time
+without decompressing the whole segment.
+
+Credential headers (see hiicart.utils.SECRET_HEADERS) aren't archived, so
+replaying skips the gateways' verification, but notifications can still
+hold customers' details: the directory should be readable only by the site.
+"""
+
+import bisect
+import glob
+import heapq
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from functools import wraps
+from django.utils import simplejson
+
+from hiicart.settings import SETTINGS as hiicart_settings
+from hiicart.utils import request_meta
+
+
+log = logging.getLogger("hiicart.archive")
+
+# Records between points reading can start from
+INDEX_INTERVAL = 256
+
+_LENGTHS = struct.Struct(">II")
+
+# Request variables archived, besides HTTP_* headers
+_ARCHIVED_META = ("CONTENT_TYPE", "QUERY_STRING", "REMOTE_ADDR", "SCRIPT_NAME",
+                  "SERVER_NAME", "SERVER_PORT", "wsgi.url_scheme")
+
+
+def archived(gateway):
+    """Decorator for IPN views whose requests should be archived."""
+    def decorator(view):
+        path = "%s.%s" % (view.__module__, view.__name__)
+        def wrapper(request, *args, **kwargs):
+            if hiicart_settings["IPN_ARCHIVE_DIR"] and request.method == "POST":
+                try:
+                    archive_request(request, gateway, path)
+                except Exception:
+                    # Never lose the notification itself over the archive
+                    log.exception("Archiving %s IPN failed" % gateway)
+            return view(request, *args, **kwargs)
+        return wraps(view)(wrapper)
+    return decorator
+
+
+def archive_request(request, gateway, view):
+    """Append a request to the archive."""
+    meta = request_meta(request, _ARCHIVED_META)
+    header = {"gateway": gateway, "view": view, "path": request.path_info,
+              "meta": meta, "received": time.time()}
+    writer().write(header, request.raw_post_data)
+
+
+class ArchiveWriter(object):
+    """Appends records to this process's segments in a directory."""
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._segments = 0
+        self._file = None
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        while True:
+            name = "%s-%s-%i-%i" % (time.strftime("%Y%m%d%H%M%S"), socket.gethostname(),
+                                    os.getpid(), self._segments)
+            path = os.path.join(self.directory, name)
+            self._segments += 1
+            if not os.path.exists(path + ".seg"):
+                break
+        self._file = open(path + ".seg", "ab")
+        self._index = open(path + ".idx", "a")
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self._records = self._offset = self._size = 0
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._close()
+        finally:
+            self._lock.release()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.write(self._compressor.flush(zlib.Z_FINISH))
+            self._file.close()
+            self._index.close()
+            self._file = None
+
+    def write(self, header, body):
+        received = header["received"]
+        header = simplejson.dumps(header)
+        data = _LENGTHS.pack(len(header), len(body)) + header + body
+        self._lock.acquire()
+        try:
+            if self._file is None or self._size >= self.segment_size:
+                self._close()
+                self._open()
+            if self._records % INDEX_INTERVAL == 0:
+                self._index.write("%i %i %.6f\n" % (self._records, self._offset, received))
+                self._index.flush()
+            self._records += 1
+            if self._records % INDEX_INTERVAL == 0:
+                mode = zlib.Z_FULL_FLUSH
+            else:
+                mode = zlib.Z_SYNC_FLUSH
+            compressed = self._compressor.compress(data) + self._compressor.flush(mode)
+            self._file.write(compressed)
+            self._file.flush()
+            self._offset += len(compressed)
+            self._size += len(data)
+        finally:
+            self._lock.release()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    """This process's ArchiveWriter for IPN_ARCHIVE_DIR."""
+    global _writer
+    # A forked process needs segments of its own
+    if _writer is None or _writer[0] != os.getpid():
+        _writer_lock.acquire()
+        try:
+            if _writer is None or _writer[0] != os.getpid():
+                _writer = (os.getpid(), ArchiveWriter(hiicart_settings["IPN_ARCHIVE_DIR"],
+                                                      hiicart_settings["IPN_ARCHIVE_SEGMENT_SIZE"]))
+        finally:
+            _writer_lock.release()
+    return _writer[1]
+
+
+def read_index(path):
+    """A segment's index, as a list of (received, record, offset)."""
+    index = []
+    try:
+        f = open(os.path.splitext(path)[0] + ".idx")
+    except IOError:
+        return [(0, 0, 0)]
+    try:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3:
+                index.append((float(parts[2]), int(parts[0]), int(parts[1])))
+    finally:
+        f.close()
+    return index or [(0, 0, 0)]
+
+
+def read_segment(path, since=None):
+    """
+    Yield (header, body) for the records in a segment.
+
+    With since, a timestamp, reading starts at the last index point before
+    it, so some earlier records are included too. A record cut short, e.g.
+    by a crash while it was written, ends the segment.
+    """
+    index = read_index(path)
+    start = 0
+    if since is not None:
+        start = max(bisect.bisect_right(index, (since,)) - 1, 0)
+    f = open(path, "rb")
+    try:
+        f.seek(index[start][2])
+        decompressor = zlib.decompressobj(-15)
+        buffered = ""
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            try:
+                buffered += decompressor.decompress(chunk)
+            except zlib.error:
+                log.error("Archive segment %s is corrupt" % path)
+                return
+            pos = 0
+            while len(buffered) - pos >= _LENGTHS.size:
+                header_len, body_len = _LENGTHS.unpack_from(buffered, pos)
+                end = pos + _LENGTHS.size + header_len + body_len
+                if end > len(buffered):
+                    break
+                header = simplejson.loads(buffered[pos + _LENGTHS.size:end - body_len])
+                yield header, buffered[end - body_len:end]
+                pos = end
+            buffered = buffered[pos:]
+    finally:
+        f.close()
+
+
+def read_archive(directory, since=None, until=None, gateways=None):
+    """
+    Yield (header, body) for archived notifications, oldest first.
+
+    since and until are timestamps; gateways, if given, a list of gateway
+    names to include.
+    """
+    streams = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.seg"))):
+        if until is not None and read_index(path)[0][0] > until:
+            continue
+        streams.append(((header["received"], n, header, body)
+                        for n, (header, body) in enumerate(read_segment(path, since))))
+    # Each process's segments are in order; merge theirs into one
+    for received, n, header, body in heapq.merge(*streams):
+        if since is not None and received < since:
+            continue
+        if until is not None and received > until:
+            break
+        if gateways and header["gateway"] not in gateways:
+            continue
+        yield header, body
@@ -0,0 +1,117 @@
+"""
+Model fields for HiiCart.
+
+CartUUIDField holds cart uuids. In Python the value is always the usual
+36 character string, but the UUID_STORAGE setting picks the column type:
+
+ * "char" -- varchar(36), the same column as before. [default]
+ * "binary" -- 16 raw bytes (binary(16) on MySQL, bytea on PostgreSQL,
+   RAW(16) on Oracle and blob on SQLite).
+ * "native" -- PostgreSQL's uuid type, or "binary" on other databases.
+
+Changing the setting doesn't change existing columns; run the
+hiicart_uuid_storage command to convert them.
+"""
+
+import sys
+import uuid
+
+from django.db import DEFAULT_DB_ALIAS, connections, models, router
+from hiicart.settings import SETTINGS as hiicart_settings
+
+BINARY_TYPES = {
+    "mysql": "binary(16)",
+    "oracle": "RAW(16)",
+    "postgresql": "bytea",
+    "sqlite": "blob",
+    }
+
+
+def _vendor(connection):
+    engine = connection.settings_dict["ENGINE"]
+    for vendor in ("mysql", "oracle", "postgresql", "sqlite"):
+        if vendor in engine:
+            return vendor
+    return None
+
+
+def _database(connection):
+    # The DB-API module; each backend's base module imports it as Database
+    return sys.modules[connection.__module__].Database
+
+
+def uuid_storage(connection):
+    """How uuids are stored on connection: "char", "binary" or "native"."""
+    storage = hiicart_settings["UUID_STORAGE"]
+    vendor = _vendor(connection)
+    if storage == "native" and vendor != "postgresql":
+        storage = "binary"
+    if storage == "binary" and vendor not in BINARY_TYPES:
+        storage = "char"
+    return storage
+
+
+def stored_uuid(value):
+    """A uuid read from a column of any UUID_STORAGE type, as a 36 character string."""
+    if isinstance(value, buffer):
+        value = str(value)
+    if isinstance(value, str) and len(value) == 16:
+        return str(uuid.UUID(bytes=value))
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+class CartUUIDField(models.CharField):
+    """A uuid stored as UUID_STORAGE says, and always a 36 character string in Python."""
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", 36)
+        super(CartUUIDField, self).__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        storage = uuid_storage(connection)
+        if storage == "native":
+            return "uuid"
+        if storage == "binary":
+            return BINARY_TYPES[_vendor(connection)]
+        return super(CartUUIDField, self).db_type(connection=connection)
+
+    def _storage(self):
+        model = getattr(self, "model", None)
+        using = router.db_for_read(model) if model is not None else DEFAULT_DB_ALIAS
+        return uuid_storage(connections[using])
+
+    def to_python(self, value):
+        if value is None or value == "":
+            return value
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        if isinstance(value, buffer):
+            # Only binary columns come back as buffers
+            return str(uuid.UUID(bytes=str(value)))
+        if isinstance(value, str) and len(value) == 16 and self._storage() == "binary":
+            # MySQL returns binary(16) columns as str
+            return str(uuid.UUID(bytes=value))
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None or value == "":
+            return value
+        storage = uuid_storage(connection)
+        if storage == "binary":
+            # Raises ValueError for strings that aren't uuids
+            return _database(connection).Binary(uuid.UUID(value).bytes)
+        if storage == "native":
+            return str(uuid.UUID(value))
+        return value
+
+
+try:
+    from south.modelsinspector import add_introspection_rules
+    add_introspection_rules([], [r"^hiicart\.fields\.CartUUIDField"])
+except ImportError:
+    pass
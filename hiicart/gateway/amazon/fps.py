@@ -6,10 +6,12 @@ import hmac
 import urllib
 import urllib2
 import urlparse
+from StringIO import StringIO
 from datetime import datetime
 from decimal import Decimal
 from django.utils.datastructures import SortedDict
 from django.utils.safestring import mark_safe
+from hiicart.transport import transport
 from urllib2 import HTTPError
 
 
@@ -37,18 +39,14 @@ def do_fps(action, method, settings, **params):
     values["Signature"] = generate_signature(method, values,
                                              _fps_base_url(settings), settings)
     url = "%s?%s" % (_fps_base_url(settings), urllib.urlencode(values))
-    request = urllib2.Request(url)
-    #request.add_header("Content-type", "application/x-www-form-urlencoded")
-    try:
-        req = urllib2.urlopen(request)
-        response = req.read()
-        #response = urllib2.urlopen(request).read()
-    except HTTPError, e:
-        if e.code == 400:
-            response = e.read()
-        else:
-            raise
-    return response
+    response = transport().get(url)
+    # FPS reports bad requests as a 400 with an error document, which
+    # callers parse like any other response. Anything else that isn't a
+    # 2xx, including redirects, which the transport doesn't follow, is raised.
+    if response.status >= 300 and response.status != 400:
+        raise HTTPError(url, response.status, response.reason,
+                        response.headers, StringIO(response.body))
+    return response.body
 
 
 def generate_signature(verb, values, request_url, settings):
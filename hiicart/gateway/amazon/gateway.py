@@ -15,6 +15,7 @@ TEST_CBUI_URL = "https://authorize.payments-sandbox.amazon.com/cobranded-ui/acti
 
 class AmazonGateway(PaymentGatewayBase):
     "Payment Gateway for Amazon Payments."
+    charges_recurring = True
 
     def __init__(self, cart):
         super(AmazonGateway, self).__init__("amazon", cart, default_settings)
@@ -123,7 +124,7 @@ class AmazonGateway(PaymentGatewayBase):
             item.recurring = False
             item.save()
 
-    def sanitize_clone(self):
+    def sanitize_clone(self, cart):
         "Nothing to do here..."
         return self.cart
 
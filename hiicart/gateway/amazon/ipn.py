@@ -30,18 +30,12 @@ class AmazonIPN(IPNBase):
             total = Decimal(data["transactionAmount"][4:])
         if data["transactionStatus"] == "PENDING":
             transaction_id = data["transactionId"]
-            pending = self.cart.payments.filter(transaction_id=transaction_id)
-            if not pending: # Could already be created in make_pay_request
-                self._create_payment(total, transaction_id, "PENDING")
+            # Could already be created in make_pay_request
+            self._upsert_payment(total, transaction_id, "PENDING", update_states=())
         elif data["transactionStatus"] == "SUCCESS":
-            # Was this a pending payment?
+            # Completes a pending payment, but never duplicates one
             transaction_id = data["transactionId"]
-            pending = self.cart.payments.filter(transaction_id=transaction_id, state="PENDING")
-            if pending:
-                pending[0].state = "PAID"
-                pending[0].save()
-            elif self.cart.payments.filter(transaction_id=transaction_id).count() == 0: # No duplicate payments
-                self._create_payment(total, transaction_id, "PAID")
+            self._upsert_payment(total, transaction_id, "PAID", update_states=("PENDING",))
             self.begin_recurring()
         elif data["transactionStatus"] == "CANCELLED":
             message = "Purchase %i (txn:%s) was cancelled with message '%s'" % (
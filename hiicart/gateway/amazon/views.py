@@ -6,6 +6,9 @@ from django.views.decorators.csrf import csrf_view_exempt
 from hiicart.gateway.amazon.ipn import AmazonIPN
 from hiicart.gateway.base import GatewayError
 from hiicart.gateway.countries import COUNTRIES
+from hiicart.archive import archived
+from hiicart.idempotency import idempotent, verified
+from hiicart.inbox import deferrable
 from hiicart.utils import format_exceptions, cart_by_uuid
 
 
@@ -18,6 +21,21 @@ def _find_cart(request_data):
     return cart_by_uuid(uuid)
 
 
+def _cart_key(request):
+    """The uuid of an IPN's cart, for hiicart.inbox."""
+    return request.POST.get("callerReference", "")[:36]
+
+
+def _notification_key(request):
+    """What identifies an IPN across Amazon's redeliveries, for hiicart.idempotency."""
+    data = request.POST
+    if data.get("notificationType") == "TokenCancellation":
+        return "%s:TokenCancellation" % data.get("tokenId", "")
+    if data.get("transactionId"):
+        return "%s:%s" % (data["transactionId"], data.get("transactionStatus", ""))
+    return None
+
+
 @csrf_view_exempt
 @format_exceptions
 @never_cache
@@ -85,6 +103,9 @@ def cbui(request, settings=None):
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("amazon")
+@deferrable("amazon", key=_cart_key)
+@idempotent("amazon", key=_notification_key)
 def ipn(request):
     """Instant Payment Notification handler."""
     log.debug("IPN Received: \n%s" % pprint.pformat(dict(request.POST), indent=10))
@@ -97,6 +118,7 @@ def ipn(request):
     if not handler.verify_signature(request.POST.urlencode(), "POST", handler.settings["IPN_URL"]):
         log.error("Validation of Amazon request failed!")
         return HttpResponseBadRequest("Validation of Amazon request failed!")
+    verified(request)
     if not cart:
         log.error("Unable to find cart.")
         return HttpResponseBadRequest()
@@ -26,6 +26,10 @@ class AuthorizeNetGateway(PaymentGatewayBase):
         """Return True if gateway is valid."""
         return True
 
+    def sanitize_clone(self, cart):
+        """Nothing to fix here."""
+        pass
+
     def has_payment_result(self, request):
         response = self.get_response()
         if response:
@@ -2,7 +2,7 @@ import hashlib
 
 from datetime import datetime
 from decimal import Decimal
-from hiicart.gateway.base import IPNBase, PaymentResult
+from hiicart.gateway.base import IPNBase, batched, PaymentResult
 from hiicart.gateway.authorizenet.settings import SETTINGS as default_settings
 from hiicart.models import CART_TYPES
 
@@ -61,16 +61,8 @@ class AuthorizeNetIPN(IPNBase):
             state = "PENDING"
         else:
             return
-        payment = self.cart.payments.filter(transaction_id=data['x_trans_id'])
-        if payment:
-            if payment[0].state != state:
-                payment[0].state = state
-                payment[0].save()
-                return payment[0]
-        else:
-            payment = self._create_payment(data['x_amount'],
-                                           data['x_trans_id'], state)
-            payment.save()
+        payment, created, changed = self._upsert_payment(data['x_amount'], data['x_trans_id'], state)
+        if changed and not created:
             return payment
 
     def record_form_data(self, data):
@@ -82,6 +74,7 @@ class AuthorizeNetIPN(IPNBase):
                 setattr(self.cart, model_field, data[form_field])
         self.cart.save()
 
+    @batched
     def accept_payment(self, data):
         """Save a new order using details from a transaction."""
         if not self.cart:
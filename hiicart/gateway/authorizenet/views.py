@@ -4,6 +4,7 @@ from django.http import HttpResponseRedirect, HttpResponse
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_view_exempt
 from django.shortcuts import render_to_response
+from hiicart.archive import archived
 from hiicart.gateway.base import GatewayError
 from hiicart.gateway.authorizenet.ipn import AuthorizeNetIPN
 from hiicart.gateway.authorizenet.gateway import AuthorizeNetGateway
@@ -22,6 +23,7 @@ def _find_cart(data):
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("authorizenet")
 def ipn(request):
     """
     Authorize.net Payment Notification
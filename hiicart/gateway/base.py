@@ -1,12 +1,76 @@
 import logging
 import os
-from hiicart.utils import call_func
+from collections import Mapping
+from functools import wraps
+from hiicart.gateway import settings_cache
+from hiicart.models import find_payment
 
 
 class GatewayError(Exception):
     pass
 
 
+class LayeredSettings(Mapping):
+    """
+    Read-only view of several settings dicts.
+
+    Layers are given lowest priority first and a key is looked up in each
+    layer from the last to the first. Layers aren't copied, so they must not
+    be changed while a view uses them. overlay() makes a new view with more
+    layers on top without touching this one.
+    """
+
+    def __init__(self, *layers):
+        self._layers = tuple([layer for layer in layers if layer])
+
+    def __getitem__(self, key):
+        for layer in reversed(self._layers):
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return True
+        return False
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self._layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return "LayeredSettings(%s)" % dict(self.items())
+
+    def overlay(self, *layers):
+        """New view with layers added on top of these ones."""
+        return LayeredSettings(*(self._layers + layers))
+
+
+def batched(method):
+    """
+    Run an IPN handler method inside self.cart.batch().
+
+    The cart is saved once at the end and state signals are sent after the
+    handler's writes are committed, or join a transaction the caller
+    manages. Methods without a cart run as usual.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.cart:
+            return method(self, *args, **kwargs)
+        with self.cart.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class _SharedBase(object):
     """Shared base class between IPNs and Gateways
 
@@ -19,14 +83,15 @@ class _SharedBase(object):
         Duplicate settings are overwritten according to priority according to
         the following ascending priority:
         default_settings -> global -> gateway defined in HIICART_SETTINGS
+        -> store settings -> cart settings
+
+        self.settings is a read-only LayeredSettings, so none of those dicts
+        are copied or changed.
         """
         self.name = name.upper()
         self.log = logging.getLogger("hiicart.gateway." + self.name)
-        self.settings = default_settings or {}
-        self.settings.update(cart.hiicart_settings)
-        if self.name in self.settings:
-            self.settings.update(cart.hiicart_settings[self.name])
-        self._settings_base = self.settings.copy()
+        self._settings_base = LayeredSettings(default_settings, cart.hiicart_settings,
+                                              cart.hiicart_settings.get(self.name))
         self.cart = cart
         self._update_with_store_settings()
 
@@ -41,25 +106,20 @@ class _SharedBase(object):
         """Pull cart-specific settings and update self.settings with them.
         We need an DI facility to get cart-specific settings in. This way,
         we're able to have different carts use different google accounts."""
+        self._store_settings = None
         if self.cart.hiicart_settings.get("STORE_SETTINGS_FN"):
-            s = call_func(self.cart.hiicart_settings["STORE_SETTINGS_FN"], self.cart)
-            if s:
-                self.settings.update(s)
-                return
-        self.settings = self._settings_base.copy()  # reset to defaults
+            self._store_settings = settings_cache.store_settings(self.cart)
+        self.settings = self._settings_base.overlay(self._store_settings)
 
     def _update_with_cart_settings(self, cart_settings_kwargs):
         """Pull cart-specific settings and update self.settings with them.
         We need an DI facility to get cart-specific settings in. This way,
         we're able to have different carts use different google accounts."""
+        cart_settings = None
         if self.cart.hiicart_settings.get("CART_SETTINGS_FN"):
             cart_settings_kwargs = cart_settings_kwargs or {}
-            s = call_func(self.cart.hiicart_settings["CART_SETTINGS_FN"],
-                          self.cart, **cart_settings_kwargs)
-            if s:
-                self.settings.update(s)
-                return
-        self.settings = self._settings_base.copy()  # reset to defaults
+            cart_settings = settings_cache.cart_settings(self.cart, **cart_settings_kwargs)
+        self.settings = self._settings_base.overlay(self._store_settings, cart_settings)
 
     def _require_files(self, filenames):
         """Verify a file exists on disk. Usually use for key files."""
@@ -88,7 +148,15 @@ class IPNBase(_SharedBase):
 
     Provides shared functionality among IPN implementations
     """
-    pass # All covered by _SharedBase for now
+
+    def _payment_by_transaction(self, transaction_id):
+        """This gateway's first payment with transaction_id, of any cart, or None."""
+        return find_payment(self.name, transaction_id)
+
+    def _upsert_payment(self, amount, transaction_id, state, update_states=None):
+        """Create or update the payment for transaction_id. See PaymentBase.upsert_by_transaction."""
+        return self.cart.payment_class.upsert_by_transaction(self.cart, self.name, transaction_id,
+                                                             amount, state, update_states)
 
 
 class PaymentGatewayBase(_SharedBase):
@@ -97,6 +165,10 @@ class PaymentGatewayBase(_SharedBase):
 
     Provides a common interface for working with all payment gateways.
     """
+    # Whether charge_recurring() charges carts from here. Gateways that bill
+    # subscriptions themselves leave it False, so schedulers skip their carts.
+    charges_recurring = False
+
     def __init__(self, name, cart, default_settings=None):
         super(PaymentGatewayBase, self).__init__(name, cart, default_settings)
 
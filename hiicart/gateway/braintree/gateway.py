@@ -15,6 +15,7 @@ log = logging.getLogger('hiicart.gateway.braintree.gateway')
 
 class BraintreeGateway(PaymentGatewayBase):
     """Payment Gateway for Braintree."""
+    charges_recurring = True
 
     def __init__(self, cart):
         super(BraintreeGateway, self).__init__("braintree", cart, default_settings)
@@ -30,6 +31,10 @@ class BraintreeGateway(PaymentGatewayBase):
         # TODO: Query Braintree to validate credentials
         return True
 
+    def sanitize_clone(self, cart):
+        """Nothing to fix here."""
+        pass
+
     @property
     def is_recurring(self):
         return len(self.cart.recurring_lineitems) > 0
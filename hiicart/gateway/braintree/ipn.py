@@ -1,7 +1,7 @@
 import braintree
 from datetime import datetime
 from decimal import Decimal
-from hiicart.gateway.base import IPNBase, TransactionResult, SubscriptionResult
+from hiicart.gateway.base import IPNBase, batched, TransactionResult, SubscriptionResult
 from hiicart.gateway.braintree.settings import SETTINGS as default_settings
 from hiicart.models import CART_TYPES
 
@@ -51,18 +51,11 @@ class BraintreeIPN(IPNBase):
             state = "CANCELLED"
         else:
             return
-        payment = self.cart.payments.filter(transaction_id=transaction.id)
-        if payment:
-            if payment[0].state != state:
-                payment[0].state = state
-                payment[0].save()
-                return payment[0]
-        else:
-            payment = self._create_payment(transaction.amount,
-                                           transaction.id, state)
-            payment.save()
+        payment, created, changed = self._upsert_payment(transaction.amount, transaction.id, state)
+        if changed and not created:
             return payment
 
+    @batched
     def new_order(self, transaction):
         """Save a new order using details from a transaction."""
         if not self.cart:
@@ -90,6 +83,7 @@ class BraintreeIPN(IPNBase):
         return self._record_payment(transaction)
 
 
+    @batched
     def accept_payment(self, transaction):
         payment = self._record_payment(transaction)
         if payment:
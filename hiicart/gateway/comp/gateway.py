@@ -11,6 +11,8 @@ class CompGateway(PaymentGatewayBase):
     This gateway doesn't make a payment anywhere. It simply records
     a payment of cart.total as successfully paid.
     """
+    charges_recurring = True
+
     def __init__(self, cart):
         super(CompGateway, self).__init__("comp", cart, default_settings)
 
@@ -34,7 +36,7 @@ class CompGateway(PaymentGatewayBase):
             payment = self._create_payment(self.cart.total, None, "PAID")
             payment.save()
 
-    def sanitize_clone(self):
+    def sanitize_clone(self, cart):
         """Nothing gateway-specific here."""
         pass
 
@@ -1,5 +1,4 @@
 import base64
-import httplib2
 import xml.etree.cElementTree as ET
 from decimal import Decimal
 
@@ -8,6 +7,7 @@ from django.template import Context, loader
 from hiicart.gateway.base import PaymentGatewayBase, SubmitResult, CancelResult
 from hiicart.gateway.google.settings import SETTINGS as default_settings
 from hiicart.lib.unicodeconverter import convertToUTF8
+from hiicart.transport import transport
 
 
 class GoogleGateway(PaymentGatewayBase):
@@ -42,10 +42,10 @@ class GoogleGateway(PaymentGatewayBase):
 
     def _send_xml(self, url, xml):
         """Send a command to the Checkout Order Processing API."""
-        http = httplib2.Http()
         headers = {"Content-type": "application/x-www-form-urlencoded",
                    "Authorization": "Basic %s" % self.get_basic_auth()}
-        return http.request(url, "POST", xml, headers=headers)
+        response = transport().post(url, xml, headers=headers)
+        return response, response.body
 
     def cancel_items(self, payment, items=None, reason=None):
         self._update_with_cart_settings({'request': None})
@@ -76,7 +76,7 @@ class GoogleGateway(PaymentGatewayBase):
         return base64.b64encode("%s:%s" % (self.settings["MERCHANT_ID"],
                                            self.settings["MERCHANT_KEY"]))
 
-    def sanitize_clone(self):
+    def sanitize_clone(self, cart):
         """Remove any gateway-specific changes to a cloned cart."""
         pass
 
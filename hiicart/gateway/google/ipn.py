@@ -1,8 +1,11 @@
 from datetime import datetime
 from decimal import Decimal
-from hiicart.gateway.base import IPNBase
+from django.db.models import Sum
+from hiicart.gateway.base import IPNBase, batched
+from hiicart.gateway.google.gateway import GoogleGateway
 from hiicart.gateway.google.settings import SETTINGS as default_settings
-from hiicart.models import CART_TYPES
+from hiicart.models import find_payment
+from hiicart.utils import call_func
 
 
 class GoogleIPN(IPNBase):
@@ -15,12 +18,16 @@ class GoogleIPN(IPNBase):
     @staticmethod
     def _find_payment(data):
         """Find a payment based on the google id"""
-        transaction_id = data["google-order-number"]
-        for Cart in CART_TYPES:
-            try:
-                return Cart.payment_class.objects.select_related('cart').filter(transaction_id=transaction_id)[0]
-            except:
-                pass
+        return find_payment("GOOGLE", data.get("google-order-number"))
+
+    def confirm_ipn_auth(self, authorization):
+        """Whether an Authorization header carries the merchant's credentials."""
+        if self.settings.get("IPN_AUTH_VALS", False):
+            mine = call_func(self.settings["IPN_AUTH_VALS"])
+        else:
+            mine = GoogleGateway(self.cart).get_basic_auth()
+        theirs = authorization.split(" ")[-1]
+        return bool(theirs) and theirs in mine
 
     def _record_payment(self, data, amount=None, state="PAID"):
         """Record a payment from the IPN data."""
@@ -29,15 +36,21 @@ class GoogleIPN(IPNBase):
         if not amount:
             amount = data["latest-charge-amount"]
         transaction_id = data["google-order-number"]
-        pending = self.cart.payments.filter(state="PENDING", transaction_id=transaction_id)
-        if pending:
-            pending[0].state = "PAID"
-            pending[0].save()
-            return pending[0]
-        else:
-            payment = self._create_payment(amount, transaction_id, state)
-            payment.save()
+        payment, created, changed = self._upsert_payment(amount, transaction_id, state,
+                                                         update_states=("PENDING",))
+        if changed or payment.state == "PENDING" or state != "PAID":
             return payment
+        # The order's payment is already settled, so this is another charge
+        # on it, unless it's a redelivery of one already recorded
+        if "total-charge-amount" in data:
+            # Charges share the order's number, so compare totals to spot redeliveries
+            charges = self.cart.payment_class._default_manager.filter(
+                    cart=self.cart, transaction_id=transaction_id, state="PAID")
+            charged = charges.aggregate(total=Sum("amount"))["total"] or 0
+            if charged >= Decimal(data["total-charge-amount"]):
+                self.log.warn("Charge for order #%s already recorded", transaction_id)
+                return charges.order_by("-pk")[0]
+        return self._create_payment(amount, transaction_id, state)
 
     def authorization_amount(self, data):
         """
@@ -48,6 +61,7 @@ class GoogleIPN(IPNBase):
         """
         pass
 
+    @batched
     def cancelled_subscription(self, data):
         """Handle cancelled-subscription-notification"""
         if not self.cart:
@@ -57,7 +71,7 @@ class GoogleIPN(IPNBase):
             item_ids = data["item-ids"]
         else:
             item_ids = [data["item-ids"]]
-        recurring_by_sku = dict([(li.sku, li) for li in self.cart.recurring_lineitems])
+        recurring_by_sku = self.cart.recurring_lineitems_by_sku
         for item_id in item_ids:
             sku_key = "%s.merchant-item-id" % item_id
             if sku_key in data:
@@ -68,6 +82,7 @@ class GoogleIPN(IPNBase):
             i.save()
         self.cart.update_state()
 
+    @batched
     def charge_amount(self, data):
         """
         Handle charge-amount-notification
@@ -89,6 +104,7 @@ class GoogleIPN(IPNBase):
         """
         return self.refund_amount(data)
 
+    @batched
     def new_order(self, data):
         """
         Handle new-order-notification
@@ -135,6 +151,7 @@ class GoogleIPN(IPNBase):
                              amount=data["order-total"],
                              state="PENDING")
 
+    @batched
     def order_state_change(self, data):
         """Handle an order-state-change notification"""
         old = data["previous-financial-order-state"]
@@ -149,6 +166,7 @@ class GoogleIPN(IPNBase):
                 r.save()
             self.cart.set_state("CANCELLED")
 
+    @batched
     def refund_amount(self, data):
         """
         Handle a refund-amount-notification
@@ -157,7 +175,16 @@ class GoogleIPN(IPNBase):
         the reason_code set to "REFUND"
         """
         amount = Decimal(data["latest-refund-amount"]) * -1
-        payment = self._create_payment(amount, data["google-order-number"], 'REFUND')
+        transaction_id = data["google-order-number"]
+        if "total-refund-amount" in data:
+            # Refunds share the order's number, so compare totals to spot redeliveries
+            refunded = self.cart.payment_class._default_manager.filter(
+                    cart=self.cart, transaction_id=transaction_id,
+                    state="REFUND").aggregate(total=Sum("amount"))["total"] or 0
+            if -refunded >= Decimal(data["total-refund-amount"]):
+                self.log.warn("Refund for order #%s already recorded", transaction_id)
+                return
+        payment = self._create_payment(amount, transaction_id, 'REFUND')
         self.cart.update_state()
         self.cart.save()
 
@@ -3,9 +3,11 @@ from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_view_exempt
 from hiicart.gateway.base import GatewayError
-from hiicart.gateway.google.gateway import GoogleGateway
 from hiicart.gateway.google.ipn import GoogleIPN
-from hiicart.utils import format_exceptions, call_func, cart_by_uuid
+from hiicart.archive import archived
+from hiicart.idempotency import idempotent, verified
+from hiicart.inbox import deferrable
+from hiicart.utils import format_exceptions, cart_by_uuid
 
 
 log = logging.getLogger("hiicart.gateway.google")
@@ -32,9 +34,46 @@ def _find_cart(data):
     return cart_by_uuid(private_data)
 
 
+def _order_key(request):
+    """Google's order number, sent with each of an order's notifications, for hiicart.inbox."""
+    return request.POST.get("google-order-number", "").strip()
+
+
+def _notification_key(request):
+    """Google's serial number for a notification, the same in every delivery of it."""
+    return request.POST.get("serial-number", "").strip()
+
+
+def _unauthorized(request, cart):
+    """A 401 response, unless the request carries the merchant's credentials."""
+    if GoogleIPN(cart).confirm_ipn_auth(request.META.get("HTTP_AUTHORIZATION", "")):
+        return None
+    response = HttpResponse("Authorization Required")
+    response["WWW-Authenticate"] = "Basic"
+    response.status_code = 401
+    return response
+
+
+def _verify(request):
+    """Check credentials before hiicart.inbox stores a notification without them."""
+    cart = _find_cart(request.POST)
+    return cart and _unauthorized(request, cart)
+
+
+def _acknowledge(request):
+    """Return ack so google knows we handled the message"""
+    ack = "<notification-acknowledgment xmlns='http://checkout.google.com/schema/2' serial-number='%s'/>" % request.POST["serial-number"].strip()
+    response = HttpResponse(content=ack, content_type="text/xml; charset=UTF-8")
+    log.debug("Google Checkout: Sending IPN Acknowledgement")
+    return response
+
+
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("google")
+@deferrable("google", key=_order_key, ack=_acknowledge, verify=_verify)
+@idempotent("google", key=_notification_key)
 def ipn(request):
     """View to receive notifications from Google"""
     if request.method != "POST":
@@ -44,18 +83,12 @@ def ipn(request):
     log.info("IPN Notification received from Google Checkout: %s" % data)
     cart = _find_cart(data)
     if cart:
-        gateway = GoogleGateway(cart)
-        # Check credentials
-        if gateway.settings.get("IPN_AUTH_VALS", False):
-            mine = call_func(gateway.settings["IPN_AUTH_VALS"])
-        else:
-            mine = gateway.get_basic_auth()
-        theirs = request.META["HTTP_AUTHORIZATION"].split(" ")[1]
-        if theirs not in mine:
-            response = HttpResponse("Authorization Required")
-            response["WWW-Authenticate"] = "Basic"
-            response.status_code = 401
-            return response
+        # Check credentials, unless they were checked when it was stored
+        if getattr(request, "ipn_inbox", None) is None:
+            response = _unauthorized(request, cart)
+            if response is not None:
+                return response
+        verified(request)
         # Handle the notification
         type = data["_type"]
         handler = GoogleIPN(cart)
@@ -79,8 +112,4 @@ def ipn(request):
             log.error("google gateway: Unknown message type recieved: %s" % type)
     else:
         log.error('google gateway: Unknown tranaction, %s' % data)
-    # Return ack so google knows we handled the message
-    ack = "<notification-acknowledgment xmlns='http://checkout.google.com/schema/2' serial-number='%s'/>" % data["serial-number"].strip()
-    response = HttpResponse(content=ack, content_type="text/xml; charset=UTF-8")
-    log.debug("Google Checkout: Sending IPN Acknowledgement")
-    return response
+    return _acknowledge(request)
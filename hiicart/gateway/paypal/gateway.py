@@ -1,7 +1,6 @@
 import os
 import urllib
 import urllib2
-import httplib2
 from cgi import parse_qs
 
 from decimal import Decimal
@@ -14,6 +13,7 @@ from django.utils.safestring import mark_safe
 
 from hiicart.gateway.base import PaymentGatewayBase, CancelResult, SubmitResult, GatewayError
 from hiicart.gateway.paypal.settings import SETTINGS as default_settings
+from hiicart.transport import transport
 
 PAYMENT_CMD = {
     "BUY_NOW" : "_xclick",
@@ -79,14 +79,13 @@ class PaypalGateway(PaymentGatewayBase):
     def _do_nvp(self, method, params_dict):
         if not self.settings['API_USERNAME']:
             raise GatewayError("You must have NVP API credentials to do API operations (%s) with Paypal" % method)
-        http = httplib2.Http()
         params_dict['method'] = method
         params_dict['user'] = self.settings['API_USERNAME']
         params_dict['pwd'] = self.settings['API_PASSWORD']
         params_dict['signature'] = self.settings['API_SIGNATURE']
         params_dict['version'] = self.settings['API_VERSION']
         encoded_params = urllib.urlencode(params_dict)
-        response, content = http.request(self._nvp_url, 'POST', encoded_params)
+        content = transport().post(self._nvp_url, encoded_params).body
         response_dict = parse_qs(content)
         for k, v in response_dict.iteritems():
             if type(v) == list:
@@ -261,7 +260,7 @@ class PaypalGateway(PaymentGatewayBase):
         """This Paypal API doesn't support manually charging subscriptions."""
         pass
 
-    def sanitize_clone(self):
+    def sanitize_clone(self, cart):
         """Nothing to fix here."""
         pass
 
@@ -1,7 +1,7 @@
-import urllib2
 from django.utils.safestring import mark_safe
-from hiicart.gateway.base import IPNBase
+from hiicart.gateway.base import IPNBase, batched
 from hiicart.gateway.paypal.settings import SETTINGS as default_settings
+from hiicart.transport import transport
 
 
 POST_URL = "https://www.paypal.com/cgi-bin/webscr"
@@ -22,11 +22,12 @@ class PaypalIPN(IPNBase):
             url = POST_TEST_URL
         return mark_safe(url)
 
+    @batched
     def accept_payment(self, data):
         """Accept a successful Paypal payment"""
         transaction_id = data["txn_id"]
         self.log.debug("IPN for transaction #%s received" % transaction_id)
-        if self.cart.payment_class.objects.filter(transaction_id=transaction_id).count() > 0:
+        if self._payment_by_transaction(transaction_id) is not None:
             self.log.warn("IPN #%s, already processed", transaction_id)
             return
         if not self.cart:
@@ -65,6 +66,7 @@ class PaypalIPN(IPNBase):
         self.cart.save()
 
 
+    @batched
     def activate_subscription(self, data):
         """Send signal that a subscription has been activated."""
         if not self.cart:
@@ -72,35 +74,38 @@ class PaypalIPN(IPNBase):
             return
         sku = data.get("item_number", None)
         if sku:
-            recurring_by_sku = dict([(li.sku, li) for li in self.cart.recurring_lineitems])
-            item = recurring_by_sku.get(sku)
+            item = self.cart.recurring_lineitems_by_sku.get(sku)
         else:
             item = None
-        if item:
+        if item and not item.is_active:
             item.is_active = True
             item.save()
             self.cart.update_state()
             self.cart.save()
 
+    @batched
     def cancel_subscription(self, data):
         """Send signal that a subscription has been cancelled."""
         if not self.cart:
             self.log.warn("Unable to find purchase for IPN.")
             return
         sku = data.get("item_number", None)
-        recurring_by_sku = dict([(li.sku, li) for li in self.cart.recurring_lineitems])
-        item = recurring_by_sku.get(sku)
-        if item:
+        item = self.cart.recurring_lineitems_by_sku.get(sku)
+        if item and item.is_active:
             item.is_active = False
             item.save()
             self.cart.update_state()
             self.cart.save()
 
+    @batched
     def payment_refunded(self, data):
         """Accept a refund notification.
         mc_gross will be negative
         """
         transaction_id = data["txn_id"]
+        if self._payment_by_transaction(transaction_id) is not None:
+            self.log.warn("IPN #%s, already processed", transaction_id)
+            return
         payment = self._create_payment(data["mc_gross"], transaction_id, "REFUND")
         self.cart.update_state()
         self.cart.save()
@@ -111,10 +116,7 @@ class PaypalIPN(IPNBase):
         Overcomes issues with unicode and urlencode.
         """
         raw_data += "&cmd=_notify-validate"
-        req = urllib2.Request(self.submit_url)
-        req.add_header("Content-type", "application/x-www-form-urlencoded")
-        result = urllib2.urlopen(req, raw_data)
-        ret = result.read()
+        ret = transport().post(self.submit_url, raw_data).body
         if ret == "VERIFIED":
             return True
         else:
@@ -4,6 +4,9 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_view_exempt
 from hiicart.gateway.base import GatewayError
 from hiicart.gateway.paypal.ipn import PaypalIPN
+from hiicart.archive import archived
+from hiicart.idempotency import idempotent, verified
+from hiicart.inbox import deferrable
 from hiicart.utils import format_exceptions, cart_by_uuid
 from urllib import unquote_plus
 from urlparse import parse_qs
@@ -21,6 +24,29 @@ def _find_cart(data):
     return cart_by_uuid(invoice[:36])
 
 
+def _cart_key(request):
+    """The uuid of an IPN's cart, for hiicart.inbox."""
+    data = request.POST
+    invoice = data.get('invoice') or data.get('item_number') or data.get('rp_invoice_id')
+    return (invoice or "")[:36]
+
+
+def _notification_key(request):
+    """What identifies an IPN across PayPal's redeliveries, for hiicart.idempotency."""
+    data = request.POST
+    if data.get('ipn_track_id'):
+        return data['ipn_track_id']
+    if data.get('txn_id'):
+        return "%s:%s" % (data['txn_id'], data.get('payment_status', ''))
+    if data.get('pay_key'):
+        # Adaptive Payments
+        return "%s:%s" % (data['pay_key'], data.get('status', ''))
+    profile = data.get('subscr_id') or data.get('recurring_payment_id')
+    if profile:
+        return "%s:%s" % (profile, data.get('txn_type', ''))
+    return None
+
+
 def _base_paypal_ipn_listener(request, ipn_class):
     """
     PayPal IPN (Instant Payment Notification)
@@ -47,6 +73,7 @@ def _base_paypal_ipn_listener(request, ipn_class):
     if not handler.confirm_ipn_data(request.raw_post_data):
         log.error("Paypal IPN Confirmation Failed.")
         raise GatewayError("Paypal IPN Confirmation Failed.")
+    verified(request)
     # Paypal defaults to cp1252, because it hates you
     # So, if we end up with the unicode char that means
     # "unknown char" (\ufffd), try to transcode from cp1252
@@ -76,5 +103,8 @@ def _base_paypal_ipn_listener(request, ipn_class):
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("paypal")
+@deferrable("paypal", key=_cart_key)
+@idempotent("paypal", key=_notification_key)
 def ipn(request):
     return _base_paypal_ipn_listener(request, PaypalIPN)
@@ -4,13 +4,13 @@ API Reference: https://cms.paypal.com/us/cgi-bin/?cmd=_render-content&content_ID
 """
 # TODO: Make this an object that gets its own settings (using _SharedBase?)
 
-import httplib2
 import urllib
 import urllib2
 
 from datetime import datetime
 from decimal import Decimal
 from django.core.urlresolvers import reverse
+from hiicart.transport import transport
 from urllib import unquote
 
 LIVE_ENDPOINT = "https://api-3t.paypal.com/nvp"
@@ -37,9 +37,7 @@ def _send_command(params, settings):
     keys.sort()
     pairs = [(k,params[k]) for k in keys]
     url = LIVE_ENDPOINT if settings["LIVE"] else SANDBOX_ENDPOINT
-    response, data = httplib2.Http().request(url, "POST",
-                                             urllib.urlencode(pairs))
-    data = unquote(data)
+    data = unquote(transport().post(url, urllib.urlencode(pairs)).body)
     # TODO: logging
     return dict([(l,r) for l,r in [p.split('=') for p in data.split('&')]])
 
@@ -1,6 +1,6 @@
-import urllib2
-from hiicart.gateway.base import IPNBase
+from hiicart.gateway.base import IPNBase, batched
 from hiicart.gateway.paypal2.settings import SETTINGS as default_settings
+from hiicart.transport import transport
 
 
 class Paypal2IPN(IPNBase):
@@ -9,12 +9,13 @@ class Paypal2IPN(IPNBase):
     def __init__(self, cart):
         super(Paypal2IPN, self).__init__("paypal2", cart, default_settings)
 
+    @batched
     def accept_payment(self, data):
         """Accept a PayPal payment IPN."""
         # TODO: Should this simple mirror/reuse what's in gateway.paypal?
         transaction_id = data["txn_id"]
         self.log.debug("IPN for transaction #%s received" % transaction_id)
-        if self.cart.payment_class.objects.filter(transaction_id=transaction_id).count() > 0:
+        if self._payment_by_transaction(transaction_id) is not None:
             self.log.warn("IPN #%s, already processed", transaction_id)
             return
         if not self.cart:
@@ -34,10 +35,11 @@ class Paypal2IPN(IPNBase):
         self.cart.update_state()
         self.cart.save()
 
+    @batched
     def accept_recurring_payment(self, data):
         transaction_id = data["txn_id"]
         self.log.debug("IPN for transaction #%s received" % transaction_id)
-        if self.cart.payment_class.objects.filter(transaction_id=transaction_id).count() > 0:
+        if self._payment_by_transaction(transaction_id) is not None:
             self.log.warn("IPN #%s, already processed", transaction_id)
             return
         if not self.cart:
@@ -62,10 +64,7 @@ class Paypal2IPN(IPNBase):
         else:
             submit_url = "https://www.sandbox.paypal.com/cgi-bin/webscr"
         raw_data += "&cmd=_notify-validate"
-        req = urllib2.Request(submit_url)
-        req.add_header("Content-type", "application/x-www-form-urlencoded")
-        result = urllib2.urlopen(req, raw_data).read()
-        return urllib2.urlopen(req, raw_data).read() == "VERIFIED"
+        return transport().post(submit_url, raw_data).body == "VERIFIED"
 
     def recurring_payment_profile_cancelled(self, data):
         """Notification that a recurring profile was cancelled."""
@@ -5,7 +5,11 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_view_exempt
 from hiicart.gateway.base import GatewayError
 from hiicart.gateway.paypal2 import api
+from hiicart.gateway.paypal.views import _notification_key
 from hiicart.gateway.paypal2.ipn import Paypal2IPN
+from hiicart.archive import archived
+from hiicart.idempotency import idempotent, verified
+from hiicart.inbox import deferrable
 from hiicart.utils import format_exceptions, cart_by_uuid
 
 
@@ -26,6 +30,13 @@ def _find_cart(data):
     return cart_by_uuid(invoice[:36])
 
 
+def _cart_key(request):
+    """The uuid of an IPN's cart, for hiicart.inbox."""
+    data = request.POST
+    invoice = data.get('invoice') or data.get('rp_invoice_id') or data.get('item_number')
+    return (invoice or "")[:36]
+
+
 # TODO: Move all the functions from ipn.py here. There's no real reason
 #       for it to be in a separate file. It creates confusion when you
 #       have an api.py and ipn.py. The same should happen in the other
@@ -35,6 +46,9 @@ def _find_cart(data):
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("paypal2")
+@deferrable("paypal2", key=_cart_key)
+@idempotent("paypal2", key=_notification_key)
 def ipn(request):
     """Instant Payment Notification ipn.
 
@@ -51,6 +65,7 @@ def ipn(request):
     if not ipn.confirm_ipn_data(request.raw_post_data):
         log.error("Paypal IPN Confirmation Failed.")
         raise GatewayError("Paypal IPN Confirmation Failed.")
+    verified(request)
     if "txn_type" in data: # Inidividual Tranasction IPN
         if data["txn_type"] == "cart":
             ipn.accept_payment(data)
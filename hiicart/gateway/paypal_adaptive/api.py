@@ -1,10 +1,11 @@
 """Common functions to make calls to Paypal's Adaptive Payment API."""
 
-import httplib2
 import simplejson
 import urllib
 import urllib2
 
+from hiicart.transport import transport
+
 LIVE_ENDPOINT = "https://svcs.paypal.com/AdaptivePayments/%s"
 SANDBOX_ENDPOINT = "https://svcs.sandbox.paypal.com/AdaptivePayments/%s"
 
@@ -16,7 +17,6 @@ def _endpoint_url(settings):
 
 def _send_command(settings, operation, params):
     """Send a command to the Adaptive API."""
-    http = httplib2.Http()
     headers = {"X-PAYPAL-SECURITY-USERID": settings["USERID"],
                "X-PAYPAL-SECURITY-PASSWORD": settings["PASSWORD"],
                "X-PAYPAL-SECURITY-SIGNATURE": settings["SIGNATURE"],
@@ -32,6 +32,6 @@ def _send_command(settings, operation, params):
     keys = params.keys()
     keys.sort()
     pairs = [(k,params[k]) for k in keys]
-    response, data = http.request(_endpoint_url(settings) % operation, "POST",
-                                  urllib.urlencode(pairs), headers=headers)
-    return simplejson.loads(data)
+    response = transport().post(_endpoint_url(settings) % operation,
+                                urllib.urlencode(pairs), headers=headers)
+    return simplejson.loads(response.body)
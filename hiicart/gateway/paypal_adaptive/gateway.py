@@ -52,7 +52,7 @@ class PaypalAPGateway(PaymentGatewayBase):
         """Charge a cart's recurring item, if necessary."""
         raise GatewayError("Adaptive Payments doesn't support recurring payments.")
 
-    def sanitize_clone(self):
+    def sanitize_clone(self, cart):
         """Nothing to do here..."""
         return self.cart
 
@@ -1,8 +1,8 @@
 import re
-import urllib2
 from decimal import Decimal
-from hiicart.gateway.base import IPNBase
+from hiicart.gateway.base import IPNBase, batched
 from hiicart.gateway.paypal_adaptive.settings import SETTINGS as default_settings
+from hiicart.transport import transport
 from hiicart.utils import cart_by_uuid
 
 
@@ -34,21 +34,16 @@ class PaypalAPIPN(IPNBase):
             key_base = "transaction[%i]." % i
             if not any([k.startswith(key_base) for k in data.keys()]):
                 break
-            p = self.cart.payment_class.objects.filter(transaction_id=data[key_base + "id"])
-            if len(p) == 0:
-                p = self.cart.payment_class(cart=cart, gateway=cart.gateway,
-                                            transaction_id=data[key_base + "id"])
-            else:
-                p = p[0]
             amount = re.sub("[^0-9.]", "", data[key_base + "amount"])
-            p.amount = Decimal(amount)
-            p.state = _adaptive_states[data[key_base + "status"]]
-            p.save() # Need .id if creating new payment
+            p, created, changed = cart.payment_class.upsert_by_transaction(
+                    cart, self.name, data[key_base + "id"], Decimal(amount),
+                    _adaptive_states[data[key_base + "status"]])
             p.notes.create(text="Payment receiver: %s" % data[key_base + "receiver"])
         if "memo" in data:
             cart.notes.create(text="IPN Memo: %s" % data["memo"])
         cart.update_state()
 
+    @batched
     def accept_payment(self, data):
         """Accept a normal PayPal payment IPN.
 
@@ -60,7 +55,7 @@ class PaypalAPIPN(IPNBase):
         # TODO: Should this simple mirror/reuse what's in gateway.paypal?
         transaction_id = data["txn_id"]
         self.log.debug("IPN for transaction #%s received" % transaction_id)
-        if self.cart.payment_class.objects.filter(transaction_id=transaction_id).count() > 0:
+        if self._payment_by_transaction(transaction_id) is not None:
             self.log.warn("IPN #%s, already processed", transaction_id)
             return
         if not self.cart:
@@ -103,7 +98,4 @@ class PaypalAPIPN(IPNBase):
         else:
             submit_url = "https://www.sandbox.paypal.com/cgi-bin/webscr"
         raw_data += "&cmd=_notify-validate"
-        req = urllib2.Request(submit_url)
-        req.add_header("Content-type", "application/x-www-form-urlencoded")
-        result = urllib2.urlopen(req, raw_data).read()
-        return urllib2.urlopen(req, raw_data).read() == "VERIFIED"
+        return transport().post(submit_url, raw_data).body == "VERIFIED"
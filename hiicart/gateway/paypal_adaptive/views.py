@@ -3,7 +3,11 @@ from django.http import HttpResponse
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_view_exempt
 from hiicart.gateway.base import GatewayError
+from hiicart.gateway.paypal.views import _notification_key
 from hiicart.gateway.paypal_adaptive.ipn import PaypalAPIPN
+from hiicart.archive import archived
+from hiicart.idempotency import idempotent, verified
+from hiicart.inbox import deferrable
 from hiicart.utils import format_exceptions, cart_by_uuid
 
 
@@ -19,9 +23,18 @@ def _find_cart(data):
     return cart_by_uuid(invoice[:36])
 
 
+def _cart_key(request):
+    """The uuid of an IPN's cart, for hiicart.inbox."""
+    invoice = request.POST.get("invoice") or request.POST.get("item_number")
+    return (invoice or "")[:36]
+
+
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("paypal_adaptive")
+@deferrable("paypal_adaptive", key=_cart_key)
+@idempotent("paypal_adaptive", key=_notification_key)
 def ipn(request):
     """Instant Payment Notification ipn.
 
@@ -38,6 +51,7 @@ def ipn(request):
     if not ipn.confirm_ipn_data(request.raw_post_data):
         log.error("Paypal IPN Confirmation Failed.")
         raise GatewayError("Paypal IPN Confirmation Failed.")
+    verified(request)
     if "transaction_type" in data: # Parallel/Chained Payment initiation IPN.
         if data["transaction_type"] == "Adaptive Payment PAY":
             ipn.accept_adaptive_payment(data)
@@ -1,5 +1,4 @@
 import urllib
-import httplib2
 from cgi import parse_qs
 
 from decimal import Decimal
@@ -11,6 +10,7 @@ from dateutil.relativedelta import relativedelta
 from hiicart.gateway.base import PaymentGatewayBase, SubmitResult, GatewayError, CancelResult
 from hiicart.gateway.paypal_express.settings import SETTINGS as default_settings
 from hiicart.models import HiiCartError
+from hiicart.transport import transport
 
 NVP_SIGNATURE_TEST_URL = "https://api-3t.sandbox.paypal.com/nvp"
 NVP_SIGNATURE_URL = "https://api-3t.paypal.com/nvp"
@@ -55,7 +55,6 @@ class PaypalExpressCheckoutGateway(PaymentGatewayBase):
         return mark_safe(url)
 
     def _do_nvp(self, method, params_dict):
-        http = httplib2.Http()
         params_dict['method'] = method
         params_dict['user'] = self.settings['API_USERNAME']
         params_dict['pwd'] = self.settings['API_PASSWORD']
@@ -63,7 +62,7 @@ class PaypalExpressCheckoutGateway(PaymentGatewayBase):
         params_dict['version'] = self.settings['API_VERSION']
         encoded_params = urllib.urlencode(params_dict)
 
-        response, content = http.request(self._nvp_url, 'POST', encoded_params)
+        content = transport().post(self._nvp_url, encoded_params).body
         response_dict = parse_qs(content)
         for k, v in response_dict.iteritems():
             if type(v) == list:
@@ -389,6 +388,6 @@ class PaypalExpressCheckoutGateway(PaymentGatewayBase):
         """This Paypal API doesn't support manually charging subscriptions."""
         pass
 
-    def sanitize_clone(self):
+    def sanitize_clone(self, cart):
         """Nothing to fix here."""
         pass
@@ -3,7 +3,10 @@ from django.views.decorators.csrf import csrf_view_exempt
 from django.http import HttpResponseRedirect
 from hiicart.gateway.paypal_express.gateway import PaypalExpressCheckoutGateway
 from hiicart.gateway.paypal_express.ipn import PaypalExpressCheckoutIPN
-from hiicart.gateway.paypal.views import _base_paypal_ipn_listener
+from hiicart.gateway.paypal.views import _base_paypal_ipn_listener, _cart_key, _notification_key
+from hiicart.archive import archived
+from hiicart.idempotency import idempotent
+from hiicart.inbox import deferrable
 from hiicart.utils import format_exceptions, cart_by_uuid
 from hiicart.gateway.base import GatewayError
 
@@ -51,5 +54,8 @@ def finalize(request):
 @csrf_view_exempt
 @format_exceptions
 @never_cache
+@archived("paypal_express")
+@deferrable("paypal_express", key=_cart_key)
+@idempotent("paypal_express", key=_notification_key)
 def ipn(request):
     return _base_paypal_ipn_listener(request, PaypalExpressCheckoutIPN)
@@ -0,0 +1,81 @@
+"""
+Registry of payment gateway classes.
+
+Gateways are registered by name with the dotted path of their class and are
+only imported the first time they're used, so a store using PayPal never
+imports braintree or M2Crypto. Resolved classes are cached.
+
+Other gateways can be added by:
+ * listing them in HIICART_SETTINGS["GATEWAYS"] as {name: "dotted.path.Class"},
+ * a setuptools entry point in the "hiicart.gateways" group, whose name is
+   the gateway name, or
+ * calling register_gateway() with a class or dotted path.
+"""
+
+from hiicart.settings import SETTINGS as hiicart_settings
+
+BUILTIN_GATEWAYS = {
+    "amazon": "hiicart.gateway.amazon.gateway.AmazonGateway",
+    "authorizenet": "hiicart.gateway.authorizenet.gateway.AuthorizeNetGateway",
+    "braintree": "hiicart.gateway.braintree.gateway.BraintreeGateway",
+    "comp": "hiicart.gateway.comp.gateway.CompGateway",
+    "google": "hiicart.gateway.google.gateway.GoogleGateway",
+    "paypal": "hiicart.gateway.paypal.gateway.PaypalGateway",
+    "paypal2": "hiicart.gateway.paypal2.gateway.Paypal2Gateway",
+    "paypal_adaptive": "hiicart.gateway.paypal_adaptive.gateway.PaypalAPGateway",
+    "paypal_express": "hiicart.gateway.paypal_express.gateway.PaypalExpressCheckoutGateway",
+    }
+
+ENTRY_POINT_GROUP = "hiicart.gateways"
+
+# name -> class or dotted path, filled in by _load_registry()
+_gateways = None
+
+
+def _load_registry():
+    global _gateways
+    if _gateways is None:
+        gateways = BUILTIN_GATEWAYS.copy()
+        gateways.update(hiicart_settings.get("GATEWAYS") or {})
+        _gateways = gateways
+    return _gateways
+
+
+def _import_path(path):
+    module, name = path.rsplit(".", 1)
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def _find_entry_point(name):
+    """Load the class of a gateway registered as a setuptools entry point."""
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+        return entry_point.load()
+    return None
+
+
+def register_gateway(name, cls):
+    """Register a gateway class, or the dotted path to one, under name."""
+    _load_registry()[name] = cls
+
+
+def get_gateway_class(name):
+    """Gateway class registered under name. Raises KeyError if there isn't one."""
+    gateways = _load_registry()
+    cls = gateways.get(name)
+    if cls is None:
+        cls = _find_entry_point(name)
+        if cls is None:
+            raise KeyError(name)
+    elif isinstance(cls, basestring):
+        cls = _import_path(cls)
+    gateways[name] = cls
+    return cls
+
+
+def gateway_names():
+    """Names of registered gateways. Entry points are only found on lookup."""
+    return sorted(_load_registry().keys())
@@ -0,0 +1,105 @@
+"""
+Caching for STORE_SETTINGS_FN and CART_SETTINGS_FN results.
+
+Gateways and IPN handlers look up per-store settings when they're created,
+and handling one notification can create several of them for the same cart.
+Results are cached in two places:
+
+ * on the cart instance, so a cart's settings functions run at most once
+   per instance (for each set of CART_SETTINGS_FN arguments), and
+ * if STORE_SETTINGS_KEY_FN is set, in a process-wide cache keyed by the
+   store key it returns for a cart. Entries expire after SETTINGS_CACHE_TTL
+   seconds and can be dropped with invalidate_store_settings() when a
+   store's settings change.
+
+Cached dicts are shared, so callers must not change them. Gateways only
+read them through LayeredSettings.
+"""
+
+import threading
+import time
+
+from hiicart.utils import call_func
+
+
+class SettingsCache(object):
+    """Thread-safe dict of settings with expiring entries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, compute, ttl):
+        """Cached value for key, or compute() if it's missing or older than ttl seconds."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+        finally:
+            self._lock.release()
+        if entry is not None and (ttl is None or now - entry[0] < ttl):
+            return entry[1]
+        # Computed outside the lock so a slow lookup doesn't block other stores
+        value = compute()
+        self._lock.acquire()
+        try:
+            self._entries[key] = (now, value)
+        finally:
+            self._lock.release()
+        return value
+
+    def invalidate(self, key=None):
+        """Drop the entry for key, or every entry if key is None."""
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+
+_store_settings = SettingsCache()
+
+
+def _memo(cart):
+    memo = getattr(cart, "_settings_memo", None)
+    if memo is None:
+        memo = cart._settings_memo = {}
+    return memo
+
+
+def store_settings(cart):
+    """Result of STORE_SETTINGS_FN for the cart, cached as described above."""
+    memo = _memo(cart)
+    if "store" not in memo:
+        hiicart_settings = cart.hiicart_settings
+        compute = lambda: call_func(hiicart_settings["STORE_SETTINGS_FN"], cart)
+        key_fn = hiicart_settings.get("STORE_SETTINGS_KEY_FN")
+        if key_fn:
+            key = call_func(key_fn, cart)
+            memo["store"] = _store_settings.get(key, compute,
+                                                hiicart_settings.get("SETTINGS_CACHE_TTL"))
+        else:
+            memo["store"] = compute()
+    return memo["store"]
+
+
+def cart_settings(cart, **kwargs):
+    """Result of CART_SETTINGS_FN for the cart and kwargs, cached on the cart."""
+    fn = cart.hiicart_settings["CART_SETTINGS_FN"]
+    try:
+        key = ("cart",) + tuple(sorted(kwargs.items()))
+        hash(key)
+    except TypeError:
+        return call_func(fn, cart, **kwargs)
+    memo = _memo(cart)
+    if key not in memo:
+        memo[key] = call_func(fn, cart, **kwargs)
+    return memo[key]
+
+
+def invalidate_store_settings(key=None):
+    """Forget cached settings for a store key, or for every store if key is None."""
+    _store_settings.invalidate(key)
@@ -0,0 +1,204 @@
+"""
+Handle each gateway notification once, however often it's delivered.
+
+Gateways resend notifications they don't think arrived, often several at
+a time. IPN views decorated with idempotent() work out a key identifying
+the notification, e.g. PayPal's ipn_track_id or Google's serial-number.
+Then:
+
+ * the first request with a key runs the view, and its response is kept;
+ * later requests with the key get that response without running the view;
+ * requests that arrive while the first is running wait for it, up to
+   IPN_IDEMPOTENCY_WAIT seconds, and get its response. If it's still
+   running they raise NotificationInProgress, so the gateway (or the
+   hiicart.inbox worker) tries again later.
+
+Keys are stored in NotificationKey, whose unique constraint settles races
+between processes. Threads of one process with the same key wait on the
+first of them rather than on the database, and if IPN_IDEMPOTENCY_CACHE
+names a django cache, handled keys are kept there so most duplicates
+don't touch the database at all.
+
+Views call verified(request) once the gateway has confirmed the
+notification is genuine. A view that raises an error, returns an error
+response, or returns without verifying the notification, e.g. because its
+cart wasn't found, gives its key up, so the next delivery is handled and
+a forged request can't use up the real notification's key. A key whose
+view ran for longer than
+IPN_IDEMPOTENCY_TIMEOUT seconds, e.g. because its process died, is taken
+over by the next delivery.
+"""
+
+import hashlib
+import threading
+import time
+
+from datetime import datetime, timedelta
+from functools import wraps
+from django.db import IntegrityError, router, transaction
+from django.http import HttpResponse
+from django.utils import simplejson
+
+from hiicart.models import NotificationKey, _commit_on_success
+from hiicart.settings import SETTINGS as hiicart_settings
+
+
+class NotificationInProgress(Exception):
+    """Another request is still handling the same notification."""
+
+
+# Events set when the request handling a (gateway, key) in this process finishes
+_running = {}
+_running_lock = threading.Lock()
+
+
+def idempotent(gateway, key):
+    """
+    Decorator for IPN views that should handle each notification once.
+
+    key(request) returns the notification's key, or None to always run the
+    view, e.g. for notifications it can't identify.
+    """
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            notification_key = request.method == "POST" and key(request)
+            if not notification_key:
+                return view(request, *args, **kwargs)
+            return once(gateway, notification_key[:128],
+                        lambda: view(request, *args, **kwargs),
+                        lambda: getattr(request, "ipn_verified", False))
+        return wraps(view)(wrapper)
+    return decorator
+
+
+def verified(request):
+    """Mark a request's notification as confirmed by the gateway, so idempotent() keeps its response."""
+    request.ipn_verified = True
+
+
+def _cache():
+    if hiicart_settings["IPN_IDEMPOTENCY_CACHE"]:
+        from django.core.cache import get_cache
+        return get_cache(hiicart_settings["IPN_IDEMPOTENCY_CACHE"])
+    return None
+
+
+def _cache_key(gateway, key):
+    return "hiicart.notification.%s.%s" % (gateway, hashlib.md5(key.encode("utf-8")).hexdigest())
+
+
+def _keep(gateway, key, kept):
+    """Cache a handled notification's (status, headers, body)."""
+    cache = _cache()
+    if cache is not None:
+        cache.set(_cache_key(gateway, key), kept,
+                  hiicart_settings["IPN_IDEMPOTENCY_CACHE_TTL"])
+
+
+def _response(status, headers, body):
+    response = HttpResponse(body, status=status)
+    for header, value in headers:
+        response[header] = value
+    return response
+
+
+def once(gateway, key, fn, verified=None):
+    """
+    Call fn() for the first delivery of a notification.
+
+    Returns fn()'s response, or the one kept from when it was first called.
+    If verified is given, the response is only kept if verified() returns
+    True after fn().
+    """
+    cache = _cache()
+    if cache is not None:
+        kept = cache.get(_cache_key(gateway, key))
+        if kept is not None:
+            return _response(*kept)
+    _running_lock.acquire()
+    try:
+        done = _running.get((gateway, key))
+        first = done is None
+        if first:
+            done = _running[(gateway, key)] = threading.Event()
+    finally:
+        _running_lock.release()
+    if not first:
+        done.wait(hiicart_settings["IPN_IDEMPOTENCY_WAIT"])
+    try:
+        return _once(gateway, key, fn, verified)
+    finally:
+        if first:
+            _running_lock.acquire()
+            try:
+                del _running[(gateway, key)]
+            finally:
+                _running_lock.release()
+            done.set()
+
+
+def _claim(gateway, key):
+    """Returns (record, True) if this request should handle the notification, else (record, False)."""
+    now = datetime.now()
+    using = router.db_for_write(NotificationKey)
+    try:
+        with _commit_on_success(using):
+            # Inside the caller's transaction, only undo the failed insert
+            sid = transaction.savepoint(using=using)
+            try:
+                record = NotificationKey.objects.create(gateway=gateway, key=key, started=now)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=using)
+                raise
+            transaction.savepoint_commit(sid, using=using)
+            return record, True
+    except IntegrityError:
+        pass
+    try:
+        record = NotificationKey.objects.get(gateway=gateway, key=key)
+    except NotificationKey.DoesNotExist:
+        # Given up since the insert failed
+        return None, False
+    timeout = timedelta(seconds=hiicart_settings["IPN_IDEMPOTENCY_TIMEOUT"])
+    if record.status == "RUNNING" and record.started < now - timeout:
+        taken = NotificationKey.objects.filter(pk=record.pk, status="RUNNING",
+                                               started=record.started).update(started=now)
+        if taken:
+            record.started = now
+            return record, True
+    return record, False
+
+
+def _once(gateway, key, fn, verified=None):
+    deadline = time.time() + hiicart_settings["IPN_IDEMPOTENCY_WAIT"]
+    delay = 0.05
+    while True:
+        record, claimed = _claim(gateway, key)
+        if claimed:
+            break
+        if record is not None and record.status == "DONE":
+            kept = (record.response_status, simplejson.loads(record.response_headers or "[]"),
+                    record.response_body.encode("latin-1"))
+            _keep(gateway, key, kept)
+            return _response(*kept)
+        if time.time() >= deadline:
+            raise NotificationInProgress("%s notification %s is still being handled" % (gateway, key))
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+    mine = NotificationKey.objects.filter(pk=record.pk, status="RUNNING")
+    try:
+        response = fn()
+    except Exception:
+        transaction.rollback_unless_managed()
+        mine.delete()
+        raise
+    if response.status_code >= 400 or (verified is not None and not verified()):
+        mine.delete()
+        return response
+    headers = response.items()
+    mine.update(status="DONE", finished=datetime.now(),
+                response_status=response.status_code,
+                response_headers=simplejson.dumps(headers),
+                response_body=response.content.decode("latin-1"))
+    _keep(gateway, key, (response.status_code, headers, response.content))
+    return response
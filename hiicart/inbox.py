@@ -0,0 +1,444 @@
+"""
+Deferred handling of gateway notifications (IPNs).
+
+Verifying a notification means calling back to the gateway (PayPal's
+_notify-validate, Amazon's VerifySignature), so when a gateway is slow the
+IPN views are too, and the gateway times out and sends the notification
+again. With IPN_DEFERRED set, views decorated with deferrable() instead
+store the raw notification as an IPNInbox row, acknowledge it straight
+away, and hand its id to the IPN_QUEUE_BACKEND. The queue later calls
+run(), which rebuilds the request and calls the undecorated view, which
+verifies and applies it as it would have inline.
+
+Delivery is at least once: rows are committed before the gateway gets its
+acknowledgement, a row is only claimed by one worker at a time, and rows
+whose view raises an error are retried up to IPN_MAX_ATTEMPTS times. A
+notification can still be applied twice, e.g. if a worker dies after
+applying it but before marking it done, so handlers must be idempotent.
+Those in hiicart look payments up by transaction id before creating them.
+
+The hiicart_ipn_worker command (see Worker) also applies each cart's
+notifications in the order they arrived, while processing different carts
+in parallel. The queue backends below don't, so sites that need that
+should use ManualQueue and run the command.
+
+Settings:
+
+ * *IPN_DEFERRED* -- Defer IPN verification and handling. [default: False]
+ * *IPN_QUEUE_BACKEND* -- Class that runs stored notifications.
+            [default: "hiicart.inbox.ThreadQueue"]
+     * "hiicart.inbox.ThreadQueue" -- IPN_WORKER_THREADS threads in the web
+       process. Notifications queued when the process stops stay PENDING.
+     * "hiicart.inbox.CeleryQueue" -- the hiicart.tasks.process_notification
+       celery task.
+     * "hiicart.inbox.ManualQueue" -- nothing; run hiicart_ipn_worker.
+ * *IPN_WORKER_THREADS* -- Threads used by ThreadQueue. [default: 4]
+ * *IPN_MAX_ATTEMPTS* -- Times a notification is tried before it's marked
+            FAILED. [default: 5]
+ * *IPN_CLAIM_TIMEOUT* -- Seconds after which recover() assumes the worker
+            processing a notification died. [default: 300]
+
+Notifications left PENDING by a stopped process, or PROCESSING by a dead
+worker, are picked up by hiicart_ipn_worker, or by running recover() and
+process_pending(), e.g. from cron.
+"""
+
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+import traceback
+import zlib
+
+from datetime import datetime, timedelta
+from functools import wraps
+from StringIO import StringIO
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.http import HttpResponse
+from django.utils import simplejson
+
+from hiicart.models import IPNInbox
+from hiicart.settings import SETTINGS as hiicart_settings
+from hiicart.utils import request_meta
+
+
+log = logging.getLogger("hiicart.inbox")
+
+# Views decorated with deferrable(), by dotted path
+_HANDLERS = {}
+
+# Request variables stored with a notification, besides HTTP_* headers
+_STORED_META = ("CONTENT_TYPE", "QUERY_STRING", "REMOTE_ADDR", "SCRIPT_NAME",
+                "SERVER_NAME", "SERVER_PORT", "wsgi.url_scheme")
+
+
+def deferrable(gateway, key=None, ack=None, verify=None):
+    """
+    Decorator for IPN views whose handling can be deferred.
+
+    key(request) returns the uuid of the notification's cart, or another id
+    all of the cart's notifications share; notifications with the same key
+    are handled in the order they arrived. ack(request) returns the
+    response sent to the gateway when the notification is stored; it
+    defaults to an empty 200 response.
+
+    Credential headers aren't stored (see hiicart.utils.SECRET_HEADERS), so
+    views that check them need verify(request), which checks them before
+    the notification is stored and returns an error response, or None to
+    go on. Views then skip the check for requests with an ipn_inbox.
+    """
+    def decorator(view):
+        path = "%s.%s" % (view.__module__, view.__name__)
+        _HANDLERS[path] = view
+        def wrapper(request, *args, **kwargs):
+            if (not hiicart_settings["IPN_DEFERRED"] or request.method != "POST"
+                    or getattr(request, "ipn_inbox", None) is not None):
+                return view(request, *args, **kwargs)
+            if verify is not None:
+                response = verify(request)
+                if response is not None:
+                    return response
+            notification = store(request, gateway, path, key)
+            ipn_queue().put(notification.pk)
+            if ack is not None:
+                return ack(request)
+            return HttpResponse()
+        return wraps(view)(wrapper)
+    return decorator
+
+
+def store(request, gateway, handler, key=None):
+    """Save the request, less credential headers, as an IPNInbox row, committing it at once."""
+    meta = request_meta(request, _STORED_META)
+    body = request.raw_post_data
+    partition_key = (key and key(request) or "")[:64]
+    notification = IPNInbox(gateway=gateway, handler=handler,
+                            path=request.path_info,
+                            headers=simplejson.dumps(meta),
+                            body=body.decode("latin-1"),
+                            partition_key=partition_key,
+                            bucket=partition_bucket(partition_key))
+    with transaction.commit_on_success():
+        notification.save()
+    log.info("Stored %s IPN #%s" % (gateway, notification.pk))
+    return notification
+
+
+def make_request(path, meta, body):
+    """Rebuild a POSTed HttpRequest from its path, stored META and raw body."""
+    environ = {"REQUEST_METHOD": "POST",
+               "PATH_INFO": path,
+               "SCRIPT_NAME": "",
+               "QUERY_STRING": "",
+               "SERVER_NAME": "localhost",
+               "SERVER_PORT": "80",
+               "wsgi.url_scheme": "http",
+               "wsgi.input": StringIO(body)}
+    environ.update(meta)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return WSGIRequest(environ)
+
+
+def build_request(notification):
+    """Rebuild the HttpRequest a notification was received in."""
+    request = make_request(notification.path, simplejson.loads(notification.headers),
+                           notification.raw_body)
+    request.ipn_inbox = notification
+    return request
+
+
+def _handler(path):
+    if path not in _HANDLERS:
+        # Importing the view's module registers it
+        __import__(path.rsplit(".", 1)[0])
+    return _HANDLERS[path]
+
+
+def _worker_name():
+    return ("%s:%i:%s" % (socket.gethostname(), os.getpid(),
+                          threading.current_thread().name))[-64:]
+
+
+def handle(notification):
+    """
+    Call a claimed notification's view and record the outcome.
+
+    Returns the notification's new status: DONE, REJECTED if the view
+    returned an error response, or PENDING, or FAILED after
+    IPN_MAX_ATTEMPTS, if it raised an error.
+    """
+    error = ""
+    available_at = None
+    try:
+        response = _handler(notification.handler)(build_request(notification))
+    except Exception:
+        transaction.rollback_unless_managed()
+        error = traceback.format_exc()
+        log.error("%s IPN #%s failed, attempt %i: %s" % (
+                  notification.gateway, notification.pk, notification.attempts, error))
+        if notification.attempts >= hiicart_settings["IPN_MAX_ATTEMPTS"]:
+            status = "FAILED"
+        else:
+            status = "PENDING"
+            available_at = datetime.now() + timedelta(seconds=retry_delay(notification.attempts))
+    else:
+        if response.status_code >= 400:
+            status = "REJECTED"
+            error = response.content
+            log.error("%s IPN #%s rejected: %i %s" % (
+                      notification.gateway, notification.pk, response.status_code, error))
+        else:
+            status = "DONE"
+    # Unless recover() gave it to another worker meanwhile
+    IPNInbox.objects.filter(pk=notification.pk, status="PROCESSING",
+                            claimed_by=notification.claimed_by).update(
+            status=status, last_error=error, available_at=available_at,
+            processed_at=datetime.now())
+    return status
+
+
+def process(pk):
+    """
+    Claim a PENDING notification and call its view.
+
+    Returns the notification's new status, or None if it wasn't PENDING,
+    e.g. because another worker claimed it first.
+    """
+    claimed = IPNInbox.objects.filter(pk=pk, status="PENDING").update(
+            status="PROCESSING", attempts=F("attempts") + 1,
+            claimed_at=datetime.now(), claimed_by=_worker_name())
+    if not claimed:
+        return None
+    return handle(IPNInbox.objects.get(pk=pk))
+
+
+def retry_delay(attempts):
+    """Seconds to wait before another try, after attempts failures."""
+    return min(60 * 2 ** (attempts - 1), 3600)
+
+
+def run(pk):
+    """Process a notification, putting it back on the queue if it should be retried."""
+    status = process(pk)
+    if status == "PENDING":
+        attempts = IPNInbox.objects.filter(pk=pk).values_list("attempts", flat=True)[0]
+        ipn_queue().put(pk, retry_delay(attempts))
+    return status
+
+
+def recover(timeout=None):
+    """
+    Make notifications claimed more than timeout seconds ago PENDING again.
+
+    Returns how many there were. timeout defaults to IPN_CLAIM_TIMEOUT.
+    """
+    if timeout is None:
+        timeout = hiicart_settings["IPN_CLAIM_TIMEOUT"]
+    cutoff = datetime.now() - timedelta(seconds=timeout)
+    return IPNInbox.objects.filter(status="PROCESSING", claimed_at__lt=cutoff).update(
+            status="PENDING", claimed_by="")
+
+
+def process_pending(limit=None):
+    """Process PENDING notifications, in order for each cart. Returns how many were processed."""
+    return Worker(batch_size=min(limit or 100, 100)).drain(limit)
+
+
+def partition_bucket(key):
+    """The IPNInbox.bucket for a partition key."""
+    return zlib.crc32(key.encode("utf-8")) & 0x7fffffff
+
+
+# Versions of databases that have SELECT ... FOR UPDATE SKIP LOCKED, by alias
+_SKIP_LOCKED = {}
+
+
+def _supports_skip_locked(connection):
+    if connection.alias not in _SKIP_LOCKED:
+        supported = False
+        vendor = getattr(connection, "vendor", None)
+        if vendor in ("postgresql", "mysql"):
+            cursor = connection.cursor()
+            if vendor == "postgresql":
+                cursor.execute("SHOW server_version_num")
+                supported = int(cursor.fetchone()[0]) >= 90500
+            else:
+                cursor.execute("SELECT VERSION()")
+                version = cursor.fetchone()[0]
+                supported = "MariaDB" not in version and int(version.split(".")[0]) >= 8
+        _SKIP_LOCKED[connection.alias] = supported
+    return _SKIP_LOCKED[connection.alias]
+
+
+class Worker(object):
+    """
+    Processes the PENDING notifications in one of several partitions.
+
+    Notifications are partitioned by IPNInbox.bucket, a hash of their cart's
+    uuid, so all of a cart's notifications are in the same partition. A
+    worker handles them one at a time, oldest first, and won't start one
+    while an older notification for the same cart is being processed or
+    waiting for a retry. Different partitions can be processed at the same
+    time, by workers in other threads, processes or hosts.
+
+    Batches of notifications are claimed with SELECT ... FOR UPDATE SKIP
+    LOCKED where the database supports it, so workers that share a
+    partition don't wait for each other; elsewhere they may both select the
+    same rows, but only one of them claims each.
+    """
+
+    def __init__(self, partition=0, partitions=1, batch_size=100):
+        self.partition = partition
+        self.partitions = partitions
+        self.batch_size = batch_size
+        self.name = _worker_name()
+
+    def candidates(self, now):
+        """Notifications this worker could claim, oldest first."""
+        qn = connection.ops.quote_name
+        table = qn(IPNInbox._meta.db_table)
+        # Nothing older for the same cart is in progress or waiting to retry
+        where = ["NOT EXISTS (SELECT 1 FROM %(t)s earlier"
+                 " WHERE earlier.partition_key = %(t)s.partition_key"
+                 " AND %(t)s.partition_key <> ''"
+                 " AND earlier.id < %(t)s.id"
+                 " AND (earlier.status = 'PROCESSING'"
+                 " OR (earlier.status = 'PENDING' AND earlier.available_at > %%s)))" % {"t": table}]
+        params = [now]
+        if self.partitions > 1:
+            where.append("%s.bucket %%%% %%s = %%s" % table)
+            params += [self.partitions, self.partition]
+        return (IPNInbox.objects.filter(status="PENDING")
+                                .filter(Q(available_at__isnull=True) | Q(available_at__lte=now))
+                                .extra(where=where, params=params)
+                                .order_by("pk"))
+
+    def claim(self):
+        """Claim a batch of notifications. Returns them oldest first."""
+        now = datetime.now()
+        with transaction.commit_on_success():
+            candidates = self.candidates(now).values_list("pk", flat=True)[:self.batch_size]
+            if _supports_skip_locked(connection):
+                sql, params = candidates.query.get_compiler(candidates.db).as_sql()
+                cursor = connection.cursor()
+                cursor.execute(sql + " FOR UPDATE SKIP LOCKED", params)
+                pks = [row[0] for row in cursor.fetchall()]
+            else:
+                pks = list(candidates)
+            if not pks:
+                return []
+            IPNInbox.objects.filter(pk__in=pks, status="PENDING").update(
+                    status="PROCESSING", attempts=F("attempts") + 1,
+                    claimed_at=now, claimed_by=self.name)
+        return list(IPNInbox.objects.filter(pk__in=pks, status="PROCESSING",
+                                            claimed_by=self.name).order_by("pk"))
+
+    def _release(self, notification):
+        """Give back a claimed notification without counting the attempt."""
+        IPNInbox.objects.filter(pk=notification.pk, claimed_by=self.name).update(
+                status="PENDING", attempts=F("attempts") - 1, claimed_by="")
+
+    def process_batch(self):
+        """Claim and handle a batch. Returns how many notifications were handled."""
+        failed = set()
+        handled = 0
+        for notification in self.claim():
+            key = notification.partition_key
+            if key and key in failed:
+                # Wait for the failed one's retry, to keep the cart's order
+                self._release(notification)
+                continue
+            if handle(notification) == "PENDING":
+                failed.add(key)
+            handled += 1
+        return handled
+
+    def drain(self, limit=None):
+        """Process batches until none are left, or limit notifications were handled."""
+        total = 0
+        while limit is None or total < limit:
+            handled = self.process_batch()
+            if not handled:
+                break
+            total += handled
+        return total
+
+    def run(self, poll=1.0):
+        """Process notifications as they arrive, forever."""
+        recovered_at = 0
+        while True:
+            if time.time() - recovered_at > hiicart_settings["IPN_CLAIM_TIMEOUT"] / 2:
+                recover()
+                recovered_at = time.time()
+            if not self.drain():
+                time.sleep(poll)
+
+
+class ManualQueue(object):
+    """Leaves notifications for hiicart_ipn_worker or process_pending()."""
+
+    def put(self, pk, delay=0):
+        pass
+
+
+class ThreadQueue(object):
+    """Process notifications in worker threads of this process."""
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < hiicart_settings["IPN_WORKER_THREADS"]:
+                thread = threading.Thread(target=self._work,
+                                          name="hiicart-ipn-%i" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            pk = self._queue.get()
+            try:
+                run(pk)
+            except Exception:
+                log.exception("Processing IPN #%s failed" % pk)
+
+    def put(self, pk, delay=0):
+        if delay:
+            timer = threading.Timer(delay, self.put, [pk])
+            timer.daemon = True
+            timer.start()
+            return
+        self._start()
+        self._queue.put(pk)
+
+
+class CeleryQueue(object):
+    """Process notifications with celery."""
+
+    def put(self, pk, delay=0):
+        from hiicart.tasks import process_notification
+        process_notification.apply_async(args=[pk], countdown=delay)
+
+
+_queue = None
+
+
+def ipn_queue():
+    """The IPN_QUEUE_BACKEND instance, shared by the whole process."""
+    global _queue
+    if _queue is None:
+        path = hiicart_settings["IPN_QUEUE_BACKEND"]
+        module, name = path.rsplit(".", 1)
+        _queue = getattr(__import__(module, fromlist=[name]), name)()
+    return _queue
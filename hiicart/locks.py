@@ -0,0 +1,107 @@
+"""
+Per-cart locks for HiiCartBase.batch().
+
+Payment gateways often send several notifications for a cart at once, and
+handlers that read a cart, change it and save it would overwrite each
+other. batch() takes a lock on the cart for the length of its transaction
+and re-reads the cart once it has it, so each handler works from the
+latest committed state.
+
+The CART_LOCK_BACKEND setting names the lock class:
+
+ * "hiicart.locks.DatabaseLock" -- lock the cart's row with a no-op UPDATE,
+   held until the transaction ends. Only serializes handlers on databases
+   with row locks; see DatabaseLock. [default]
+ * "hiicart.locks.ThreadLock" -- a lock per cart in this process. Only for
+   sites running a single process, e.g. on SQLite.
+ * "hiicart.locks.NullLock" -- no locking.
+
+Backends have acquire(cart, using) and release(cart, using) methods.
+release() is called after the transaction has committed or rolled back,
+or, when the batch joined a transaction managed elsewhere, as it exits.
+"""
+
+import threading
+
+from django.db import connections
+from hiicart.settings import SETTINGS as hiicart_settings
+
+
+class NullLock(object):
+    """Doesn't lock anything."""
+
+    def acquire(self, cart, using):
+        pass
+
+    def release(self, cart, using):
+        pass
+
+
+class DatabaseLock(NullLock):
+    """
+    Lock the cart's row until the end of the transaction.
+
+    Serializes handlers on PostgreSQL, Oracle and MySQL with InnoDB, where
+    the UPDATE takes a row lock, even though it changes nothing. It doesn't
+    on SQLite, which has no row locks: the UPDATE takes the lock on the whole
+    database, which other handlers wait for only up to the connection's
+    timeout before failing with "database is locked". Nor on MySQL's MyISAM
+    tables, which have no transactions. Use ThreadLock there.
+    """
+
+    def acquire(self, cart, using):
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        pk = qn(cart._meta.pk.column)
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET %s = %s WHERE %s = %%s" % (
+                       qn(cart._meta.db_table), pk, pk, pk), [cart.pk])
+
+
+class ThreadLock(NullLock):
+    """A lock per cart, shared by the threads of this process."""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    def _lock(self, cart):
+        key = (cart.__class__, cart.pk)
+        self._guard.acquire()
+        try:
+            lock = self._locks.get(key)
+            if lock is None:
+                # [lock, users]; dropped when nobody holds or waits for it
+                lock = self._locks[key] = [threading.Lock(), 0]
+            lock[1] += 1
+            return lock
+        finally:
+            self._guard.release()
+
+    def acquire(self, cart, using):
+        self._lock(cart)[0].acquire()
+
+    def release(self, cart, using):
+        key = (cart.__class__, cart.pk)
+        self._guard.acquire()
+        try:
+            lock = self._locks[key]
+            lock[0].release()
+            lock[1] -= 1
+            if not lock[1]:
+                del self._locks[key]
+        finally:
+            self._guard.release()
+
+
+_backend = None
+
+
+def cart_lock():
+    """The CART_LOCK_BACKEND instance, shared by the whole process."""
+    global _backend
+    if _backend is None:
+        path = hiicart_settings["CART_LOCK_BACKEND"]
+        module, name = path.rsplit(".", 1)
+        _backend = getattr(__import__(module, fromlist=[name]), name)()
+    return _backend
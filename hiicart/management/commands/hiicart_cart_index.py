@@ -0,0 +1,41 @@
+"""Add carts missing from CartIndex."""
+
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from hiicart.models import CART_TYPES, CartIndex
+
+
+class Command(BaseCommand):
+    help = ("Add every cart of every cart type that isn't in CartIndex yet, "
+            "e.g. carts that existed before their app was migrated.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=5000,
+                    help="Carts checked per query. [default: 5000]"),
+        )
+
+    def handle(self, *args, **options):
+        for cart_class in CART_TYPES:
+            content_type = ContentType.objects.get_for_model(cart_class)
+            indexed = CartIndex.objects.filter(content_type=content_type)
+            carts = cart_class._default_manager.order_by("pk")
+            last_id = added = 0
+            while True:
+                rows = list(carts.filter(pk__gt=last_id)
+                                 .values_list("pk", "_cart_uuid")[:options["batch_size"]])
+                if not rows:
+                    break
+                done = set(indexed.filter(object_id__gte=rows[0][0], object_id__lte=rows[-1][0])
+                                  .values_list("object_id", flat=True))
+                missing = [(pk, cart_uuid) for pk, cart_uuid in rows if pk not in done]
+                if missing:
+                    with transaction.commit_on_success():
+                        for pk, cart_uuid in missing:
+                            CartIndex.objects.create(cart_uuid=cart_uuid, object_id=pk,
+                                                     content_type=content_type)
+                added += len(missing)
+                last_id = rows[-1][0]
+            self.stdout.write("%s: indexed %i carts\n" % (cart_class.__name__, added))
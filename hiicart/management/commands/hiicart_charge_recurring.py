@@ -0,0 +1,79 @@
+"""Charge recurring carts that are due, in parallel."""
+
+import os
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hiicart.models import CART_TYPES
+from hiicart.recurring import RecurringChargeScheduler
+from hiicart.settings import SETTINGS as hiicart_settings
+from hiicart.utils import read_checkpoint, write_checkpoint
+
+
+class Command(BaseCommand):
+    help = ("Run charge_recurring for every RECURRING cart with an active "
+            "recurring item past CHARGE_RECURRING_GRACE_PERIOD, or "
+            "EXPIRATION_GRACE_PERIOD if that isn't set.")
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=8,
+                    help="Carts charged at once. [default: 8]"),
+        make_option("--gateway-limit", action="append", dest="gateway_limits",
+                    default=[], metavar="GATEWAY=N",
+                    help="Most carts charged at once with GATEWAY. May be repeated."),
+        make_option("--batch-size", type="int", dest="batch_size", default=500,
+                    help="Carts loaded and charged per batch. [default: 500]"),
+        make_option("--checkpoint", dest="checkpoint", default=None,
+                    help="File recording progress. An interrupted run started "
+                         "again with the same file resumes where it stopped."),
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+        limits = {}
+        for limit in options["gateway_limits"]:
+            try:
+                gateway, n = limit.split("=")
+                limits[gateway] = int(n)
+            except ValueError:
+                raise CommandError("Invalid --gateway-limit %s, use GATEWAY=N." % limit)
+        scheduler = RecurringChargeScheduler(
+            workers=options["workers"], gateway_limits=limits,
+            grace_period=hiicart_settings["CHARGE_RECURRING_GRACE_PERIOD"])
+        if not scheduler.grace_period:
+            raise CommandError("Set CHARGE_RECURRING_GRACE_PERIOD or EXPIRATION_GRACE_PERIOD; "
+                               "without either charge_recurring never charges a cart.")
+        path = options["checkpoint"]
+        checkpoint = read_checkpoint(path)
+        start = time.time()
+        charged = skipped = failed = 0
+        for cart_class in CART_TYPES:
+            label = "%s.%s" % (cart_class._meta.app_label, cart_class._meta.object_name)
+            last_id = checkpoint.get(label, 0)
+            while True:
+                carts = list(scheduler.due_carts(cart_class, last_id)[:options["batch_size"]])
+                if not carts:
+                    break
+                for result in scheduler.charge(carts):
+                    if result.ok:
+                        charged += 1
+                    elif result.error is None:
+                        skipped += 1
+                        self.stderr.write("%s\n" % unicode(result))
+                    else:
+                        failed += 1
+                        self.stderr.write("%s\n" % unicode(result))
+                last_id = carts[-1].pk
+                if path:
+                    checkpoint[label] = last_id
+                    write_checkpoint(path, checkpoint)
+                self.stdout.write("%s: %i ok, %i skipped, %i failed up to #%i, %.1f carts/s\n" % (
+                                  label, charged, skipped, failed, last_id,
+                                  (charged + skipped + failed) / max(time.time() - start, 0.001)))
+        if path and os.path.exists(path):
+            os.remove(path)
+        self.stdout.write("Charged %i carts, %i skipped, %i failed, in %.1fs\n" % (
+                          charged, skipped, failed, time.time() - start))
@@ -0,0 +1,102 @@
+"""Cancel recurring carts whose subscriptions have expired."""
+
+import os
+import time
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from hiicart.locks import cart_lock
+from hiicart.models import CART_TYPES, _commit_on_success
+from hiicart.settings import SETTINGS as hiicart_settings
+from hiicart.utils import read_checkpoint, write_checkpoint
+
+
+class Command(BaseCommand):
+    help = ("Cancel RECURRING and PENDCANCEL carts whose recurring items "
+            "expired more than EXPIRATION_GRACE_PERIOD ago.")
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="Report expired carts without cancelling them."),
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+                    help="Carts cancelled per query. [default: 1000]"),
+        make_option("--checkpoint", dest="checkpoint", default=None,
+                    help="File recording progress. An interrupted run started "
+                         "again with the same file resumes where it stopped."),
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+        grace_period = hiicart_settings["EXPIRATION_GRACE_PERIOD"]
+        if not grace_period:
+            raise CommandError("Set EXPIRATION_GRACE_PERIOD; without it "
+                               "cancel_if_expired never cancels a cart.")
+        cutoff = datetime.now() - grace_period
+        path = options["checkpoint"]
+        checkpoint = read_checkpoint(path)
+        start = time.time()
+        total = 0
+        for cart_class in CART_TYPES:
+            label = "%s.%s" % (cart_class._meta.app_label, cart_class._meta.object_name)
+            last_id = checkpoint.get(label, 0)
+            if last_id:
+                self.stdout.write("%s: resuming after cart #%i\n" % (label, last_id))
+            candidates = cart_class._default_manager.expired(cutoff).order_by("pk")
+            while True:
+                chunk = list(candidates.filter(pk__gt=last_id)[:options["batch_size"]].iterator())
+                if not chunk:
+                    break
+                if options["dry_run"]:
+                    for cart in chunk:
+                        self.stdout.write("%s #%i would be cancelled\n" % (label, cart.pk))
+                else:
+                    self.cancel(cart_class, chunk)
+                last_id = chunk[-1].pk
+                total += len(chunk)
+                if path and not options["dry_run"]:
+                    checkpoint[label] = last_id
+                    write_checkpoint(path, checkpoint)
+                self.stdout.write("%s: %i carts up to #%i, %.1f carts/s\n" % (
+                                  label, total, last_id, total / max(time.time() - start, 0.001)))
+        if path and not options["dry_run"] and os.path.exists(path):
+            os.remove(path)
+        self.stdout.write("%s %i carts in %.1fs\n" % (
+                          "Found" if options["dry_run"] else "Cancelled",
+                          total, time.time() - start))
+
+    def cancel(self, cart_class, carts):
+        """
+        Cancel carts with one UPDATE, then send cart_state_changed for each.
+
+        The carts are locked like in HiiCartBase.batch(), and only those
+        still RECURRING or PENDCANCEL once locked are cancelled and signalled.
+        """
+        using = router.db_for_write(cart_class)
+        manager = cart_class._default_manager.using(using)
+        backend = cart_lock()
+        locked = []
+        try:
+            with _commit_on_success(using):
+                # carts are in pk order, so concurrent runs can't deadlock
+                for cart in carts:
+                    backend.acquire(cart, using)
+                    locked.append(cart)
+                old_states = dict(manager.filter(pk__in=[c.pk for c in carts],
+                                                 _cart_state__in=("RECURRING", "PENDCANCEL"))
+                                         .values_list("pk", "_cart_state"))
+                if old_states:
+                    manager.filter(pk__in=old_states.keys()).update(
+                        _cart_state="CANCELLED", last_updated=datetime.now())
+        finally:
+            for cart in locked:
+                backend.release(cart, using)
+        for cart in carts:
+            if cart.pk not in old_states:
+                continue
+            cart._cart_state = cart._old_state = "CANCELLED"
+            cart.cart_state_changed.send(sender=cart_class.__name__, cart=cart,
+                                         old_state=old_states[cart.pk], new_state="CANCELLED")
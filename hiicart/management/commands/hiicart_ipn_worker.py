@@ -0,0 +1,56 @@
+"""Process deferred IPNs stored in IPNInbox."""
+
+import multiprocessing
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from hiicart.inbox import Worker
+
+
+class Command(BaseCommand):
+    help = ("Process deferred IPNs, applying each cart's notifications in the "
+            "order they arrived. Notifications are split into --partitions "
+            "partitions by cart, each processed by its own process.")
+    option_list = BaseCommand.option_list + (
+        make_option("--partitions", type="int", dest="partitions", default=1,
+                    help="Number of partitions across all hosts. [default: 1]"),
+        make_option("--partition", type="int", dest="partition", action="append",
+                    help="Partition to process; repeat for several. Use to "
+                         "spread partitions over hosts. [default: all]"),
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+                    help="Notifications claimed per query. [default: 100]"),
+        make_option("--poll", type="float", dest="poll", default=1.0,
+                    help="Seconds to wait when there's nothing to do. [default: 1]"),
+        make_option("--once", action="store_true", dest="once", default=False,
+                    help="Exit once there's nothing to do."),
+        )
+
+    def handle(self, *args, **options):
+        partitions = options["partitions"]
+        mine = options["partition"] or range(partitions)
+        if partitions < 1 or options["batch_size"] < 1:
+            raise CommandError("--partitions and --batch-size must be positive.")
+        if [p for p in mine if not 0 <= p < partitions]:
+            raise CommandError("--partition must be from 0 to %i." % (partitions - 1))
+        if len(mine) == 1:
+            self.work(mine[0], partitions, options)
+            return
+        # Each process opens its own connection
+        connection.close()
+        processes = [multiprocessing.Process(target=self.work, args=(p, partitions, options))
+                     for p in mine]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    def work(self, partition, partitions, options):
+        worker = Worker(partition, partitions, options["batch_size"])
+        if options["once"]:
+            count = worker.drain()
+            self.stdout.write("Partition %i: processed %i notifications\n" % (partition, count))
+        else:
+            worker.run(options["poll"])
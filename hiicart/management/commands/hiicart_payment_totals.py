@@ -0,0 +1,102 @@
+"""Check or rebuild the payment totals HiiCart keeps on each cart."""
+
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+from django.db.models import Max, Sum
+
+from hiicart.models import CART_TYPES
+
+
+BACKFILL_SQL = """
+UPDATE %(cart)s SET
+    paid_total = COALESCE((SELECT SUM(p.amount) FROM %(payment)s p
+                           WHERE p.%(fk)s = %(cart)s.%(pk)s AND p.state = 'PAID'), 0),
+    refund_total = COALESCE((SELECT SUM(p.amount) FROM %(payment)s p
+                             WHERE p.%(fk)s = %(cart)s.%(pk)s AND p.state = 'REFUND'), 0),
+    last_paid_at = (SELECT MAX(p.created) FROM %(payment)s p
+                    WHERE p.%(fk)s = %(cart)s.%(pk)s AND p.state = 'PAID' AND p.amount > 0)
+"""
+
+
+def _payment_totals(payment_class, start, end):
+    """Actual totals, by cart id, for carts with start <= id < end."""
+    payments = payment_class._default_manager.filter(cart__gte=start, cart__lt=end)
+    totals = {}
+    rows = payments.filter(state__in=("PAID", "REFUND")).values("cart", "state") \
+                   .annotate(total=Sum("amount")).order_by()
+    for row in rows:
+        field = "paid_total" if row["state"] == "PAID" else "refund_total"
+        totals.setdefault(row["cart"], {})[field] = row["total"]
+    rows = payments.filter(state="PAID", amount__gt=0).values("cart") \
+                   .annotate(last=Max("created")).order_by()
+    for row in rows:
+        totals.setdefault(row["cart"], {})["last_paid_at"] = row["last"]
+    return totals
+
+
+class Command(BaseCommand):
+    help = ("Check the paid_total, refund_total and last_paid_at columns of "
+            "every cart type against its payments. Use --fix to repair the "
+            "carts that differ or --backfill to recalculate every cart.")
+    option_list = BaseCommand.option_list + (
+        make_option("--fix", action="store_true", dest="fix", default=False,
+                    help="Repair carts whose totals don't match their payments."),
+        make_option("--backfill", action="store_true", dest="backfill", default=False,
+                    help="Recalculate the totals of all carts in one statement per cart type."),
+        make_option("--batch-size", type="int", dest="batch_size", default=5000,
+                    help="Range of cart ids checked per query. [default: 5000]"),
+        )
+
+    def handle(self, *args, **options):
+        for cart_class in CART_TYPES:
+            if not hasattr(cart_class, "payment_class"):
+                continue
+            if options["backfill"]:
+                self.backfill(cart_class)
+            else:
+                self.check(cart_class, options["batch_size"], options["fix"])
+
+    def backfill(self, cart_class):
+        using = router.db_for_write(cart_class)
+        qn = connections[using].ops.quote_name
+        payment_class = cart_class.payment_class
+        sql = BACKFILL_SQL % {"cart": qn(cart_class._meta.db_table),
+                              "pk": qn(cart_class._meta.pk.column),
+                              "payment": qn(payment_class._meta.db_table),
+                              "fk": qn(payment_class._meta.get_field("cart").column)}
+        cursor = connections[using].cursor()
+        cursor.execute(sql)
+        transaction.commit_unless_managed(using=using)
+        self.stdout.write("%s: backfilled %s carts\n" % (cart_class.__name__, cursor.rowcount))
+
+    def check(self, cart_class, batch_size, fix):
+        carts = cart_class._default_manager.all()
+        last_id = carts.aggregate(last=Max("pk"))["last"] or 0
+        checked = mismatched = 0
+        for start in range(0, last_id + 1, batch_size):
+            end = start + batch_size
+            actual = _payment_totals(cart_class.payment_class, start, end)
+            rows = carts.filter(pk__gte=start, pk__lt=end) \
+                        .values_list("pk", "paid_total", "refund_total", "last_paid_at")
+            for pk, paid_total, refund_total, last_paid_at in rows:
+                checked += 1
+                expected = {"paid_total": Decimal("0.00"),
+                            "refund_total": Decimal("0.00"),
+                            "last_paid_at": None}
+                expected.update(actual.get(pk, {}))
+                found = {"paid_total": paid_total,
+                         "refund_total": refund_total,
+                         "last_paid_at": last_paid_at}
+                if found == expected:
+                    continue
+                mismatched += 1
+                self.stdout.write("%s #%s: found %s, expected %s\n" % (
+                                  cart_class.__name__, pk, found, expected))
+                if fix:
+                    carts.filter(pk=pk).update(**expected)
+        self.stdout.write("%s: %i carts checked, %i mismatched%s\n" % (
+                          cart_class.__name__, checked, mismatched,
+                          " and fixed" if fix and mismatched else ""))
@@ -0,0 +1,163 @@
+"""Replay archived notifications through the IPN views."""
+
+import time
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+
+from hiicart import archive, idempotency, inbox
+from hiicart.settings import SETTINGS as hiicart_settings
+from hiicart.utils import get_func
+
+
+# Gateway methods checking a notification came from the gateway
+VERIFIERS = ("hiicart.gateway.amazon.ipn.AmazonIPN.verify_signature",
+             "hiicart.gateway.authorizenet.ipn.AuthorizeNetIPN.confirm_ipn_data",
+             "hiicart.gateway.google.ipn.GoogleIPN.confirm_ipn_auth",
+             "hiicart.gateway.paypal.ipn.PaypalIPN.confirm_ipn_data",
+             "hiicart.gateway.paypal2.ipn.Paypal2IPN.confirm_ipn_data",
+             "hiicart.gateway.paypal_adaptive.ipn.PaypalAPIPN.confirm_ipn_data")
+
+
+class _ReplayRouter(object):
+    """Sends every query to the database being replayed against."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def db_for_read(self, model, **hints):
+        return self.database
+
+    def db_for_write(self, model, **hints):
+        return self.database
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+def _timestamp(value):
+    try:
+        return time.mktime(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timetuple())
+    except ValueError:
+        try:
+            return time.mktime(datetime.strptime(value, "%Y-%m-%d").timetuple())
+        except ValueError:
+            raise CommandError("Times must be YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS'.")
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of a sorted list."""
+    return ordered[max(int(round(percent / 100.0 * len(ordered))) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = ("Replay notifications archived in IPN_ARCHIVE_DIR through the IPN "
+            "views, oldest first, with gateway verification stubbed out, and "
+            "report throughput and latency per gateway.")
+    option_list = BaseCommand.option_list + (
+        make_option("--dir", dest="directory", default=None,
+                    help="Archive directory. [default: IPN_ARCHIVE_DIR]"),
+        make_option("--database", dest="database", default=None,
+                    help="Database to replay against, from DATABASES. Every "
+                         "query is routed to it. [default: the usual routing]"),
+        make_option("--rate", type="float", dest="rate", default=0,
+                    help="Notifications per second, 0 for as fast as possible. [default: 0]"),
+        make_option("--gateway", dest="gateways", action="append", default=None,
+                    help="Gateway to replay; repeat for several. [default: all]"),
+        make_option("--since", dest="since", default=None,
+                    help="Replay notifications received from this time, "
+                         "YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS'."),
+        make_option("--until", dest="until", default=None,
+                    help="Replay notifications received until this time."),
+        make_option("--limit", type="int", dest="limit", default=0,
+                    help="Notifications to replay, 0 for all. [default: 0]"),
+        make_option("--repeat", action="store_true", dest="repeat", default=False,
+                    help="Handle notifications already handled in the database "
+                         "again, e.g. to repair carts after a handler bug."),
+        )
+
+    def handle(self, *args, **options):
+        directory = options["directory"] or hiicart_settings["IPN_ARCHIVE_DIR"]
+        if not directory:
+            raise CommandError("Give --dir or set IPN_ARCHIVE_DIR.")
+        database = options["database"]
+        if database and database not in connections.databases:
+            raise CommandError("Unknown database %s." % database)
+        since = options["since"] and _timestamp(options["since"])
+        until = options["until"] and _timestamp(options["until"])
+        records = archive.read_archive(directory, since, until, options["gateways"])
+
+        saved_settings = dict([(k, hiicart_settings[k]) for k in ("IPN_DEFERRED", "IPN_ARCHIVE_DIR")])
+        saved_verifiers = []
+        saved_once = idempotency.once
+        replay_router = database and _ReplayRouter(database)
+        try:
+            # Handle notifications here and now, without archiving them again
+            hiicart_settings["IPN_DEFERRED"] = False
+            hiicart_settings["IPN_ARCHIVE_DIR"] = None
+            for path in VERIFIERS:
+                module, cls, method = path.rsplit(".", 2)
+                try:
+                    cls = get_func("%s.%s" % (module, cls))
+                except (ImportError, AttributeError):
+                    continue
+                saved_verifiers.append((cls, method, cls.__dict__[method]))
+                setattr(cls, method, lambda self, *args, **kwargs: True)
+            if options["repeat"]:
+                idempotency.once = lambda gateway, key, fn, verified=None: fn()
+            if replay_router:
+                router.routers.insert(0, replay_router)
+            stats, elapsed = self.replay(records, options["rate"], options["limit"])
+        finally:
+            if replay_router:
+                router.routers.remove(replay_router)
+            idempotency.once = saved_once
+            for cls, method, fn in saved_verifiers:
+                setattr(cls, method, fn)
+            hiicart_settings.update(saved_settings)
+        self.report(stats, elapsed)
+
+    def replay(self, records, rate, limit):
+        """Returns ({gateway: (latencies, errors)}, seconds taken)."""
+        stats = {}
+        views = {}
+        interval = rate and 1.0 / rate
+        start = time.time()
+        for count, (header, body) in enumerate(records):
+            if limit and count >= limit:
+                break
+            if interval:
+                delay = start + count * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if header["view"] not in views:
+                views[header["view"]] = get_func(header["view"])
+            request = inbox.make_request(header["path"], header["meta"], body)
+            latencies, errors = stats.setdefault(header["gateway"], ([], [0]))
+            began = time.time()
+            try:
+                failed = views[header["view"]](request).status_code >= 400
+            except Exception:
+                failed = True
+            latencies.append(time.time() - began)
+            if failed:
+                errors[0] += 1
+        return stats, time.time() - start
+
+    def report(self, stats, elapsed):
+        self.stdout.write("%-16s %8s %7s %9s %9s %9s %9s %9s\n" % (
+            "gateway", "count", "errors", "per sec", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        total = 0
+        for gateway in sorted(stats):
+            latencies, errors = stats[gateway]
+            ordered = sorted(latencies)
+            total += len(ordered)
+            self.stdout.write("%-16s %8i %7i %9.1f %9.2f %9.2f %9.2f %9.2f\n" % (
+                gateway, len(ordered), errors[0], len(ordered) / (sum(ordered) or 1e-9),
+                _percentile(ordered, 50) * 1000, _percentile(ordered, 90) * 1000,
+                _percentile(ordered, 99) * 1000, ordered[-1] * 1000))
+        self.stdout.write("Replayed %i notifications in %.1fs, %.1f per second\n" % (
+            total, elapsed, total / (elapsed or 1e-9)))
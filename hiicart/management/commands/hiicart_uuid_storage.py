@@ -0,0 +1,92 @@
+"""Convert cart uuid columns to the type UUID_STORAGE asks for."""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from hiicart.fields import CartUUIDField, stored_uuid, uuid_storage
+from hiicart.models import CART_TYPES, CartIndex
+
+
+class Command(BaseCommand):
+    help = ("Rebuild every cart uuid column (each cart type's _cart_uuid and "
+            "CartIndex.cart_uuid) with the column type for the current "
+            "UUID_STORAGE setting, copying the data. Run it once after "
+            "changing UUID_STORAGE, with the site stopped. An interrupted "
+            "run is finished by running it again.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=5000,
+                    help="Rows copied per batch. [default: 5000]"),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from south.db import dbs
+        except ImportError:
+            raise CommandError("South is required to change column types.")
+        columns = [(cls, "_cart_uuid") for cls in CART_TYPES] + [(CartIndex, "cart_uuid")]
+        for model, name in columns:
+            using = router.db_for_write(model)
+            self.convert(dbs[using], connections[using], model, name, options["batch_size"])
+
+    def convert(self, db, connection, model, name, batch_size):
+        """
+        Copy a uuid column into a new column of the current type, then swap them.
+
+        A run that stopped while copying copies again into the new column it
+        left. One that stopped after dropping the old column only renames
+        the new one. The drop, rename and index run in one transaction, so
+        on databases with transactional DDL, e.g. PostgreSQL, they happen
+        together or not at all.
+        """
+        table = model._meta.db_table
+        field = model._meta.get_field(name)
+        column = field.column
+        tmp = column + "_new"
+        existing = [row[0] for row in connection.introspection.get_table_description(
+                    connection.cursor(), table)]
+        copied = 0
+        if column in existing:
+            if tmp in existing:
+                self.stdout.write("%s.%s: resuming an interrupted conversion\n" % (table, column))
+            else:
+                db.add_column(table, tmp, CartUUIDField(null=True), keep_default=False)
+            copied = self.copy(connection, model, field, tmp, batch_size)
+        elif tmp in existing:
+            self.stdout.write("%s.%s: finishing an interrupted conversion\n" % (table, column))
+        else:
+            raise CommandError("%s has neither %s nor %s." % (table, column, tmp))
+        db.start_transaction()
+        try:
+            if column in existing:
+                db.delete_column(table, column)
+            db.rename_column(table, tmp, column)
+            db.alter_column(table, column, CartUUIDField())
+            db.create_index(table, [column])
+        except:
+            db.rollback_transaction()
+            raise
+        db.commit_transaction()
+        self.stdout.write("%s.%s: %i rows stored as %s\n" % (
+                          table, column, copied, uuid_storage(connection)))
+
+    def copy(self, connection, model, field, tmp, batch_size):
+        """Copy every row's uuid from field's column to tmp. Returns how many were copied."""
+        qn = connection.ops.quote_name
+        update = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                 qn(model._meta.db_table), qn(tmp), qn(model._meta.pk.column))
+        rows = model._default_manager.order_by("pk")
+        last_id = copied = 0
+        while True:
+            # values_list() returns values as stored, whatever the old type
+            batch = list(rows.filter(pk__gt=last_id).values_list("pk", field.name)[:batch_size])
+            if not batch:
+                break
+            params = [(field.get_db_prep_value(stored_uuid(value), connection=connection), pk)
+                      for pk, value in batch]
+            connection.cursor().executemany(update, params)
+            transaction.commit_unless_managed(using=connection.alias)
+            copied += len(batch)
+            last_id = batch[-1][0]
+        return copied
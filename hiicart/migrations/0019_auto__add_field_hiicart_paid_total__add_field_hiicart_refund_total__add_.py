@@ -0,0 +1,200 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+# Fills the payment totals from existing payments. Correlated subqueries keep
+# this to one statement per column however many carts there are.
+BACKFILL_SQL = """
+UPDATE hiicart_hiicart SET
+    paid_total = COALESCE((SELECT SUM(p.amount) FROM hiicart_payment p
+                           WHERE p.cart_id = hiicart_hiicart.id AND p.state = 'PAID'), 0),
+    refund_total = COALESCE((SELECT SUM(p.amount) FROM hiicart_payment p
+                             WHERE p.cart_id = hiicart_hiicart.id AND p.state = 'REFUND'), 0),
+    last_paid_at = (SELECT MAX(p.created) FROM hiicart_payment p
+                    WHERE p.cart_id = hiicart_hiicart.id AND p.state = 'PAID' AND p.amount > 0)
+"""
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'HiiCart.paid_total'
+        db.add_column('hiicart_hiicart', 'paid_total', self.gf('django.db.models.fields.DecimalField')(default='0.00', max_digits=18, decimal_places=2), keep_default=False)
+
+        # Adding field 'HiiCart.refund_total'
+        db.add_column('hiicart_hiicart', 'refund_total', self.gf('django.db.models.fields.DecimalField')(default='0.00', max_digits=18, decimal_places=2), keep_default=False)
+
+        # Adding field 'HiiCart.last_paid_at'
+        db.add_column('hiicart_hiicart', 'last_paid_at', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        if not db.dry_run:
+            db.execute(BACKFILL_SQL)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'HiiCart.paid_total'
+        db.delete_column('hiicart_hiicart', 'paid_total')
+
+        # Deleting field 'HiiCart.refund_total'
+        db.delete_column('hiicart_hiicart', 'refund_total')
+
+        # Deleting field 'HiiCart.last_paid_at'
+        db.delete_column('hiicart_hiicart', 'last_paid_at')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'hiicart.hiicart': {
+            'Meta': {'object_name': 'HiiCart'},
+            '_cart_state': ('django.db.models.fields.CharField', [], {'default': "'OPEN'", 'max_length': '16', 'db_index': 'True'}),
+            '_cart_uuid': ('django.db.models.fields.CharField', [], {'max_length': '36', 'db_index': 'True'}),
+            '_sub_total': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '2', 'blank': 'True'}),
+            '_total': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '2'}),
+            'bill_city': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50'}),
+            'bill_country': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '2'}),
+            'bill_email': ('django.db.models.fields.EmailField', [], {'default': "''", 'max_length': '255'}),
+            'bill_first_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'bill_last_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'bill_phone': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '30'}),
+            'bill_postal_code': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '30'}),
+            'bill_state': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50'}),
+            'bill_street1': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '80'}),
+            'bill_street2': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '80'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'custom_id': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'discount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '2', 'blank': 'True'}),
+            'failure_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True'}),
+            'fulfilled': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'gateway': ('django.db.models.fields.CharField', [], {'max_length': '16', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_paid_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'paid_total': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'refund_total': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'ship_city': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50'}),
+            'ship_country': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '2'}),
+            'ship_email': ('django.db.models.fields.EmailField', [], {'default': "''", 'max_length': '255'}),
+            'ship_first_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'ship_last_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'ship_phone': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '30'}),
+            'ship_postal_code': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '30'}),
+            'ship_state': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50'}),
+            'ship_street1': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '80'}),
+            'ship_street2': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '80'}),
+            'shipping': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '2', 'blank': 'True'}),
+            'shipping_option_name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'success_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True'}),
+            'tax': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '2', 'blank': 'True'}),
+            'tax_country': ('django.db.models.fields.CharField', [], {'max_length': '2', 'null': 'True', 'blank': 'True'}),
+            'tax_rate': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '6', 'decimal_places': '5', 'blank': 'True'}),
+            'tax_region': ('django.db.models.fields.CharField', [], {'max_length': '127', 'null': 'True', 'blank': 'True'}),
+            'thankyou': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'null': 'True', 'blank': 'True'})
+        },
+        'hiicart.lineitem': {
+            'Meta': {'object_name': 'LineItem'},
+            '_sub_total': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '10'}),
+            '_total': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'cart': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['hiicart.HiiCart']"}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'digital_description': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'discount': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '10'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'ordering': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'quantity': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'sku': ('django.db.models.fields.CharField', [], {'default': "'1'", 'max_length': '255', 'db_index': 'True'}),
+            'unit_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '10'})
+        },
+        'hiicart.note': {
+            'Meta': {'object_name': 'Note'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'text': ('django.db.models.fields.TextField', [], {})
+        },
+        'hiicart.payment': {
+            'Meta': {'object_name': 'Payment'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '2'}),
+            'cart': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'payments'", 'to': "orm['hiicart.HiiCart']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'gateway': ('django.db.models.fields.CharField', [], {'max_length': '25', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'transaction_id': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '45', 'null': 'True', 'blank': 'True'})
+        },
+        'hiicart.paymentresponse': {
+            'Meta': {'object_name': 'PaymentResponse'},
+            'cart': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'payment_results'", 'to': "orm['hiicart.HiiCart']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'response_code': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'response_text': ('django.db.models.fields.TextField', [], {})
+        },
+        'hiicart.recurringlineitem': {
+            'Meta': {'object_name': 'RecurringLineItem'},
+            '_sub_total': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '10'}),
+            '_total': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'cart': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['hiicart.HiiCart']"}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'digital_description': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'discount': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '10'}),
+            'duration': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'duration_unit': ('django.db.models.fields.CharField', [], {'default': "'DAY'", 'max_length': '5'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'ordering': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'payment_token': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True'}),
+            'quantity': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'recurring_price': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'recurring_shipping': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'recurring_start': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'recurring_times': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'sku': ('django.db.models.fields.CharField', [], {'default': "'1'", 'max_length': '255', 'db_index': 'True'}),
+            'trial': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'trial_length': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'trial_price': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '18', 'decimal_places': '2'}),
+            'trial_times': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'})
+        }
+    }
+
+    complete_apps = ['hiicart']
@@ -1,8 +1,10 @@
 import copy
 import django
 import logging
+import operator
 import uuid
 
+from contextlib import contextmanager
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
@@ -10,8 +12,13 @@ from django.dispatch import Signal
 from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F, Max, Q, signals
+from django.db.models.query import QuerySet
 from django.utils.safestring import mark_safe
+from hiicart.fields import CartUUIDField
+from hiicart.gateway.registry import get_gateway_class
+from hiicart.locks import cart_lock
 from hiicart.settings import SETTINGS as hiicart_settings
 from logging.handlers import RotatingFileHandler
 
@@ -58,6 +65,12 @@ PAYMENT_STATES = (("PENDING", "Pending"),
                   ("REFUND", "Refund"),
                   ("CANCELLED", "Cancelled"))
 
+IPN_STATES = (("PENDING", "Pending"),  # Waiting to be processed, or retried
+              ("PROCESSING", "Processing"),
+              ("DONE", "Done"),
+              ("REJECTED", "Rejected"),  # The handler refused it, e.g. failed verification
+              ("FAILED", "Failed"))  # Raised an error IPN_MAX_ATTEMPTS times
+
 # What state transitions are valid for a cart
 VALID_TRANSITIONS = {"OPEN": ["SUBMITTED", "ABANDONED", "COMPLETED",
                               "RECURRING", "PENDCANCEL", "CANCELLED"],
@@ -74,11 +87,235 @@ VALID_TRANSITIONS = {"OPEN": ["SUBMITTED", "ABANDONED", "COMPLETED",
 # For automatic tracking of all cart types, see HiiCartMetaclass
 CART_TYPES = []
 
+# For automatic tracking of all payment types, see PaymentMetaclass
+PAYMENT_TYPES = []
+
+# How many carts HiiCartQuerySet.prefetch_lineitems() loads at once
+PREFETCH_CHUNK_SIZE = 500
+
+# Most cart ids load_lineitems binds in one statement, across all the
+# branches of its UNION. SQLite refuses statements with more than 999.
+UNION_MAX_PARAMS = 999
+
+# Cart columns that mirror its payments. They are only written when
+# payments are saved or deleted, using F() expressions, so never set them
+# directly; HiiCartBase.save doesn't write them.
+#  paid_total -- sum of PAID payment amounts
+#  refund_total -- sum of REFUND payment amounts (normally negative)
+#  last_paid_at -- creation date of the latest PAID payment with amount > 0
+PAYMENT_TOTAL_FIELDS = ("paid_total", "refund_total", "last_paid_at")
+
+# Cart fields, besides its lineitems, that its total is calculated from
+CART_TOTAL_FIELDS = ("discount", "tax", "shipping")
+
 
 class HiiCartError(Exception):
     pass
 
 
+class HiiCartQuerySet(QuerySet):
+    """QuerySet for carts that can bulk load lineitems while iterating."""
+
+    def __init__(self, *args, **kwargs):
+        super(HiiCartQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_lineitems = False
+
+    def _clone(self, *args, **kwargs):
+        c = super(HiiCartQuerySet, self)._clone(*args, **kwargs)
+        c._prefetch_lineitems = self._prefetch_lineitems
+        return c
+
+    def iterator(self):
+        carts = super(HiiCartQuerySet, self).iterator()
+        if not self._prefetch_lineitems:
+            for cart in carts:
+                yield cart
+            return
+        chunk = []
+        for cart in carts:
+            chunk.append(cart)
+            if len(chunk) >= PREFETCH_CHUNK_SIZE:
+                for c in prefetch_lineitems(chunk):
+                    yield c
+                chunk = []
+        for c in prefetch_lineitems(chunk):
+            yield c
+
+    def prefetch_lineitems(self):
+        """Load lineitems for the carts in chunks. See prefetch_lineitems()."""
+        c = self._clone()
+        c._prefetch_lineitems = True
+        return c
+
+    def expired(self, before=None):
+        """
+        RECURRING and PENDCANCEL carts whose recurring lineitems all expire
+        before the given date (default now).
+
+        Same test as cancel_if_expired(), but done in the database using the
+        stored RecurringLineItemBase.expires_at.
+        """
+        if before is None:
+            before = datetime.now()
+        due = []
+        qs = self.filter(_cart_state__in=("RECURRING", "PENDCANCEL"))
+        for cls in self.model.recurring_lineitem_types:
+            items = cls._default_manager
+            due.append(Q(pk__in=items.due(before).values("cart")))
+            qs = qs.exclude(pk__in=items.filter(expires_at__gte=before).values("cart"))
+        if not due:
+            return self.none()
+        return qs.filter(reduce(operator.or_, due))
+
+
+    def charge_due(self, before=None):
+        """RECURRING carts with an active recurring lineitem due before the given date."""
+        due = [Q(pk__in=cls._default_manager.due(before).filter(is_active=True).values("cart"))
+               for cls in self.model.recurring_lineitem_types]
+        if not due:
+            return self.none()
+        return self.filter(reduce(operator.or_, due), _cart_state="RECURRING")
+
+
+class HiiCartManager(models.Manager):
+    def get_query_set(self):
+        return HiiCartQuerySet(self.model, using=self._db)
+
+    def prefetch_lineitems(self):
+        return self.get_query_set().prefetch_lineitems()
+
+    def expired(self, before=None):
+        return self.get_query_set().expired(before)
+
+    def charge_due(self, before=None):
+        return self.get_query_set().charge_due(before)
+
+    def bulk_clone(self, carts):
+        """Clone carts in the OPEN state. See bulk_clone()."""
+        return bulk_clone(carts)
+
+
+class DirtyFieldsMixin(object):
+    """
+    Save only the fields that changed since an instance was loaded or saved.
+
+    Saving an existing row runs an UPDATE of the changed columns (and any
+    auto_now fields) instead of every column, or no query at all if nothing
+    changed. pre_save and post_save are sent either way. New rows, rows of
+    multi-table models, and saves with force_insert or force_update are
+    saved by django as usual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DirtyFieldsMixin, self).__init__(*args, **kwargs)
+        self._remember_saved()
+
+    def _remember_saved(self, names=None):
+        """Record current values as saved, for all fields or just names."""
+        # Read from __dict__ so deferred fields aren't loaded
+        values = dict(getattr(self, "_saved_values", None) or {})
+        for f in self._meta.local_fields:
+            if (names is None or f.name in names) and f.attname in self.__dict__:
+                values[f.attname] = self.__dict__[f.attname]
+        self._saved_values = values
+
+    def get_dirty_fields(self):
+        """Names of fields changed since the instance was loaded or saved."""
+        saved = getattr(self, "_saved_values", {})
+        return [f.name for f in self._meta.local_fields
+                if f.attname in self.__dict__ and f.attname in saved
+                and self.__dict__[f.attname] != saved[f.attname]]
+
+    def _saves_dirty_fields(self, using=None):
+        """Whether save() will write only changed fields."""
+        using = using or router.db_for_write(self.__class__, instance=self)
+        saved = getattr(self, "_saved_values", {})
+        pk_name = self._meta.pk.attname
+        return (self.pk is not None and not self._state.adding and not self._meta.parents
+                and self._state.db == using and saved.get(pk_name) == self.pk)
+
+    def save(self, force_insert=False, force_update=False, using=None):
+        using = using or router.db_for_write(self.__class__, instance=self)
+        if force_insert or force_update or not self._saves_dirty_fields(using) \
+                or not self._save_dirty_fields(using):
+            super(DirtyFieldsMixin, self).save(force_insert=force_insert,
+                                               force_update=force_update, using=using)
+        self._remember_saved()
+
+    def _save_dirty_fields(self, using):
+        """UPDATE the changed columns. Returns False if the row is missing."""
+        cls = self.__class__
+        signals.pre_save.send(sender=cls, instance=self, raw=False, using=using)
+        dirty = set(self.get_dirty_fields())
+        if dirty:
+            values = {}
+            for f in self._meta.local_fields:
+                auto_now = getattr(f, "auto_now", False)
+                if f.name in dirty or auto_now:
+                    values[f.name] = f.pre_save(self, False)
+            if not cls._base_manager.using(using).filter(pk=self.pk).update(**values):
+                return False
+        signals.post_save.send(sender=cls, instance=self, created=False, raw=False, using=using)
+        return True
+
+
+@contextmanager
+def _commit_on_success(using):
+    """
+    commit_on_success(using), or join the transaction if one is managed already.
+
+    Nested commit_on_success blocks commit when they exit, which would commit
+    the caller's transaction early, e.g. under TransactionMiddleware.
+    """
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+
+class CartBatch(object):
+    """Writes and state signals put off by HiiCartBase.batch()."""
+
+    def __init__(self):
+        self.save_pending = False
+        self.flushing = False
+        self._signals = []
+
+    def queue_signal(self, signal, sender, name, instance, old_state, new_state):
+        """Collect a state change, merging it with earlier ones for the instance."""
+        for entry in self._signals:
+            if entry[0] is signal and entry[3] is instance:
+                entry[5] = new_state
+                return
+        self._signals.append([signal, sender, name, instance, old_state, new_state])
+
+    def send_signals(self):
+        """Send each instance's net state change, if it has one."""
+        for signal, sender, name, instance, old_state, new_state in self._signals:
+            if old_state != new_state:
+                signal.send(sender=sender, old_state=old_state, new_state=new_state,
+                            **{name: instance})
+        self._signals = []
+
+
+def _send_state_changed(cart, signal, sender, name, instance, old_state, new_state):
+    """Send a state signal now, or after the batch if cart is in one."""
+    batch = getattr(cart, "_batch", None)
+    if batch is not None:
+        batch.queue_signal(signal, sender, name, instance, old_state, new_state)
+    else:
+        signal.send(sender=sender, old_state=old_state, new_state=new_state,
+                    **{name: instance})
+
+
+def _remove_from_index(sender, instance, **kwargs):
+    """Remove a deleted cart from CartIndex, however it was deleted."""
+    content_type = ContentType.objects.get_for_model(sender)
+    CartIndex.objects.filter(content_type=content_type, object_id=instance.pk).delete()
+    _forget_cart_location(instance._cart_uuid)
+
+
 class HiiCartMetaclass(models.base.ModelBase):
     def __new__(cls, name, bases, attrs):
         try:
@@ -95,11 +332,14 @@ class HiiCartMetaclass(models.base.ModelBase):
         new_class = super(HiiCartMetaclass, cls).__new__(cls, name, bases, attrs)
         if parents:
             CART_TYPES.append(new_class)
+            # Queryset and cascade deletes skip delete(), but not post_delete
+            if not new_class._meta.abstract:
+                signals.post_delete.connect(_remove_from_index, sender=new_class)
 
         return new_class
 
 
-class HiiCartBase(models.Model):
+class HiiCartBase(DirtyFieldsMixin, models.Model):
     """
     Collects information about an order and tracks its state.
 
@@ -109,7 +349,7 @@ class HiiCartBase(models.Model):
     __metaclass__ = HiiCartMetaclass
 
     _cart_state = models.CharField(choices=HIICART_STATES, max_length=16, default="OPEN", db_index=True)
-    _cart_uuid = models.CharField(max_length=36, db_index=True)
+    _cart_uuid = CartUUIDField(db_index=True)
     gateway = models.CharField(max_length=16, null=True, blank=True)
     notes = generic.GenericRelation("Note")
     # Redirection targets after purchase completes
@@ -129,7 +369,7 @@ class HiiCartBase(models.Model):
     # Customer Info
     ship_first_name = models.CharField("First name", max_length=255, default="")
     ship_last_name = models.CharField("Last name", max_length=255, default="")
-    ship_email = models.EmailField("Email", max_length=255, default="")
+    ship_email = models.EmailField("Email", max_length=255, default="", db_index=True)
     ship_phone = models.CharField("Phone Number", max_length=30, default="")
     ship_street1 = models.CharField("Street", max_length=80, default="")
     ship_street2 = models.CharField("Street 2", max_length=80, default="")
@@ -139,7 +379,7 @@ class HiiCartBase(models.Model):
     ship_country = models.CharField("Country", max_length=2, default="")
     bill_first_name = models.CharField("First name", max_length=255, default="")
     bill_last_name = models.CharField("Last name", max_length=255, default="")
-    bill_email = models.EmailField("Email", max_length=255, default="")
+    bill_email = models.EmailField("Email", max_length=255, default="", db_index=True)
     bill_phone = models.CharField("Phone Number", max_length=30, default="")
     bill_street1 = models.CharField("Street", max_length=80, default="")
     bill_street2 = models.CharField("Street", max_length=80, default="")
@@ -149,9 +389,15 @@ class HiiCartBase(models.Model):
     bill_country = models.CharField("Country", max_length=2, default="")
     thankyou = models.CharField("Thank you message.", max_length=255, blank=True, null=True, default=None)
     fulfilled = models.BooleanField(default=False)
-    custom_id = models.CharField(max_length=255, blank=True, null=True, default=None)
+    custom_id = models.CharField(max_length=255, blank=True, null=True, default=None, db_index=True)
     created = models.DateTimeField("Created", auto_now_add=True)
     last_updated = models.DateTimeField("Last Updated", auto_now=True)
+    # Payment totals, maintained by PaymentBase.save. See PAYMENT_TOTAL_FIELDS.
+    paid_total = models.DecimalField("Total Paid", max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    refund_total = models.DecimalField("Total Refunded", max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    last_paid_at = models.DateTimeField("Last Paid", blank=True, null=True)
+
+    objects = HiiCartManager()
 
     class Meta:
         abstract = True
@@ -160,7 +406,12 @@ class HiiCartBase(models.Model):
         """Override in order to keep track of changes to state."""
         super(HiiCartBase, self).__init__(*args, **kwargs)
         self._old_state = self.state
+        self._old_uuid = self._cart_uuid
         self.hiicart_settings = hiicart_settings
+        self._lineitem_cache = None
+        self._sku_cache = None
+        self._totals_stale = False
+        self._batch = None
 
     def __unicode__(self):
         if self.id:
@@ -196,9 +447,62 @@ class HiiCartBase(models.Model):
     def one_time_lineitems(self):
         return self._get_lineitems(self.one_time_lineitem_types)
 
+    @property
+    def lineitems_by_sku(self):
+        """All lineitems keyed by sku. Cached along with the lineitems."""
+        return self._get_sku_index("all", self.lineitem_types)
+
+    @property
+    def recurring_lineitems_by_sku(self):
+        """Recurring lineitems keyed by sku. Cached along with the lineitems."""
+        return self._get_sku_index("recurring", self.recurring_lineitem_types)
+
     def _get_lineitems(self, cls_list):
-        l = [cls.objects.filter(cart=self) for cls in cls_list]
-        return [item for sublist in l for item in sublist]
+        return [item for item in self._load_lineitems() if type(item) in cls_list]
+
+    def _get_sku_index(self, key, cls_list):
+        if self._sku_cache is None:
+            self._sku_cache = {}
+        if key not in self._sku_cache:
+            self._sku_cache[key] = dict([(li.sku, li) for li in self._get_lineitems(cls_list)])
+        return self._sku_cache[key]
+
+    def _load_lineitems(self):
+        """
+        Load lineitems of every registered type once per cart instance.
+
+        The cart is attached to each loaded item so item.cart doesn't need
+        another query. Unsaved carts can't have lineitems and aren't cached.
+        """
+        if self._lineitem_cache is not None:
+            return self._lineitem_cache
+        if self.pk is None:
+            return []
+        items = load_lineitems(self.lineitem_types, [self.pk])
+        for item in items:
+            setattr(item, item._meta.get_field("cart").get_cache_name(), self)
+        self._lineitem_cache = items
+        return items
+
+    def _lineitem_changed(self, item, deleted=False):
+        """
+        Keep the lineitem cache coherent after a lineitem is saved or deleted.
+
+        Saving an item that is already in the cache keeps the cache, since
+        the cached instance is the one that changed. Anything else (new items,
+        items loaded elsewhere, deletes) drops the cache.
+        """
+        self._sku_cache = None
+        self._totals_stale = True
+        if self._lineitem_cache is None:
+            return
+        if deleted or not any([li is item for li in self._lineitem_cache]):
+            self.refresh_lineitems()
+
+    def refresh_lineitems(self):
+        """Drop cached lineitems so they're reloaded on next access."""
+        self._lineitem_cache = None
+        self._sku_cache = None
 
     def _is_valid_transition(self, old, new):
         """
@@ -216,6 +520,19 @@ class HiiCartBase(models.Model):
         """Recalculate totals"""
         self._sub_total = self.sub_total
         self._total = self.total
+        self._totals_stale = False
+
+    def _needs_recalc(self):
+        """
+        Whether totals may be out of date.
+
+        True for new carts, after a lineitem was saved or deleted through
+        this cart, or when CART_TOTAL_FIELDS changed. Also true whenever
+        lineitems are loaded, since recalculating is free then.
+        """
+        if self.pk is None or self._totals_stale or self._lineitem_cache is not None:
+            return True
+        return bool(set(CART_TOTAL_FIELDS) & set(self.get_dirty_fields()))
 
     @property
     def cart_uuid(self):
@@ -256,6 +573,7 @@ class HiiCartBase(models.Model):
             if p.created > newpmnt:
                 p.created = newpmnt
                 p.save()
+        self._refresh_payment_totals()
 
     def cancel_if_expired(self, grace_period=None):
         """Mark this cart as cancelled if recurring lineitems have expired."""
@@ -297,6 +615,10 @@ class HiiCartBase(models.Model):
         # This method only works when id and pk have been cleared
         dupe.pk = None
         dupe.id = None
+        dupe._batch = None
+        dupe.refresh_lineitems()
+        dupe.paid_total = dupe.refund_total = Decimal("0.00")
+        dupe.last_paid_at = None
         dupe.set_state("OPEN", validate=False)
         dupe.gateway = None
         # Clear out any gateway-specific actions that might've been taken
@@ -320,48 +642,150 @@ class HiiCartBase(models.Model):
         return self._get_gateway(self.gateway)
 
     def _get_gateway(self, name):
-        # importing now prevents circular import issues.
-        from hiicart.gateway.amazon.gateway import AmazonGateway
-        from hiicart.gateway.comp.gateway import CompGateway
-        from hiicart.gateway.google.gateway import GoogleGateway
-        from hiicart.gateway.paypal.gateway import PaypalGateway
-        from hiicart.gateway.paypal2.gateway import Paypal2Gateway
-        from hiicart.gateway.paypal_adaptive.gateway import PaypalAPGateway
-        from hiicart.gateway.paypal_express.gateway import PaypalExpressCheckoutGateway
-        from hiicart.gateway.braintree.gateway import BraintreeGateway
-        from hiicart.gateway.authorizenet.gateway import AuthorizeNetGateway
-
         """Factory to get payment gateways."""
-        gateways = {
-            'amazon': AmazonGateway,
-            'comp': CompGateway,
-            'google': GoogleGateway,
-            'paypal': PaypalGateway,
-            'paypal2': Paypal2Gateway,
-            'paypal_adaptive': PaypalAPGateway,
-            'paypal_express': PaypalExpressCheckoutGateway,
-            'braintree': BraintreeGateway,
-            'authorizenet': AuthorizeNetGateway
-            }
         try:
-            cls = gateways[name]
-            return cls(self)
+            cls = get_gateway_class(name)
         except KeyError:
             raise HiiCartError("Unknown gateway: %s" % name)
+        return cls(self)
+
+    def get_dirty_fields(self):
+        """
+        Override to leave out PAYMENT_TOTAL_FIELDS.
+
+        Payments update those with F() expressions, so the values this
+        instance holds may be stale and must never be written back.
+        """
+        return [name for name in super(HiiCartBase, self).get_dirty_fields()
+                if name not in PAYMENT_TOTAL_FIELDS]
+
+    def _refresh_payment_totals(self):
+        """Re-read the payment totals, which PaymentBase.save updates in the db."""
+        if self.pk is None:
+            return
+        rows = self.__class__._default_manager.filter(pk=self.pk).values(*PAYMENT_TOTAL_FIELDS)
+        for row in rows:
+            for name in PAYMENT_TOTAL_FIELDS:
+                setattr(self, name, row[name])
+        self._remember_saved(PAYMENT_TOTAL_FIELDS)
+
+    def _update_lineitem_expirations(self):
+        """Store the expiration of recurring lineitems after last_paid_at changed."""
+        for item in self.recurring_lineitems:
+            expires_at = item._calc_expiration(self.last_paid_at)
+            if item.expires_at != expires_at:
+                item.expires_at = expires_at
+                item.__class__._default_manager.filter(pk=item.pk).update(expires_at=expires_at)
+                item._remember_saved(["expires_at"])
 
     def save(self, *args, **kwargs):
         """Override to recalculate total and signal on state change."""
-        self._recalc()
+        if self._batch is not None and not self._batch.flushing and self.pk is not None:
+            self._batch.save_pending = True
+            return
+        if self._needs_recalc():
+            self._recalc()
+        # Don't overwrite totals a payment changed since this cart was
+        # loaded. Saving only dirty fields never writes them, but re-read
+        # them if they were changed here so the instance matches the row.
+        saved = getattr(self, "_saved_values", {})
+        if not self._saves_dirty_fields(kwargs.get("using")) \
+                or [name for name in PAYMENT_TOTAL_FIELDS
+                    if name in self.__dict__ and self.__dict__[name] != saved.get(name)]:
+            self._refresh_payment_totals()
         if not self._cart_uuid:
             self._cart_uuid = str(uuid.uuid4())
+        created = self.pk is None
         super(HiiCartBase, self).save(*args, **kwargs)
+        if created or self._cart_uuid != self._old_uuid:
+            self._update_index(created)
         # Signal sent after save in case someone queries database
         if self.state != self._old_state:
-            self.cart_state_changed.send(sender=self.__class__.__name__, cart=self,
-                                         old_state=self._old_state,
-                                         new_state=self.state)
+            _send_state_changed(self, self.cart_state_changed, self.__class__.__name__,
+                                "cart", self, self._old_state, self.state)
             self._old_state = self.state
 
+    @contextmanager
+    def batch(self, lock=True):
+        """
+        Coalesce the cart's writes and state signals, e.g. for one IPN.
+
+        Inside the block save() on this cart is put off, while
+        cart_state_changed and payment_state_changed for payments attached
+        to it are collected. On exit the cart is saved once, in the same
+        transaction as everything else written in the block, and each signal
+        is sent once after the commit with the net old and new states.
+        Nothing is sent if the block raises. Nested blocks join the outer one.
+        Inside a transaction managed elsewhere, e.g. by TransactionMiddleware,
+        the batch joins that transaction instead of committing, and the
+        signals are sent when the block exits.
+
+        With lock, the cart is locked with CART_LOCK_BACKEND (see
+        hiicart.locks) until the transaction ends, and re-read from the
+        database once locked. Unsaved changes made before the block are
+        applied on top of the fresh values and saved with the batch. Keep
+        slow work, like calls to the gateway, out of the block.
+        """
+        if self._batch is not None:
+            yield self
+            return
+        batch = self._batch = CartBatch()
+        using = router.db_for_write(self.__class__, instance=self)
+        backend = cart_lock() if lock and self.pk is not None else None
+        locked = False
+        try:
+            with _commit_on_success(using):
+                if backend is not None:
+                    backend.acquire(self, using)
+                    locked = True
+                    if self._reload(using):
+                        batch.save_pending = True
+                yield self
+                if batch.save_pending:
+                    batch.flushing = True
+                    self.save()
+        finally:
+            self._batch = None
+            if locked:
+                backend.release(self, using)
+        batch.send_signals()
+
+    def _reload(self, using=None):
+        """
+        Re-read the cart's fields from the database and drop cached lineitems.
+
+        Fields changed on this instance since it was loaded or saved keep
+        their new values, which stay dirty. Returns whether there were any.
+        """
+        dirty = self.get_dirty_fields()
+        changes = dict([(f.attname, self.__dict__[f.attname])
+                        for f in self._meta.local_fields if f.name in dirty])
+        fresh = self.__class__._default_manager.using(using).get(pk=self.pk)
+        for f in self._meta.local_fields:
+            if f.attname in fresh.__dict__:
+                setattr(self, f.attname, fresh.__dict__[f.attname])
+        self._remember_saved()
+        self._old_state = self.state
+        self._old_uuid = self._cart_uuid
+        self._totals_stale = False
+        self.refresh_lineitems()
+        for attname, value in changes.items():
+            setattr(self, attname, value)
+        return bool(changes)
+
+    def _update_index(self, created):
+        """Add the cart to CartIndex, or record its changed uuid."""
+        content_type = ContentType.objects.get_for_model(self)
+        if created:
+            CartIndex.objects.create(cart_uuid=self._cart_uuid,
+                                     content_type=content_type, object_id=self.pk)
+        else:
+            CartIndex.objects.filter(content_type=content_type, object_id=self.pk) \
+                             .update(cart_uuid=self._cart_uuid)
+            _forget_cart_location(self._old_uuid)
+        _forget_cart_location(self._cart_uuid)
+        self._old_uuid = self._cart_uuid
+
     def set_state(self, newstate, validate=True):
         """Set state of the cart, optionally not validating the transition."""
         if newstate == self.state:
@@ -389,10 +813,16 @@ class HiiCartBase(models.Model):
         Valid state transitions are listed in VALID_TRANSITIONS. This
         function contains the logic for when those various states are used.
         """
+        total_paid, total_refund = self._payment_totals()
+        newstate = self._next_state(total_paid, total_refund)
+        # Validate transition then save
+        if newstate and newstate != self.state and self._is_valid_transition(self.state, newstate):
+            self._cart_state = newstate
+            self.save()
+
+    def _next_state(self, total_paid, total_refund):
+        """State the cart should be in, given its payment totals, or None."""
         newstate = None
-        payments = self.payments.all()
-        total_paid = sum([p.amount for p in payments if p.state == "PAID"])
-        total_refund = abs(sum([p.amount for p in payments if p.state == "REFUND"]))
         # Subscriptions involve multiple payments, therefore diff may be < 0
         if self.total - total_paid <= 0:
             newstate = "COMPLETED"
@@ -402,21 +832,277 @@ class HiiCartBase(models.Model):
         elif total_refund > 0 and total_refund >= total_paid:
             newstate = "REFUND"
         # Account for recurring state changes
-        if any([li.is_active for li in self.recurring_lineitems]):
+        recurring = self.recurring_lineitems
+        if any([li.is_active for li in recurring]):
             newstate = "RECURRING"
-        elif len(self.recurring_lineitems) > 0:
+        elif len(recurring) > 0:
             # Paid and then cancelled, but not expired
-            if newstate == "COMPLETED" and not all([r.is_expired() for r in self.recurring_lineitems]):
+            if newstate == "COMPLETED" and not all([r.is_expired() for r in recurring]):
                 newstate = "PENDCANCEL"
             # Could be cancelled manually (is_active set to False)
             # Could be a re-subscription, but is now cancelled. Is not paid.
             # Could be expired
             elif newstate == "COMPLETED" or self.state == "RECURRING":
                 newstate = "CANCELLED"
-        # Validate transition then save
-        if newstate and newstate != self.state and self._is_valid_transition(self.state, newstate):
-            self._cart_state = newstate
-            self.save()
+        return newstate
+
+    def _payment_totals(self):
+        """Sum of PAID and (absolute) REFUND payments, read from the cart row."""
+        self._refresh_payment_totals()
+        return self.paid_total, abs(self.refund_total)
+
+
+# Cached UNION ALL statements for load_lineitems, keyed by (db, types)
+_UNION_PLANS = {}
+
+
+def _union_plan(cls_list, using):
+    """
+    Build the UNION ALL statement used to load several lineitem types.
+
+    Returns None if the types can't share a statement, e.g. when they use
+    multi-table inheritance or have same-named columns of different types.
+    """
+    key = (using, tuple(cls_list))
+    if key in _UNION_PLANS:
+        return _UNION_PLANS[key]
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    columns = []
+    column_types = {}
+    for cls in cls_list:
+        if cls._meta.parents:
+            _UNION_PLANS[key] = None
+            return None
+        for f in cls._meta.local_fields:
+            db_type = f.db_type(connection=connection)
+            if f.column not in column_types:
+                column_types[f.column] = db_type
+                columns.append(f.column)
+            elif column_types[f.column] != db_type:
+                _UNION_PLANS[key] = None
+                return None
+    selects = []
+    for i, cls in enumerate(cls_list):
+        own = set([f.column for f in cls._meta.local_fields])
+        cols = [qn(c) if c in own else "NULL" for c in columns]
+        selects.append("SELECT %i, %s FROM %s WHERE %s IN (%%s)" % (
+                       i, ", ".join(cols), qn(cls._meta.db_table),
+                       qn(cls._meta.get_field("cart").column)))
+    plan = (" UNION ALL ".join(selects), columns)
+    _UNION_PLANS[key] = plan
+    return plan
+
+
+def _sort_lineitems(items):
+    """
+    Sort lineitems of mixed types by Meta.ordering, as the ORM would.
+
+    OneTimeLineItemBase and RecurringLineItemBase declare their own Meta, so
+    the concrete types don't inherit LineItemBase's ordering; it's used
+    unless the type sets one.
+    """
+    if not items:
+        return items
+    ordering = items[0]._meta.ordering or LineItemBase._meta.ordering
+    for name in reversed(ordering):
+        reverse = name.startswith("-")
+        name = name.lstrip("-")
+        items.sort(key=lambda li: getattr(li, name, None), reverse=reverse)
+    return items
+
+
+def _to_python(field, value):
+    """Convert a raw column value, which may have lost its type in the UNION."""
+    if value is None:
+        return None
+    if isinstance(field, models.DecimalField):
+        if isinstance(value, float):
+            # repr() gives every digit needed to read back the same float;
+            # str() rounds to 12 significant digits
+            value = repr(value)
+        quantum = Decimal(10) ** -field.decimal_places
+        return field.to_python(value).quantize(quantum)
+    return field.to_python(value)
+
+
+def load_lineitems(cls_list, cart_ids):
+    """
+    Load lineitems of several types for one or more carts in a single query.
+
+    Each type's table is a branch of a UNION ALL, padded with NULLs for the
+    columns it doesn't have, and each row is turned back into an instance of
+    its own class. Falls back to one query per type if the types can't share
+    a statement. Results are sorted by Meta.ordering. Each branch binds
+    every cart id, so the ids are split into chunks that keep a statement
+    under UNION_MAX_PARAMS.
+    """
+    cls_list = list(cls_list)
+    cart_ids = list(cart_ids)
+    if not cls_list or not cart_ids:
+        return []
+    if len(cls_list) == 1:
+        return _sort_lineitems(list(cls_list[0].objects.filter(cart__in=cart_ids)))
+    using = router.db_for_read(cls_list[0])
+    plan = None
+    if all([router.db_for_read(cls) == using for cls in cls_list]):
+        plan = _union_plan(cls_list, using)
+    if plan is None:
+        items = []
+        for cls in cls_list:
+            items.extend(cls.objects.filter(cart__in=cart_ids))
+        return _sort_lineitems(items)
+    sql, columns = plan
+    size = max(1, UNION_MAX_PARAMS // len(cls_list))
+    rows = []
+    cursor = connections[using].cursor()
+    for start in range(0, len(cart_ids), size):
+        chunk = cart_ids[start:start + size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(sql % ((placeholders,) * len(cls_list)), chunk * len(cls_list))
+        rows.extend(cursor.fetchall())
+    fields = [dict([(f.column, f) for f in cls._meta.local_fields]) for cls in cls_list]
+    items = []
+    for row in rows:
+        index = row[0]
+        values = {}
+        for column, value in zip(columns, row[1:]):
+            f = fields[index].get(column)
+            if f is not None:
+                values[f.attname] = _to_python(f, value)
+        item = cls_list[index](**values)
+        item._state.db = using
+        item._state.adding = False
+        items.append(item)
+    items.sort(key=lambda li: (cls_list.index(type(li)), li.pk))
+    return _sort_lineitems(items)
+
+
+def prefetch_lineitems(carts):
+    """
+    Load lineitems for a batch of carts, returning the carts as a list.
+
+    Uses one lineitem query per cart class instead of several per cart, so
+    total, sub_total, recurring_lineitems and get_expiration() (which reads
+    the cart's last_paid_at) don't touch the database for the batch.
+    """
+    carts = list(carts)
+    by_class = {}
+    for cart in carts:
+        if cart.pk is not None:
+            by_class.setdefault(type(cart), {}).setdefault(cart.pk, []).append(cart)
+    for cls, by_id in by_class.items():
+        items = dict([(pk, []) for pk in by_id])
+        for item in load_lineitems(cls.lineitem_types, by_id.keys()):
+            items[item.cart_id].append(item)
+        for pk, batch in by_id.items():
+            for cart in batch:
+                cart._lineitem_cache = list(items[pk])
+                cart._sku_cache = None
+                for item in cart._lineitem_cache:
+                    setattr(item, item._meta.get_field("cart").get_cache_name(), cart)
+    return carts
+
+
+def _bulk_insert(model, objs):
+    """
+    Insert new objects without calling their save() overrides.
+
+    Uses bulk_create where available (django >= 1.4), otherwise one INSERT
+    per object. bulk_create doesn't set primary keys, so callers must look
+    them up afterwards.
+    """
+    if not objs:
+        return
+    if hasattr(QuerySet, "bulk_create"):
+        model._default_manager.bulk_create(objs)
+    else:
+        for obj in objs:
+            obj.save_base(force_insert=True)
+
+
+def bulk_clone(carts):
+    """
+    Clone carts in the OPEN state, like HiiCartBase.clone() but in bulk.
+
+    Lineitems are loaded with prefetch_lineitems(), totals are calculated in
+    memory, and carts and lineitems are inserted with bulk_create, one chunk
+    of PREFETCH_CHUNK_SIZE carts per transaction. cart_state_changed is sent
+    for each clone once its chunk is written. Returns the clones in order.
+    """
+    carts = list(carts)
+    clones = []
+    for start in range(0, len(carts), PREFETCH_CHUNK_SIZE):
+        chunk = prefetch_lineitems(carts[start:start + PREFETCH_CHUNK_SIZE])
+        clones.extend(_bulk_clone_chunk(chunk))
+    return clones
+
+
+def _bulk_clone_chunk(carts):
+    dupes = []
+    for cart in carts:
+        dupe = copy.copy(cart)
+        dupe.pk = None
+        dupe.id = None
+        dupe._batch = None
+        dupe.paid_total = dupe.refund_total = Decimal("0.00")
+        dupe.last_paid_at = None
+        dupe._cart_state = "OPEN"
+        dupe._cart_uuid = str(uuid.uuid4())
+        dupe.gateway = None
+        gateway = cart.get_gateway()
+        if gateway is not None:
+            gateway.sanitize_clone(dupe)
+        items = []
+        for item in cart.lineitems:
+            dupe_item = copy.copy(item)
+            dupe_item.pk = None
+            dupe_item.id = None
+            setattr(dupe_item, dupe_item._meta.get_field("cart").get_cache_name(), dupe)
+            if isinstance(dupe_item, RecurringLineItemBase):
+                dupe_item.expires_at = dupe_item._calc_expiration(None)
+            dupe_item._recalc()
+            items.append(dupe_item)
+        dupe._lineitem_cache = items
+        dupe._sku_cache = None
+        dupe._recalc()
+        dupes.append(dupe)
+    by_class = {}
+    for dupe in dupes:
+        by_class.setdefault(type(dupe), []).append(dupe)
+    for cls, batch in by_class.items():
+        using = router.db_for_write(cls)
+        with _commit_on_success(using):
+            _bulk_insert(cls, batch)
+            if any([d.pk is None for d in batch]):
+                rows = cls._default_manager.using(using).filter(
+                           _cart_uuid__in=[d._cart_uuid for d in batch]).values_list("_cart_uuid", "pk")
+                # values_list() returns uuids as stored, which may be binary
+                to_python = cls._meta.get_field("_cart_uuid").to_python
+                pks = dict([(to_python(cart_uuid), pk) for cart_uuid, pk in rows])
+                for dupe in batch:
+                    dupe.pk = dupe.id = pks[dupe._cart_uuid]
+            by_type = {}
+            for dupe in batch:
+                for item in dupe._lineitem_cache:
+                    item.cart_id = dupe.pk
+                    by_type.setdefault(type(item), []).append(item)
+            for item_cls, items in by_type.items():
+                _bulk_insert(item_cls, items)
+            content_type = ContentType.objects.get_for_model(cls)
+            _bulk_insert(CartIndex, [CartIndex(cart_uuid=d._cart_uuid, content_type=content_type,
+                                               object_id=d.pk) for d in batch])
+            for dupe in batch:
+                dupe._old_uuid = dupe._cart_uuid
+                dupe._remember_saved()
+                for item in dupe._lineitem_cache:
+                    item._remember_saved()
+    for dupe in dupes:
+        if dupe._old_state != "OPEN":
+            dupe.cart_state_changed.send(sender=dupe.__class__.__name__, cart=dupe,
+                                         old_state=dupe._old_state, new_state="OPEN")
+            dupe._old_state = "OPEN"
+    return dupes
 
 
 # Stop CASCADE ON DELETE with User, but keep compatibility with django < 1.3
@@ -433,7 +1119,7 @@ class HiiCart(HiiCartBase):
         user = models.ForeignKey(User, null=True, blank=True)
 
 
-class LineItemBase(models.Model):
+class LineItemBase(DirtyFieldsMixin, models.Model):
     """
     Abstract Base Class for a single line item in a purchase.
 
@@ -468,6 +1154,12 @@ class LineItemBase(models.Model):
         self._sub_total = self.sub_total
         self._total = self.total
 
+    def _notify_cart(self, deleted=False):
+        """Let an already loaded cart know this item changed."""
+        cart = getattr(self, self._meta.get_field("cart").get_cache_name(), None)
+        if cart is not None:
+            cart._lineitem_changed(self, deleted=deleted)
+
     def clone(self, newcart):
         """Clone this cart in the OPEN state."""
         dupe = copy.copy(self)
@@ -478,10 +1170,16 @@ class LineItemBase(models.Model):
         dupe.save()
         return dupe
 
+    def delete(self, *args, **kwargs):
+        """Override delete to invalidate the cart's lineitem cache."""
+        super(LineItemBase, self).delete(*args, **kwargs)
+        self._notify_cart(deleted=True)
+
     def save(self, *args, **kwargs):
         """Override save to recalc before saving."""
         self._recalc()
         super(LineItemBase, self).save(*args, **kwargs)
+        self._notify_cart()
 
     @property
     def sub_total(self):
@@ -517,6 +1215,27 @@ class LineItem(OneTimeLineItemBase):
     cart = models.ForeignKey(HiiCart, verbose_name="Cart")
 
 
+class RecurringLineItemQuerySet(QuerySet):
+    def due(self, before=None):
+        """
+        Items that expire before the given date (default now).
+
+        Items without an expires_at have never been paid for or scheduled,
+        which get_expiration() treats as already expired, so they're included.
+        """
+        if before is None:
+            before = datetime.now()
+        return self.filter(Q(expires_at__lt=before) | Q(expires_at__isnull=True))
+
+
+class RecurringLineItemManager(models.Manager):
+    def get_query_set(self):
+        return RecurringLineItemQuerySet(self.model, using=self._db)
+
+    def due(self, before=None):
+        return self.get_query_set().due(before)
+
+
 class RecurringLineItemBase(LineItemBase):
     """Base class for line items that recur, for external apps to inherit from"""
 
@@ -532,6 +1251,11 @@ class RecurringLineItemBase(LineItemBase):
     trial_price = models.DecimalField("Trial Price", default=Decimal("0.00"), max_digits=18, decimal_places=2)
     trial_length = models.PositiveIntegerField("Trial length", default=0)
     trial_times = models.PositiveIntegerField("Trial Times", help_text="Number of trial cycles", default=1)
+    # Stored copy of get_expiration() so due items can be found with an index.
+    # Null until the item has a payment or a recurring_start.
+    expires_at = models.DateTimeField("Expires At", null=True, blank=True, db_index=True)
+
+    objects = RecurringLineItemManager()
 
     class Meta:
         abstract = True
@@ -539,6 +1263,7 @@ class RecurringLineItemBase(LineItemBase):
     def __init__(self, *args, **kwargs):
         self.hiicart_settings = hiicart_settings
         super(RecurringLineItemBase, self).__init__(*args, **kwargs)
+        self._old_schedule = self._schedule()
 
     @property
     def sub_total(self):
@@ -550,24 +1275,36 @@ class RecurringLineItemBase(LineItemBase):
         """Total, calculated as sub_total - discount + shipping."""
         return self.sub_total - self.discount + self.recurring_shipping
 
-    def get_expiration(self):
-        """Expiration/next billing date for item."""
+    def _schedule(self):
+        return (self.duration, self.duration_unit, self.recurring_start)
+
+    def _calc_expiration(self, last_payment):
+        """Expiration after last_payment, or None if the item hasn't started."""
+        if self.duration is None:
+            return None
         delta = None
         if self.duration_unit == "DAY":
             delta = relativedelta(days=self.duration)
         elif self.duration_unit == "MONTH":
             delta = relativedelta(months=self.duration)
-        payments = self.cart.payments.filter(
-                state="PAID", amount__gt=0).order_by("-created")
-        if not payments:
+        if last_payment is None:
             if self.recurring_start:
                 last_payment = self.recurring_start - delta
             else:
-                return datetime.min
-        else:
-            last_payment = payments[0].created
+                return None
         return last_payment + delta
 
+    def get_expiration(self):
+        """Expiration/next billing date for item."""
+        return self._calc_expiration(self.cart.last_paid_at) or datetime.min
+
+    def save(self, *args, **kwargs):
+        """Override save to store expires_at when the billing schedule changes."""
+        if self.pk is None or self._schedule() != self._old_schedule:
+            self.expires_at = self._calc_expiration(self.cart.last_paid_at)
+        super(RecurringLineItemBase, self).save(*args, **kwargs)
+        self._old_schedule = self._schedule()
+
     def is_expired(self, grace_period=None):
         """Get subscription expiration based on last payment optionally providing a grace period."""
         if grace_period:
@@ -587,6 +1324,11 @@ class RecurringLineItem(RecurringLineItemBase):
     cart = models.ForeignKey(HiiCart, verbose_name="Cart")
 
 
+def _remove_from_totals(sender, instance, **kwargs):
+    """Take a deleted payment out of its cart's totals, however it was deleted."""
+    instance._update_cart_totals(False, deleted=True)
+
+
 class PaymentMetaclass(models.base.ModelBase):
     def __new__(cls, name, bases, attrs):
         try:
@@ -597,10 +1339,13 @@ class PaymentMetaclass(models.base.ModelBase):
             # This is PaymentBase
             parents = False
         new_class = super(PaymentMetaclass, cls).__new__(cls, name, bases, attrs)
+        if parents and not new_class._meta.abstract:
+            PAYMENT_TYPES.append(new_class)
+            signals.post_delete.connect(_remove_from_totals, sender=new_class)
         return new_class
 
 
-class PaymentBase(models.Model):
+class PaymentBase(DirtyFieldsMixin, models.Model):
     __metaclass__ = PaymentMetaclass
 
     amount = models.DecimalField("amount", max_digits=18, decimal_places=2)
@@ -610,6 +1355,9 @@ class PaymentBase(models.Model):
     created = models.DateTimeField("Created", auto_now_add=True)
     last_updated = models.DateTimeField("Last Updated", auto_now=True)
     transaction_id = models.CharField("Transaction ID", max_length=45, db_index=True, blank=True, null=True)
+    # "GATEWAY:transaction_id" for payments created by upsert_by_transaction,
+    # so two notifications can't both create a payment for one transaction
+    transaction_key = models.CharField(max_length=71, unique=True, blank=True, null=True, editable=False)
 
     class Meta:
         abstract = True
@@ -620,6 +1368,8 @@ class PaymentBase(models.Model):
         """Override in order to keep track of changes to state."""
         super(PaymentBase, self).__init__(*args, **kwargs)
         self._old_state = self.state
+        self._old_amount = self.amount
+        self._old_created = self.created
 
     def __unicode__(self):
         if self.id is not None:
@@ -628,14 +1378,123 @@ class PaymentBase(models.Model):
         else:
             return u"(unsaved) $%s %s" % (self.amount, self.state)
 
+    @classmethod
+    def upsert_by_transaction(cls, cart, gateway, transaction_id, amount, state, update_states=None):
+        """
+        Create or update the payment for a gateway transaction.
+
+        Looks up cart's first non-refund payment for (gateway, transaction_id)
+        and moves it to state. Its amount is kept; amount is only used for a
+        new payment. If update_states is given, the first payment in one of
+        those states is preferred, e.g. the pending one among several
+        charges, and a payment in any other state is left alone. Without a
+        payment one is created for cart. Both go through save(), so cart
+        totals and payment_state_changed are handled as usual.
+
+        Returns (payment, created, changed): whether the payment was created,
+        and whether it was created or its state changed.
+        """
+        gateway = gateway.upper()
+        payments = cls._default_manager.filter(cart=cart, gateway=gateway,
+                                               transaction_id=transaction_id) \
+                                       .exclude(state="REFUND").order_by("pk")
+        existing = []
+        if update_states:
+            existing = list(payments.filter(state__in=update_states)[:1])
+        existing = existing or list(payments[:1])
+        key = "%s:%s" % (gateway, transaction_id)
+        using = router.db_for_write(cls)
+        while not existing:
+            payment = cls(cart=cart, gateway=gateway, transaction_id=transaction_id,
+                          transaction_key=key, amount=amount, state=state)
+            sid = transaction.savepoint(using=using)
+            try:
+                payment.save(force_insert=True)
+            except IntegrityError:
+                # Another notification for the transaction got there first
+                transaction.savepoint_rollback(sid, using=using)
+                existing = list(payments.filter(transaction_key=key))
+                if not existing:
+                    # The key is held by the transaction's refund, which is
+                    # never updated here; free it for the new payment
+                    if not cls._default_manager.filter(cart=cart, transaction_key=key,
+                                                       state="REFUND") \
+                                               .update(transaction_key=None):
+                        raise
+            else:
+                transaction.savepoint_commit(sid, using=using)
+                return payment, True, True
+        payment = existing[0]
+        # Lets save() find the cart, e.g. to see that it's in a batch()
+        setattr(payment, cls._meta.get_field("cart").get_cache_name(), cart)
+        if update_states is not None and payment.state not in update_states:
+            return payment, False, False
+        if payment.state == state:
+            return payment, False, False
+        payment.state = state
+        payment.save()
+        return payment, False, True
+
+    def _update_cart_totals(self, created, deleted=False):
+        """
+        Apply this payment's change to the cart's PAYMENT_TOTAL_FIELDS.
+
+        Totals are adjusted with F() expressions so concurrent payments don't
+        lose updates. last_paid_at only moves forward, unless the latest
+        payment changed or was deleted, in which case it's recalculated.
+        """
+        def amount_if(state, payment_state, amount):
+            if payment_state != state or amount is None:
+                return Decimal("0.00")
+            return Decimal(str(amount))
+        old_state = None if created else self._old_state
+        # A deleted payment counts as if it had no state
+        state = None if deleted else self.state
+        paid = amount_if("PAID", state, self.amount) - amount_if("PAID", old_state, self._old_amount)
+        refund = amount_if("REFUND", state, self.amount) - amount_if("REFUND", old_state, self._old_amount)
+        carts = self._meta.get_field("cart").rel.to._default_manager.filter(pk=self.cart_id)
+        updates = {}
+        if paid:
+            updates["paid_total"] = F("paid_total") + paid
+        if refund:
+            updates["refund_total"] = F("refund_total") + refund
+        if updates:
+            carts.update(**updates)
+        was_last = amount_if("PAID", old_state, self._old_amount) > 0
+        is_last = amount_if("PAID", state, self.amount) > 0
+        last_paid_changed = False
+        if was_last and (not is_last or self.created != self._old_created):
+            last = self.__class__._default_manager.filter(
+                    cart=self.cart_id, state="PAID", amount__gt=0).aggregate(last=Max("created"))
+            # No rows if the cart was deleted too, e.g. by a cascade
+            last_paid_changed = bool(carts.update(last_paid_at=last["last"]))
+        elif is_last:
+            last_paid_changed = bool(
+                carts.filter(Q(last_paid_at__isnull=True) | Q(last_paid_at__lt=self.created)) \
+                     .update(last_paid_at=self.created))
+        self._old_amount = self.amount
+        self._old_created = self.created
+        cart = getattr(self, self._meta.get_field("cart").get_cache_name(), None)
+        if cart is not None:
+            cart._refresh_payment_totals()
+        if last_paid_changed:
+            if cart is None:
+                cart = self.cart
+            cart._update_lineitem_expirations()
+
     def save(self, *args, **kwargs):
+        created = self.pk is None
+        # Upper case, so find_payment() can match gateways exactly
+        if self.gateway:
+            self.gateway = self.gateway.upper()
         super(PaymentBase, self).save(*args, **kwargs)
+        self._update_cart_totals(created)
         log.warn('Payment saved %s => %s for payment_id: %s' % (self._old_state, self.state, self.id))
         # Signal sent after save in case someone queries database
         if self.state != self._old_state:
-            self.payment_state_changed.send(sender=self.__class__.__name__, payment=self,
-                                            old_state=self._old_state,
-                                            new_state=self.state)
+            cart = getattr(self, self._meta.get_field("cart").get_cache_name(), None)
+            _send_state_changed(cart, self.payment_state_changed, self.__class__.__name__,
+                                "payment", self, self._old_state, self.state)
             self._old_state = self.state
 
 
@@ -660,3 +1519,265 @@ class PaymentResponse(models.Model):
     cart = models.ForeignKey(HiiCart, related_name="payment_results")
     response_code = models.PositiveIntegerField()
     response_text = models.TextField()
+
+
+class CartIndex(models.Model):
+    """
+    Which cart type and id a cart uuid belongs to, for all cart types.
+
+    Lets find_cart() load a cart with one indexed query rather than trying
+    each of CART_TYPES. Maintained by HiiCartBase.save(), and by a
+    post_delete handler for each cart type.
+    """
+    cart_uuid = CartUUIDField(db_index=True)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (("content_type", "object_id"),)
+
+
+class IPNInbox(models.Model):
+    """
+    A gateway notification stored to be verified and handled later.
+
+    Written by IPN views when IPN_DEFERRED is set; see hiicart.inbox.
+    """
+    gateway = models.CharField(max_length=32, db_index=True)
+    # Dotted path of the view that handles it
+    handler = models.CharField(max_length=255)
+    path = models.CharField(max_length=255)
+    # JSON dict of the request's CGI variables and HTTP_* headers
+    headers = models.TextField()
+    # Raw request body, decoded as latin-1 so any bytes survive
+    body = models.TextField(blank=True)
+    received = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=16, choices=IPN_STATES,
+                              default="PENDING", db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # Not tried again before this, after an error
+    available_at = models.DateTimeField(null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # The worker processing it; see hiicart.inbox.Worker
+    claimed_by = models.CharField(max_length=64, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # The cart's uuid, or another id shared by all its notifications, and a
+    # hash of it used to split notifications between workers
+    partition_key = models.CharField(max_length=64, blank=True, db_index=True)
+    bucket = models.PositiveIntegerField(default=0, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "IPN inbox"
+
+    def __unicode__(self):
+        return u"%s IPN #%s (%s)" % (self.gateway, self.pk, self.status)
+
+    @property
+    def raw_body(self):
+        return self.body.encode("latin-1")
+
+
+class NotificationKey(models.Model):
+    """
+    A gateway notification that has been, or is being, handled.
+
+    Lets hiicart.idempotency handle each notification once, however many
+    times the gateway delivers it.
+    """
+    gateway = models.CharField(max_length=32)
+    key = models.CharField(max_length=128)
+    status = models.CharField(max_length=16, default="RUNNING",
+                              choices=(("RUNNING", "Running"), ("DONE", "Done")))
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+    # The response sent for it, sent again for duplicates
+    response_status = models.PositiveIntegerField(null=True, blank=True)
+    response_headers = models.TextField(blank=True)
+    response_body = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = (("gateway", "key"),)
+
+    def __unicode__(self):
+        return u"%s notification %s (%s)" % (self.gateway, self.key, self.status)
+
+
+def _cart_location_cache():
+    """The cache for find_cart(), if CART_INDEX_CACHE names one."""
+    if hiicart_settings["CART_INDEX_CACHE"]:
+        from django.core.cache import get_cache
+        return get_cache(hiicart_settings["CART_INDEX_CACHE"])
+    return None
+
+
+def _cache_key(cart_uuid):
+    return "hiicart.cart_index.%s" % cart_uuid
+
+
+def _forget_cart_location(cart_uuid):
+    cache = _cart_location_cache()
+    if cache is not None and cart_uuid:
+        cache.delete(_cache_key(cart_uuid))
+
+
+def find_cart(cart_uuid):
+    """
+    Get the cart with the given uuid, of any cart type, or None.
+
+    Looks the uuid up in CartIndex, or in the CART_INDEX_CACHE cache when
+    that's set, then loads the cart by primary key. If the index is stale,
+    e.g. rows written outside the ORM, the stale row is dropped and each of
+    CART_TYPES is tried instead.
+    """
+    cache = _cart_location_cache()
+    location = None
+    if cache is not None:
+        location = cache.get(_cache_key(cart_uuid))
+    if location is None:
+        try:
+            index = CartIndex.objects.get(cart_uuid=cart_uuid)
+        except CartIndex.DoesNotExist:
+            return _scan_for_cart(cart_uuid)
+        except ValueError:
+            # Not a uuid, with binary UUID_STORAGE
+            return None
+        location = (index.content_type_id, index.object_id)
+        if cache is not None:
+            cache.set(_cache_key(cart_uuid), location)
+    content_type_id, pk = location
+    cls = ContentType.objects.get_for_id(content_type_id).model_class()
+    try:
+        cart = cls._default_manager.get(pk=pk)
+    except cls.DoesNotExist:
+        cart = None
+    if cart is not None and cart._cart_uuid == cart_uuid:
+        return cart
+    # The row points at a deleted cart, or one since given another uuid
+    CartIndex.objects.filter(cart_uuid=cart_uuid, content_type=content_type_id,
+                             object_id=pk).delete()
+    _forget_cart_location(cart_uuid)
+    return _scan_for_cart(cart_uuid)
+
+
+def _scan_for_cart(cart_uuid):
+    """Find a cart missing from CartIndex by trying each cart type, and index it."""
+    for cls in CART_TYPES:
+        if cls._meta.abstract:
+            continue
+        try:
+            cart = cls._default_manager.get(_cart_uuid=cart_uuid)
+        except (cls.DoesNotExist, ValueError):
+            continue
+        content_type = ContentType.objects.get_for_model(cart)
+        if not CartIndex.objects.filter(content_type=content_type, object_id=cart.pk) \
+                                .update(cart_uuid=cart_uuid):
+            CartIndex.objects.create(cart_uuid=cart_uuid, content_type=content_type,
+                                     object_id=cart.pk)
+        return cart
+    return None
+
+
+def find_payment(gateway, transaction_id):
+    """
+    Get the first payment, of any payment type, for a gateway's transaction id, or None.
+
+    The payment's cart is loaded by the same query, which uses the
+    (gateway, transaction_id) index. Gateways are stored in upper case by
+    PaymentBase.save and matched exactly; payment tables of other apps need
+    existing gateways upper-cased, as migration 0028 does for Payment.
+
+    Duplicate checks built on this are per gateway: the same transaction id
+    from two gateways is two payments.
+    """
+    if not transaction_id:
+        return None
+    for cls in PAYMENT_TYPES:
+        payments = list(cls._default_manager.select_related("cart")
+                                            .filter(gateway=gateway.upper(),
+                                                    transaction_id=transaction_id)
+                                            .order_by("pk")[:1])
+        if payments:
+            return payments[0]
+    return None
+
+
+class CartSearch(object):
+    """
+    Carts of every cart type matching a search_carts() lookup, newest first.
+
+    Supports count() and slicing, so it can be handed to django's Paginator.
+    A slice reads just the ids and creation dates it needs from each cart
+    type's table, merges them, and then loads the carts on the page with one
+    query per type.
+    """
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = sum([qs.count() for qs in self.querysets])
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            result = self[k:k + 1]
+            if not result:
+                raise IndexError("CartSearch index out of range")
+            return result[0]
+        if k.step is not None or (k.start or 0) < 0 or (k.stop is not None and k.stop < 0):
+            raise ValueError("CartSearch only supports positive slices without a step")
+        rows = []
+        for qs in self.querysets:
+            ids = qs.order_by("-created", "-pk").values_list("created", "pk")
+            if k.stop is not None:
+                ids = ids[:k.stop]
+            rows.extend([(created, qs.model, pk) for created, pk in ids])
+        rows.sort(key=lambda row: (row[0], row[2]), reverse=True)
+        rows = rows[k.start:k.stop]
+        by_class = {}
+        for created, cls, pk in rows:
+            by_class.setdefault(cls, []).append(pk)
+        carts = {}
+        for cls, ids in by_class.items():
+            for pk, cart in cls._default_manager.in_bulk(ids).items():
+                carts[(cls, pk)] = cart
+        return [carts[(cls, pk)] for created, cls, pk in rows if (cls, pk) in carts]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def search_carts(email=None, custom_id=None, transaction_id=None):
+    """
+    Find carts of every cart type by customer details.
+
+    email matches bill_email or ship_email, and transaction_id matches the
+    transaction_id of any of a cart's payments. Every lookup uses an index.
+    When several are given, carts must match all of them. Returns a
+    CartSearch, e.g. to page through with Paginator(search_carts(...), 50).
+    """
+    if not (email or custom_id or transaction_id):
+        raise ValueError("search_carts needs an email, custom_id or transaction_id")
+    querysets = []
+    for cls in CART_TYPES:
+        if cls._meta.abstract:
+            continue
+        if transaction_id and getattr(cls, "payment_class", None) is None:
+            # No payments, so no carts of this type can match
+            continue
+        qs = cls._default_manager.all()
+        if email:
+            qs = qs.filter(Q(bill_email=email) | Q(ship_email=email))
+        if custom_id:
+            qs = qs.filter(custom_id=custom_id)
+        if transaction_id:
+            payments = cls.payment_class._default_manager.filter(transaction_id=transaction_id)
+            qs = qs.filter(pk__in=payments.values("cart"))
+        querysets.append(qs)
+    return CartSearch(querysets)
@@ -0,0 +1,158 @@
+"""
+Charge recurring carts in parallel.
+
+RecurringChargeScheduler runs HiiCartBase.charge_recurring() for batches of
+carts on a bounded pool of threads. Carts are grouped by gateway and each
+gateway has its own concurrency limit, so a slow gateway can't use up every
+worker and one gateway's rate limits aren't exceeded. A failing cart is
+logged and reported; it never stops the rest of the batch.
+
+Carts are selected and charged with the same grace period, the one the
+gateways' charge_recurring() would use: the scheduler's, or else
+CHARGE_RECURRING_GRACE_PERIOD, or else EXPIRATION_GRACE_PERIOD as in
+is_expired(). Without any, is_expired() never finds an item expired, so no
+cart is due. Carts of gateways that bill subscriptions themselves, like
+PayPal and Google Checkout, are never due. A cart still due after
+charge_recurring() is reported as skipped.
+
+Runs are restartable because the carts come from HiiCart.objects.charge_due():
+a cart that was charged gets a new expires_at and drops out of the selection.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from datetime import datetime
+from django.db import connections
+
+from hiicart.gateway.registry import get_gateway_class
+from hiicart.settings import SETTINGS as hiicart_settings
+
+log = logging.getLogger("hiicart.recurring")
+
+
+class ChargeResult(object):
+    """Outcome of charging one cart."""
+
+    def __init__(self, cart, seconds, error=None, skipped=False):
+        self.cart = cart
+        self.seconds = seconds
+        self.error = error
+        # charge_recurring() ran without error, but the cart is still due
+        self.skipped = skipped
+
+    def __unicode__(self):
+        if self.error is not None:
+            outcome = u" FAILED: %s" % self.error
+        elif self.skipped:
+            outcome = u" SKIPPED: still due"
+        else:
+            outcome = u""
+        return u"%s #%s %s %.3fs%s" % (self.cart.__class__.__name__, self.cart.pk,
+                                       self.cart.gateway, self.seconds, outcome)
+
+    @property
+    def ok(self):
+        return self.error is None and not self.skipped
+
+
+class RecurringChargeScheduler(object):
+    """
+    Charge recurring carts with at most `workers` running at once.
+
+    gateway_limits maps gateway names to the most carts charged at once with
+    that gateway. Gateways not listed can use every worker. With workers=1
+    carts are charged in the calling thread.
+
+    grace_period defaults to CHARGE_RECURRING_GRACE_PERIOD, then
+    EXPIRATION_GRACE_PERIOD, as in the gateways' charge_recurring().
+    """
+
+    def __init__(self, workers=8, gateway_limits=None, grace_period=None):
+        self.workers = max(workers, 1)
+        self.gateway_limits = gateway_limits or {}
+        self.grace_period = (grace_period or hiicart_settings["CHARGE_RECURRING_GRACE_PERIOD"]
+                             or hiicart_settings["EXPIRATION_GRACE_PERIOD"])
+        # gateway name -> whether its charge_recurring() charges anything
+        self._charging = {}
+
+    def _charges_recurring(self, gateway):
+        if gateway not in self._charging:
+            try:
+                cls = get_gateway_class(gateway)
+            except KeyError:
+                cls = None
+            self._charging[gateway] = getattr(cls, "charges_recurring", False)
+        return self._charging[gateway]
+
+    def _due(self, cart_class):
+        """Carts of cart_class that charge_recurring() would charge."""
+        manager = cart_class._default_manager
+        if not self.grace_period:
+            # is_expired() never finds an item expired without a grace period
+            return manager.charge_due().filter(pk__in=[])
+        due = manager.charge_due(datetime.now() - self.grace_period)
+        gateways = due.order_by().values_list("gateway", flat=True).distinct()
+        return due.filter(gateway__in=[g for g in gateways if self._charges_recurring(g)])
+
+    def due_carts(self, cart_class, after_id=0):
+        """Carts of cart_class due to be charged, in id order, after after_id."""
+        return self._due(cart_class).filter(pk__gt=after_id).order_by("pk").prefetch_lineitems()
+
+    def charge(self, carts):
+        """Charge carts. Returns a ChargeResult for each, in no particular order."""
+        if self.workers == 1:
+            return [self._charge(cart) for cart in carts]
+        groups = {}
+        for cart in carts:
+            groups.setdefault(cart.gateway, []).append(cart)
+        results = []
+        slots = threading.BoundedSemaphore(self.workers)
+        threads = []
+        for gateway, group in groups.items():
+            jobs = Queue.Queue()
+            for cart in group:
+                jobs.put(cart)
+            limit = min(self.gateway_limits.get(gateway, self.workers), len(group))
+            for i in range(limit):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(jobs, slots, results)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def _work(self, jobs, slots, results):
+        """Charge carts from jobs until it's empty."""
+        try:
+            while True:
+                try:
+                    cart = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                slots.acquire()
+                try:
+                    results.append(self._charge(cart))
+                finally:
+                    slots.release()
+        finally:
+            # Each thread has its own connections, which would otherwise leak
+            for conn in connections.all():
+                conn.close()
+
+    def _charge(self, cart):
+        start = time.time()
+        error = None
+        skipped = False
+        try:
+            cart.charge_recurring(self.grace_period)
+            skipped = self._due(cart.__class__).filter(pk=cart.pk).exists()
+        except Exception, e:
+            log.exception("Error charging recurring cart %s" % cart.pk)
+            error = e
+        result = ChargeResult(cart, time.time() - start, error, skipped)
+        log.info(unicode(result))
+        return result
@@ -7,6 +7,10 @@ General settings for HiiCart. Gateway settings are in each gateway's module.
 
 **Optional Settings:**
  * *CART_COMPLETE* -- Where to send users after the gateway. [default: None]
+ * *CART_INDEX_CACHE* -- Name of a django cache (from CACHES) used to cache
+            where each cart uuid is stored. [default: None]
+ * *CART_LOCK_BACKEND* -- Class used to lock carts while notifications are
+            handled. See hiicart.locks. [default: "hiicart.locks.DatabaseLock"]
  * *CART_SETTINGS_FN* -- Function to call to get cart-specific settings. See
             note below about how these work. [default: None]
  * *CHARGE_RECURRING_GRACE_PERIOD* -- Timedela for grace period before charging
@@ -16,11 +20,55 @@ General settings for HiiCart. Gateway settings are in each gateway's module.
             item is marked as expired.  Useful because sometimes a eCheck needs
             to clear or the gateway is a day late with the recurring payment.
             [default: None]
+ * *GATEWAYS* -- Dict of extra gateway names to the dotted path of their
+            class. See hiicart.gateway.registry. [default: None]
+ * *HTTP_CONNECT_TIMEOUT* -- Seconds to wait when connecting to a gateway.
+            [default: 10]
+ * *HTTP_POOL_SIZE* -- Idle keep-alive connections kept per gateway host.
+            See hiicart.transport. [default: 4]
+ * *HTTP_READ_TIMEOUT* -- Seconds to wait for each read of a gateway's
+            response. [default: 30]
+ * *HTTP_TIMING_FN* -- Function called with each gateway request's
+            hiicart.transport.Response, e.g. to record latency. [default: None]
+ * *IPN_ARCHIVE_DIR* -- Directory to archive raw notifications in, for
+            replaying with hiicart_replay. See hiicart.archive. [default: None]
+ * *IPN_ARCHIVE_SEGMENT_SIZE* -- Bytes of notifications per archive segment
+            file, before compression. [default: 67108864]
+ * *IPN_CLAIM_TIMEOUT* -- Seconds before a deferred notification's worker is
+            assumed dead. See hiicart.inbox. [default: 300]
+ * *IPN_DEFERRED* -- Store notifications and acknowledge them at once,
+            verifying and handling them later. See hiicart.inbox.
+            [default: False]
+ * *IPN_IDEMPOTENCY_CACHE* -- Name of a django cache (from CACHES) used to
+            remember handled notifications. See hiicart.idempotency.
+            [default: None]
+ * *IPN_IDEMPOTENCY_CACHE_TTL* -- Seconds handled notifications are cached.
+            [default: 86400]
+ * *IPN_IDEMPOTENCY_TIMEOUT* -- Seconds before a notification still being
+            handled is handled again by its next delivery. [default: 300]
+ * *IPN_IDEMPOTENCY_WAIT* -- Seconds a duplicate notification waits for the
+            first delivery to be handled. [default: 10]
+ * *IPN_MAX_ATTEMPTS* -- Times a deferred notification is tried.
+            [default: 5]
+ * *IPN_QUEUE_BACKEND* -- Class that processes deferred notifications.
+            [default: "hiicart.inbox.ThreadQueue"]
+ * *IPN_WORKER_THREADS* -- Threads used by hiicart.inbox.ThreadQueue.
+            [default: 4]
  * *KEEP_ON_USER_DELETE* -- If True, stop CASCADE ON DELETE when associted User
             is deleted. (django > 1.3 ONLY)
  * *LIVE* -- If True, go against live gateway servers. [default: False]
  * *LOG* -- Logfile for HiiCart. [default: None]
  * *LOG_LEVEL* -- Logging level for the HiiCart log. [default: logging.DEBUG]
+ * *SETTINGS_CACHE_TTL* -- Seconds to cache STORE_SETTINGS_FN results for
+            when STORE_SETTINGS_KEY_FN is set. None caches them until
+            invalidated. [default: 300]
+ * *STORE_SETTINGS_FN* -- Function to call to get store-specific settings.
+            [default: None]
+ * *STORE_SETTINGS_KEY_FN* -- Function returning a key identifying a cart's
+            store. If set, STORE_SETTINGS_FN results are cached per store.
+            See hiicart.gateway.settings_cache. [default: None]
+ * *UUID_STORAGE* -- Column type for cart uuids: "char", "binary" or
+            "native". See hiicart.fields. [default: "char"]
 
 
 ** About Global Settings**
@@ -56,13 +104,35 @@ import logging
 
 SETTINGS = {
     'CART_COMPLETE': None,
+    'CART_INDEX_CACHE': None,
+    'CART_LOCK_BACKEND': 'hiicart.locks.DatabaseLock',
     'CART_SETTINGS_FN': None,
     'CHARGE_RECURRING_GRACE_PERIOD': None,
     'EXPIRATION_GRACE_PERIOD': None,
+    'GATEWAYS': None,
+    'HTTP_CONNECT_TIMEOUT': 10,
+    'HTTP_POOL_SIZE': 4,
+    'HTTP_READ_TIMEOUT': 30,
+    'HTTP_TIMING_FN': None,
+    'IPN_ARCHIVE_DIR': None,
+    'IPN_ARCHIVE_SEGMENT_SIZE': 64 * 1024 * 1024,
+    'IPN_CLAIM_TIMEOUT': 300,
+    'IPN_DEFERRED': False,
+    'IPN_IDEMPOTENCY_CACHE': None,
+    'IPN_IDEMPOTENCY_CACHE_TTL': 86400,
+    'IPN_IDEMPOTENCY_TIMEOUT': 300,
+    'IPN_IDEMPOTENCY_WAIT': 10,
+    'IPN_MAX_ATTEMPTS': 5,
+    'IPN_QUEUE_BACKEND': 'hiicart.inbox.ThreadQueue',
+    'IPN_WORKER_THREADS': 4,
     'KEEP_ON_USER_DELETE': None,
     'LIVE': False,
     'LOG': 'hiicart.log',
     'LOG_LEVEL': logging.DEBUG,
+    'SETTINGS_CACHE_TTL': 300,
+    'STORE_SETTINGS_FN': None,
+    'STORE_SETTINGS_KEY_FN': None,
+    'UUID_STORAGE': 'char',
     }
 
 # Integrate django settings
@@ -0,0 +1,9 @@
+from celery.decorators import task
+
+from hiicart import inbox
+
+
+@task(ignore_result=True)
+def process_notification(pk):
+    """Process a stored IPN. Used by hiicart.inbox.CeleryQueue."""
+    inbox.run(pk)
@@ -1,3 +1,8 @@
+import BaseHTTPServer
+import SocketServer
+import ssl
+import threading
+import time
 import unittest
 
 from datetime import datetime, date, timedelta
@@ -29,3 +34,55 @@ class HiiCartTestCase(unittest.TestCase):
                                                 duration=12, duration_unit="MONTH",
                                                 recurring_price=Decimal("20.00"))
 
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request with VERIFIED, keeping connections open.
+
+    Requests for /slow are answered after half a second.
+    """
+    protocol_version = "HTTP/1.1"
+    # Headers are written one at a time; don't let them wait on ACKs
+    disable_nagle_algorithm = True
+    # Paths requested, by every instance
+    paths = []
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond()
+
+    def _respond(self):
+        _StandInHandler.paths.append(self.path)
+        if self.path.startswith("/slow"):
+            time.sleep(0.5)
+        self.send_response(200)
+        self.send_header("Content-Length", "8")
+        self.end_headers()
+        self.wfile.write("VERIFIED")
+
+    def log_message(self, *args):
+        pass
+
+
+class _StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_stand_in_server(certfile=None, keyfile=None):
+    """
+    Start a local server standing in for a gateway, in a daemon thread.
+
+    Serves HTTPS if certfile is given. Returns the server; its url is
+    "http(s)://127.0.0.1:<server.server_port>/". Call shutdown() when done.
+    """
+    server = _StandInServer(("127.0.0.1", 0), _StandInHandler)
+    if certfile:
+        server.socket = ssl.wrap_socket(server.socket, certfile=certfile,
+                                        keyfile=keyfile, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
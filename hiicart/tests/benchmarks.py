@@ -0,0 +1,310 @@
+"""
+Benchmarks for HiiCart's database and gateway access.
+
+These aren't part of the default suite since they're slow and mostly print
+numbers. They're only loaded with HIICART_BENCHMARKS set; run them by name:
+
+    HIICART_BENCHMARKS=1 ./manage.py test hiicart.LineItemLoadingBenchmark
+"""
+
+import base
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import uuid
+
+from decimal import Decimal
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connection, reset_queries, transaction
+from django.http import HttpResponse
+
+from hiicart import inbox
+from hiicart.gateway.registry import BUILTIN_GATEWAYS, _import_path
+from hiicart.models import CART_TYPES, HiiCart, IPNInbox, LineItem, Payment, RecurringLineItem
+from hiicart.models import load_lineitems, search_carts
+from hiicart.transport import HTTPTransport
+
+
+def _measure(func, repeat=50):
+    """Run func repeat times. Returns (queries per call, ms per call)."""
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    try:
+        reset_queries()
+        func()
+        queries = len(connection.queries)
+        start = time.time()
+        for i in range(repeat):
+            func()
+        elapsed = (time.time() - start) * 1000 / repeat
+    finally:
+        settings.DEBUG = debug
+        reset_queries()
+    return queries, elapsed
+
+
+# (cart, sequence number) of each notification _benchmark_ipn handled
+BENCHMARK_IPNS = []
+
+@inbox.deferrable("benchmark")
+def _benchmark_ipn(request):
+    # Stands in for verifying the notification with the gateway
+    time.sleep(0.02)
+    BENCHMARK_IPNS.append((request.POST["cart"], int(request.POST["seq"])))
+    return HttpResponse()
+
+
+class LineItemLoadingBenchmark(base.HiiCartTestCase):
+    """Compare the UNION lineitem loader against one query per type."""
+
+    def setUp(self):
+        super(LineItemLoadingBenchmark, self).setUp()
+        self._add_recurring_item()
+        for i in range(5):
+            LineItem.objects.create(cart=self.cart, name="Item %i" % i,
+                                    quantity=1, sku=str(i + 10),
+                                    unit_price=Decimal("1.00"))
+
+    def test_lineitem_loading(self):
+        types = [LineItem, RecurringLineItem]
+        for n in (1, 5, 10):
+            # Registering the same models repeatedly stands in for n tables
+            cls_list = [types[i % 2] for i in range(n)]
+            def loop():
+                l = [cls.objects.filter(cart=self.cart) for cls in cls_list]
+                return [item for sublist in l for item in sublist]
+            def union():
+                return load_lineitems(cls_list, [self.cart.pk])
+            self.assertEqual(len(loop()), len(union()))
+            loop_q, loop_ms = _measure(loop)
+            union_q, union_ms = _measure(union)
+            print "%2i types: loop %2i queries %.2fms, union %i queries %.2fms" % (
+                  n, loop_q, loop_ms, union_q, union_ms)
+            self.assertTrue(union_q <= 1)
+
+
+# Time, in a fresh interpreter, to import hiicart.models and get one gateway
+# class, either through the registry or by importing every gateway like
+# _get_gateway() used to.
+IMPORT_TIME_SCRIPT = """
+import time
+start = time.time()
+import hiicart.models
+from hiicart.gateway.registry import BUILTIN_GATEWAYS, _import_path, get_gateway_class
+if %r:
+    [_import_path(path) for path in BUILTIN_GATEWAYS.values()]
+get_gateway_class("comp")
+print time.time() - start
+"""
+
+
+class GatewayRegistryBenchmark(base.HiiCartTestCase):
+    """Compare the lazy gateway registry against importing every gateway."""
+
+    def _import_time(self, import_all):
+        output = subprocess.Popen([sys.executable, "-c", IMPORT_TIME_SCRIPT % import_all],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        return float(output.strip()) * 1000
+
+    def test_get_gateway(self):
+        self.cart.gateway = "comp"
+        def import_all():
+            gateways = dict([(name, _import_path(path))
+                             for name, path in BUILTIN_GATEWAYS.items()])
+            return gateways["comp"](self.cart)
+        old_q, old_ms = _measure(import_all, repeat=200)
+        new_q, new_ms = _measure(self.cart.get_gateway, repeat=200)
+        print "get_gateway(): importing all %.3fms, registry %.3fms" % (old_ms, new_ms)
+        print "import time: importing all %.1fms, registry %.1fms" % (
+              self._import_time(True), self._import_time(False))
+
+
+class CustomerLookupBenchmark(base.HiiCartTestCase):
+    """
+    Compare search_carts() against the old cart_by_email() loop.
+
+    Inserts HIICART_BENCHMARK_CARTS carts (default 2,000,000) with raw
+    INSERTs, so the lookups run against a realistically sized table. Set it
+    lower for a quick run.
+    """
+
+    def setUp(self):
+        super(CustomerLookupBenchmark, self).setUp()
+        self.count = int(os.environ.get("HIICART_BENCHMARK_CARTS", 2000000))
+        fields = [f for f in HiiCart._meta.local_fields if not f.primary_key]
+        columns = [f.column for f in fields]
+        qn = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+              qn(HiiCart._meta.db_table), ", ".join([qn(c) for c in columns]),
+              ", ".join(["%s"] * len(columns)))
+        template = [f.get_db_prep_save(getattr(self.cart, f.attname), connection=connection)
+                    for f in fields]
+        varying = dict([(c, columns.index(c)) for c in
+                        ("_cart_uuid", "bill_email", "ship_email", "custom_id")])
+        uuid_field = HiiCart._meta.get_field("_cart_uuid")
+        cursor = connection.cursor()
+        for start in range(0, self.count, 10000):
+            rows = []
+            for i in range(start, min(start + 10000, self.count)):
+                row = list(template)
+                row[varying["_cart_uuid"]] = uuid_field.get_db_prep_save(
+                    str(uuid.uuid4()), connection=connection)
+                row[varying["bill_email"]] = "bench-%i@example.com" % i
+                row[varying["ship_email"]] = "bench-%i@example.com" % (i // 2)
+                row[varying["custom_id"]] = "bench-%i" % i
+                rows.append(row)
+            cursor.executemany(sql, rows)
+            transaction.commit_unless_managed()
+        self.cart.bill_email = "bench-target@example.com"
+        self.cart.custom_id = "bench-target"
+        self.cart.save()
+        Payment.objects.create(cart=self.cart, amount=Decimal("1.00"),
+                               state="PAID", transaction_id="bench-target")
+
+    def tearDown(self):
+        # Too many rows to delete through the ORM
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s LIKE %%s AND %s <> %%s" % (
+                       qn(HiiCart._meta.db_table), qn("custom_id"),
+                       qn(HiiCart._meta.pk.column)), ["bench-%", self.cart.pk])
+        transaction.commit_unless_managed()
+        super(CustomerLookupBenchmark, self).tearDown()
+
+    def test_customer_lookup(self):
+        email = "bench-target@example.com"
+        def old_cart_by_email():
+            for Cart in CART_TYPES:
+                try:
+                    return Cart.objects.get(bill_email=email)
+                except Cart.DoesNotExist:
+                    pass
+            for Cart in CART_TYPES:
+                try:
+                    return Cart.objects.get(ship_email=email)
+                except Cart.DoesNotExist:
+                    pass
+        lookups = [
+            ("cart_by_email loop", old_cart_by_email),
+            ("email", lambda: search_carts(email=email)[:50]),
+            ("email, shared", lambda: search_carts(email="bench-10@example.com")[:50]),
+            ("custom_id", lambda: search_carts(custom_id="bench-target")[:50]),
+            ("transaction_id", lambda: search_carts(transaction_id="bench-target")[:50]),
+            ("page 2 of 2", lambda: Paginator(search_carts(email="bench-10@example.com"), 1).page(2)),
+            ]
+        self.assertEqual(search_carts(email=email)[:1], [self.cart])
+        print "%i carts" % self.count
+        for name, func in lookups:
+            queries, ms = _measure(func, repeat=20)
+            print "%-20s %2i queries %8.2fms" % (name, queries, ms)
+
+
+class TransportBenchmark(base.HiiCartTestCase):
+    """
+    Compare the pooled HTTPTransport against a new connection per call.
+
+    Posts to a local HTTPS server, so the numbers are the handshake cost
+    alone; against a real gateway each saved round trip adds its latency.
+    Needs the openssl command to make a self-signed certificate.
+    """
+
+    def setUp(self):
+        super(TransportBenchmark, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.certfile = os.path.join(self.tempdir, "cert.pem")
+        try:
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                                   "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                                   "-keyout", self.certfile, "-out", self.certfile],
+                                  stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            self.certfile = None
+            return
+        self.server = base.start_stand_in_server(self.certfile, self.certfile)
+
+    def tearDown(self):
+        if self.certfile:
+            self.server.shutdown()
+        shutil.rmtree(self.tempdir)
+        super(TransportBenchmark, self).tearDown()
+
+    def test_transport(self):
+        if not self.certfile:
+            print "openssl not available, skipping"
+            return
+        url = "https://127.0.0.1:%i/" % self.server.server_port
+        context = ssl._create_unverified_context()
+        http = HTTPTransport(ssl_context=context)
+        def new_connection():
+            urllib2.urlopen(urllib2.Request(url), "cmd=_notify-validate",
+                            context=context).read()
+        def pooled():
+            self.assertEqual(http.post(url, "cmd=_notify-validate").body, "VERIFIED")
+        for name, func in [("new connection", new_connection), ("pooled", pooled)]:
+            queries, ms = _measure(func, repeat=200)
+            print "%-15s %6.2fms per call" % (name, ms)
+        http.close()
+
+
+class IPNWorkerBenchmark(base.HiiCartTestCase):
+    """
+    Compare hiicart_ipn_worker throughput with 1 to 8 partitions.
+
+    Each notification takes 20ms to handle, standing in for the gateway
+    round trip that dominates handling a real one. Partitions run in
+    threads here, rather than the command's processes. Needs a database
+    that threads can share, not an in-memory sqlite one.
+    """
+    notifications = 400
+    carts = 40
+
+    def tearDown(self):
+        IPNInbox.objects.filter(gateway="benchmark").delete()
+        super(IPNWorkerBenchmark, self).tearDown()
+
+    def _add_notifications(self):
+        IPNInbox.objects.filter(gateway="benchmark").delete()
+        for i in range(self.notifications):
+            key = "benchmark-cart-%i" % (i % self.carts)
+            IPNInbox.objects.create(gateway="benchmark", path="/hiicart/benchmark/ipn/",
+                                    handler="hiicart.tests.benchmarks._benchmark_ipn",
+                                    headers='{"CONTENT_TYPE": "application/x-www-form-urlencoded"}',
+                                    body="cart=%s&seq=%i" % (key, i),
+                                    partition_key=key, bucket=inbox.partition_bucket(key))
+
+    def test_ipn_worker(self):
+        db = settings.DATABASES["default"]
+        if "sqlite" in db["ENGINE"] and db.get("TEST_NAME") in (None, "", ":memory:"):
+            print "Needs a database threads can share, skipping"
+            return
+        def work(worker):
+            try:
+                worker.drain()
+            finally:
+                connection.close()
+        base_rate = None
+        for partitions in (1, 2, 4, 8):
+            self._add_notifications()
+            del BENCHMARK_IPNS[:]
+            threads = [threading.Thread(target=work, args=(inbox.Worker(p, partitions, 20),))
+                       for p in range(partitions)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            self.assertEqual(len(BENCHMARK_IPNS), self.notifications)
+            for key in set([k for k, seq in BENCHMARK_IPNS]):
+                seqs = [seq for k, seq in BENCHMARK_IPNS if k == key]
+                self.assertEqual(seqs, sorted(seqs))
+            rate = self.notifications / elapsed
+            base_rate = base_rate or rate
+            print "%i partitions: %6.1f IPNs/s, %.1fx" % (partitions, rate, rate / base_rate)
@@ -2,10 +2,15 @@ import base
 
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+from StringIO import StringIO
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management.base import CommandError
 
+from hiicart.management.commands import hiicart_expire
 from hiicart.models import HiiCart, LineItem, RecurringLineItem
+from hiicart.recurring import RecurringChargeScheduler
+from hiicart.settings import SETTINGS as hiicart_settings
 
 class CompTestCase(base.HiiCartTestCase):
     """Tests for COMP payment gateway."""
@@ -74,3 +79,68 @@ class CompTestCase(base.HiiCartTestCase):
         self.cart.adjust_expiration(datetime.now()-timedelta(days=7))
         self.cart.charge_recurring(grace_period=timedelta(days=2))
         self.assertEqual(self.cart.payments.count(), 2)
+
+    def test_charge_recurring_scheduler(self):
+        """Test charging due carts through RecurringChargeScheduler."""
+        self.test_submit_recurring()
+        scheduler = RecurringChargeScheduler(workers=1, grace_period=timedelta(hours=12))
+        self.assertFalse(self.cart in scheduler.due_carts(HiiCart))
+        self.cart.adjust_expiration(datetime.now()-timedelta(days=1))
+        due = list(scheduler.due_carts(HiiCart).filter(user=self.test_user))
+        self.assertEqual(due, [self.cart])
+        results = scheduler.charge(due)
+        self.assertEqual([r.ok for r in results], [True])
+        self.assertEqual(self.cart.payments.count(), 2)
+        self.assertFalse(self.cart in scheduler.due_carts(HiiCart))
+        # A cart charge_recurring() leaves alone is skipped, not ok
+        self.cart = HiiCart.objects.get(pk=self.cart.pk)
+        self.cart.adjust_expiration(datetime.now()-timedelta(days=1))
+        self.cart.charge_recurring = lambda grace_period=None: None
+        results = scheduler.charge([self.cart])
+        self.assertEqual([(r.ok, r.skipped) for r in results], [(False, True)])
+        # Carts of gateways that bill subscriptions themselves are never due
+        HiiCart.objects.filter(pk=self.cart.pk).update(gateway="google")
+        self.assertFalse(self.cart in scheduler.due_carts(HiiCart))
+        # The charge window is preferred, and without a grace period
+        # is_expired() never finds an item expired
+        saved = dict([(k, hiicart_settings[k]) for k in
+                      ("CHARGE_RECURRING_GRACE_PERIOD", "EXPIRATION_GRACE_PERIOD")])
+        try:
+            hiicart_settings["CHARGE_RECURRING_GRACE_PERIOD"] = timedelta(hours=12)
+            hiicart_settings["EXPIRATION_GRACE_PERIOD"] = timedelta(days=7)
+            self.assertEqual(RecurringChargeScheduler().grace_period, timedelta(hours=12))
+            hiicart_settings["CHARGE_RECURRING_GRACE_PERIOD"] = None
+            hiicart_settings["EXPIRATION_GRACE_PERIOD"] = None
+            self.assertEqual(list(RecurringChargeScheduler(workers=1).due_carts(HiiCart)), [])
+        finally:
+            hiicart_settings.update(saved)
+
+    def test_expire_command(self):
+        """Test hiicart_expire cancels expired carts once, and only with a grace period."""
+        self.test_submit_recurring()
+        self.cart.adjust_expiration(datetime.now()-timedelta(days=3))
+        changes = []
+        def on_cart(sender, cart, old_state, new_state, **kwargs):
+            if cart.pk == self.cart.pk:
+                changes.append((old_state, new_state))
+        command = hiicart_expire.Command()
+        command.stdout = StringIO()
+        options = {"dry_run": False, "batch_size": 1000, "checkpoint": None}
+        saved = hiicart_settings["EXPIRATION_GRACE_PERIOD"]
+        HiiCart.cart_state_changed.connect(on_cart)
+        try:
+            hiicart_settings["EXPIRATION_GRACE_PERIOD"] = None
+            self.assertRaises(CommandError, command.handle, **options)
+            self.assertEqual(HiiCart.objects.get(pk=self.cart.pk).state, "RECURRING")
+            hiicart_settings["EXPIRATION_GRACE_PERIOD"] = timedelta(days=1)
+            before = HiiCart.objects.get(pk=self.cart.pk).last_updated
+            command.handle(**options)
+            cancelled = HiiCart.objects.get(pk=self.cart.pk)
+            self.assertEqual(cancelled.state, "CANCELLED")
+            self.assertTrue(cancelled.last_updated > before)
+            # Carts cancelled since they were read aren't signalled again
+            command.cancel(HiiCart, [HiiCart.objects.get(pk=self.cart.pk)])
+        finally:
+            HiiCart.cart_state_changed.disconnect(on_cart)
+            hiicart_settings["EXPIRATION_GRACE_PERIOD"] = saved
+        self.assertEqual(changes, [("RECURRING", "CANCELLED")])
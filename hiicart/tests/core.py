@@ -1,11 +1,91 @@
 import base
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import uuid
 
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+from StringIO import StringIO
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.test.client import RequestFactory
+
+from hiicart import archive, inbox, models
+from hiicart.fields import CartUUIDField, stored_uuid
+from hiicart.gateway import registry, settings_cache
+from hiicart.gateway.base import LayeredSettings
+from hiicart.gateway.comp.gateway import CompGateway
+from hiicart.gateway.comp.settings import SETTINGS as comp_settings
+from hiicart.idempotency import NotificationInProgress, idempotent, verified
+from hiicart.models import HiiCart, HiiCartError, LineItem, RecurringLineItem, Payment, VALID_TRANSITIONS
+from hiicart.models import CartIndex, IPNInbox, NotificationKey, find_cart, find_payment, load_lineitems, prefetch_lineitems, search_carts
+from hiicart.models import CART_TYPES, HiiCartBase
+from hiicart.settings import SETTINGS as hiicart_settings
+from hiicart.transport import HTTPTransport
+from hiicart.utils import cart_by_email
+
+STORE_SETTINGS_CALLS = []
+
+def _store_settings(cart):
+    STORE_SETTINGS_CALLS.append(cart.pk)
+    return {"STORE": cart.pk}
+
+def _store_key(cart):
+    return cart.pk
+
+INBOX_CALLS = []
+
+@inbox.deferrable("test")
+def _inbox_view(request):
+    INBOX_CALLS.append(request.raw_post_data)
+    if "fail" in request.POST:
+        raise ValueError("Handler failed")
+    if "flaky" in request.POST and request.ipn_inbox.attempts == 1:
+        raise ValueError("Handler failed once")
+    if "reject" in request.POST:
+        return HttpResponseBadRequest("Rejected")
+    return HttpResponse("Handled")
+
+IDEMPOTENT_CALLS = []
+
+@idempotent("test", key=lambda request: request.POST.get("id"))
+def _idempotent_view(request):
+    IDEMPOTENT_CALLS.append(request.POST["id"])
+    if "slow" in request.POST:
+        time.sleep(0.2)
+    if "fail" in request.POST:
+        raise ValueError("Handler failed")
+    if "reject" in request.POST:
+        return HttpResponseBadRequest("Rejected")
+    if "forged" in request.POST:
+        return HttpResponse("Ignored")
+    verified(request)
+    response = HttpResponse("Handled %s" % request.POST["id"])
+    response["X-Handled"] = "yes"
+    return response
+
+ARCHIVED_CALLS = []
+
+@archive.archived("test")
+def _archived_view(request):
+    ARCHIVED_CALLS.append(request.raw_post_data)
+    if "reject" in request.POST:
+        return HttpResponseBadRequest("Rejected")
+    return HttpResponse("Handled")
+
+def _in_memory_db():
+    """Whether tests run on an in-memory sqlite database, which threads can't share."""
+    db = settings.DATABASES["default"]
+    return "sqlite" in db["ENGINE"] and db.get("TEST_NAME") in (None, "", ":memory:")
 
-from hiicart.models import HiiCart, LineItem, RecurringLineItem
 
 class HiiCartTestCase(base.HiiCartTestCase):
     """Basic tests to ensure HiiCart is working."""
@@ -39,6 +119,587 @@ class HiiCartTestCase(base.HiiCartTestCase):
         self.assertNotEqual(self.cart.id, newcart.id)
         newcart.delete()
 
+    def test_bulk_clone(self):
+        """Test cloning carts in bulk matches clone()."""
+        self._submit_recurring()
+        other = HiiCart.objects.create(user=self.test_user)
+        LineItem.objects.create(cart=other, name="Test 2", quantity=2,
+                                sku="2", unit_price=Decimal("5.00"))
+        signalled = []
+        def receiver(sender, cart, old_state, new_state, **kwargs):
+            signalled.append((cart.pk, old_state, new_state))
+        HiiCart.cart_state_changed.connect(receiver)
+        try:
+            clones = HiiCart.objects.bulk_clone([self.cart, other])
+        finally:
+            HiiCart.cart_state_changed.disconnect(receiver)
+        self.assertEqual(signalled, [(clones[0].pk, "RECURRING", "OPEN")])
+        for cart, dupe in zip([self.cart, other], clones):
+            fresh = HiiCart.objects.get(pk=dupe.pk)
+            self.assertNotEqual(fresh.pk, cart.pk)
+            self.assertNotEqual(fresh.cart_uuid, cart.cart_uuid)
+            self.assertEqual(fresh.state, "OPEN")
+            self.assertEqual(fresh.gateway, None)
+            self.assertEqual(fresh.paid_total, Decimal("0.00"))
+            self.assertEqual(fresh._total, cart.total)
+            self.assertEqual(sorted([li.sku for li in fresh.lineitems]),
+                             sorted([li.sku for li in cart.lineitems]))
+        self.assertEqual(clones[0].recurring_lineitems[0].expires_at, None)
+
+    def test_gateway_registry(self):
+        """Test gateways are looked up lazily and can be registered."""
+        self.assertTrue(registry.get_gateway_class("comp") is CompGateway)
+        self.assertTrue(isinstance(self.cart._get_gateway("comp"), CompGateway))
+        self.assertRaises(HiiCartError, self.cart._get_gateway, "nonexistent")
+        registry.register_gateway("nonexistent", "hiicart.gateway.comp.gateway.CompGateway")
+        try:
+            self.assertTrue(isinstance(self.cart._get_gateway("nonexistent"), CompGateway))
+        finally:
+            del registry._load_registry()["nonexistent"]
+
+    def test_store_settings_cache(self):
+        """Test STORE_SETTINGS_FN results are cached per store until invalidated."""
+        del STORE_SETTINGS_CALLS[:]
+        overrides = {"STORE_SETTINGS_FN": "hiicart.tests.core._store_settings",
+                     "STORE_SETTINGS_KEY_FN": "hiicart.tests.core._store_key"}
+        def load():
+            cart = HiiCart.objects.get(pk=self.cart.pk)
+            cart.hiicart_settings = dict(cart.hiicart_settings, **overrides)
+            return cart
+        settings_cache.invalidate_store_settings(self.cart.pk)
+        cart = load()
+        self.assertEqual(settings_cache.store_settings(cart), {"STORE": cart.pk})
+        self.assertEqual(settings_cache.store_settings(load()), {"STORE": cart.pk})
+        self.assertEqual(len(STORE_SETTINGS_CALLS), 1)
+        settings_cache.invalidate_store_settings(self.cart.pk)
+        settings_cache.store_settings(load())
+        self.assertEqual(len(STORE_SETTINGS_CALLS), 2)
+
+    def test_layered_settings(self):
+        """Test later settings layers win and overlays don't change the base."""
+        base = LayeredSettings({"A": 1, "B": 1}, None, {"B": 2})
+        top = base.overlay({"A": 3}, {})
+        self.assertEqual((base["A"], base["B"]), (1, 2))
+        self.assertEqual(dict(top.items()), {"A": 3, "B": 2})
+        self.assertFalse("C" in top)
+        self.assertFalse(hasattr(top, "__setitem__"))
+
+    def test_settings_tenant_isolation(self):
+        """Test concurrent gateways for different stores don't share settings."""
+        original = dict(comp_settings)
+        overrides = {"STORE_SETTINGS_FN": "hiicart.tests.core._store_settings"}
+        carts = []
+        for i in range(8):
+            cart = HiiCart.objects.create(user=self.test_user)
+            cart.hiicart_settings = dict(cart.hiicart_settings, **overrides)
+            carts.append(cart)
+        errors = []
+        def check(cart):
+            for i in range(200):
+                cart._settings_memo = None
+                gateway = CompGateway(cart)
+                if gateway.settings["STORE"] != cart.pk:
+                    errors.append((cart.pk, gateway.settings["STORE"]))
+        threads = [threading.Thread(target=check, args=(cart,)) for cart in carts]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(comp_settings, original)
+
+    def test_find_cart(self):
+        """Test finding carts by uuid through CartIndex."""
+        self.assertEqual(find_cart(self.cart.cart_uuid), self.cart)
+        self.assertEqual(find_cart("nonexistent"), None)
+        other = HiiCart.objects.create(user=self.test_user)
+        cart_uuid = other.cart_uuid
+        other.delete()
+        self.assertEqual(find_cart(cart_uuid), None)
+        self.assertFalse(CartIndex.objects.filter(cart_uuid=cart_uuid).exists())
+        # Queryset and cascade deletes remove index rows too
+        other = HiiCart.objects.create(user=self.test_user)
+        HiiCart.objects.filter(pk=other.pk).delete()
+        self.assertFalse(CartIndex.objects.filter(cart_uuid=other.cart_uuid).exists())
+        user = User.objects.create(username="find-cart-%s" % uuid.uuid4().hex[:8])
+        other = HiiCart.objects.create(user=user)
+        user.delete()
+        if hiicart_settings["KEEP_ON_USER_DELETE"]:
+            # The cart outlives its user, so it stays indexed
+            self.assertEqual(find_cart(other.cart_uuid), other)
+            self.assertEqual(HiiCart.objects.get(pk=other.pk).user, None)
+            other.delete()
+        else:
+            self.assertFalse(CartIndex.objects.filter(cart_uuid=other.cart_uuid).exists())
+        # A stale row never returns another cart
+        other = HiiCart.objects.create(user=self.test_user)
+        stale_uuid = str(uuid.uuid4())
+        CartIndex.objects.filter(cart_uuid=other.cart_uuid).update(cart_uuid=stale_uuid)
+        self.assertEqual(find_cart(stale_uuid), None)
+        self.assertFalse(CartIndex.objects.filter(cart_uuid=stale_uuid).exists())
+        # ...and a cart missing from the index is still found, and indexed again
+        self.assertEqual(find_cart(other.cart_uuid), other)
+        self.assertTrue(CartIndex.objects.filter(cart_uuid=other.cart_uuid).exists())
+
+    def test_search_carts(self):
+        """Test finding carts by email, custom_id and transaction id."""
+        email = "search-%s@example.com" % uuid.uuid4().hex
+        carts = []
+        for i in range(3):
+            carts.append(HiiCart.objects.create(user=self.test_user,
+                                                custom_id="search-%i" % i))
+        carts[0].bill_email = email
+        carts[0].save()
+        carts[1].ship_email = email
+        carts[1].save()
+        Payment.objects.create(cart=carts[2], amount=Decimal("1.00"),
+                               state="PAID", transaction_id="search-txn")
+        self.assertEqual(list(search_carts(email=email)), [carts[1], carts[0]])
+        self.assertEqual(search_carts(email=email).count(), 2)
+        self.assertEqual(search_carts(email=email)[1:], [carts[0]])
+        self.assertEqual(search_carts(email=email)[0], carts[1])
+        self.assertEqual(list(search_carts(custom_id="search-2")), [carts[2]])
+        self.assertEqual(list(search_carts(transaction_id="search-txn")), [carts[2]])
+        self.assertEqual(list(search_carts(email=email, custom_id="search-0")), [carts[0]])
+        self.assertEqual(list(search_carts(email="nobody@example.com")), [])
+        self.assertRaises(ValueError, search_carts)
+        # Abstract cart types, which have no table or payment class, are skipped
+        CART_TYPES.append(HiiCartBase)
+        try:
+            self.assertEqual(list(search_carts(transaction_id="search-txn")), [carts[2]])
+            self.assertEqual(search_carts(email=email).count(), 2)
+        finally:
+            CART_TYPES.remove(HiiCartBase)
+        self.assertEqual(cart_by_email(email), carts[1])
+        self.assertEqual(cart_by_email("nobody@example.com"), None)
+
+    def test_find_payment(self):
+        """Test finding payments by gateway and transaction id."""
+        txn = "find-%s" % uuid.uuid4().hex
+        first = Payment.objects.create(cart=self.cart, amount=Decimal("1.99"), gateway="PAYPAL",
+                                       state="PAID", transaction_id=txn)
+        Payment.objects.create(cart=self.cart, amount=Decimal("-1.99"), gateway="PAYPAL",
+                               state="REFUND", transaction_id=txn)
+        payment = find_payment("paypal", txn)
+        self.assertEqual(payment, first)
+        self.assertEqual(payment.cart, self.cart)
+        self.assertEqual(find_payment("GOOGLE", txn), None)
+        self.assertEqual(find_payment("PAYPAL", "nonexistent"), None)
+        self.assertEqual(find_payment("PAYPAL", None), None)
+        # Gateways are stored upper case, so they can be matched exactly
+        other = Payment.objects.create(cart=self.cart, amount=Decimal("1.99"), gateway="amazon",
+                                       state="PAID", transaction_id=txn)
+        self.assertEqual(Payment.objects.get(pk=other.pk).gateway, "AMAZON")
+        self.assertEqual(find_payment("AMAZON", txn), other)
+
+    def test_upsert_by_transaction(self):
+        """Test creating and updating payments by gateway and transaction id."""
+        txn = "upsert-%s" % uuid.uuid4().hex
+        changes = []
+        def on_change(sender, payment, old_state, new_state, **kwargs):
+            changes.append((old_state, new_state))
+        Payment.payment_state_changed.connect(on_change)
+        try:
+            payment, created, changed = Payment.upsert_by_transaction(self.cart, "paypal", txn,
+                                                                      Decimal("1.99"), "PENDING")
+            self.assertEqual((created, changed), (True, True))
+            self.assertEqual(payment.gateway, "PAYPAL")
+            same, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn,
+                                                                   Decimal("1.99"), "PENDING")
+            self.assertEqual(same, payment)
+            self.assertEqual((created, changed), (False, False))
+            paid, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn,
+                                                                   Decimal("1.99"), "PAID")
+            self.assertEqual(paid, payment)
+            self.assertEqual((created, changed), (False, True))
+            kept, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn, Decimal("1.99"),
+                                                                   "CANCELLED", update_states=("PENDING",))
+            self.assertEqual((created, changed), (False, False))
+            self.assertEqual(kept.state, "PAID")
+            # Only a new payment takes the notification's amount
+            same, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn,
+                                                                   Decimal("5.00"), "PAID")
+            self.assertEqual((created, changed), (False, False))
+            self.assertEqual(Payment.objects.get(pk=payment.pk).amount, Decimal("1.99"))
+        finally:
+            Payment.payment_state_changed.disconnect(on_change)
+        self.assertEqual(changes, [("PENDING", "PAID")])
+        self.assertEqual(Payment.objects.filter(transaction_id=txn).count(), 1)
+        self.assertEqual(HiiCart.objects.get(pk=self.cart.pk).paid_total, Decimal("1.99"))
+        # A pending charge is preferred over earlier settled ones
+        pending = Payment.objects.create(cart=self.cart, amount=Decimal("1.99"), gateway="PAYPAL",
+                                         state="PENDING", transaction_id=txn)
+        paid, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn, Decimal("1.99"),
+                                                               "PAID", update_states=("PENDING",))
+        self.assertEqual((paid, created, changed), (pending, False, True))
+        # Another cart's payment for the transaction is never matched
+        other = HiiCart.objects.create()
+        theirs = Payment.objects.create(cart=other, amount=Decimal("1.99"), gateway="PAYPAL",
+                                        state="PENDING", transaction_id=txn)
+        mine, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn, Decimal("1.99"),
+                                                               "CANCELLED", update_states=("PENDING",))
+        self.assertEqual((mine.cart_id, created, changed), (self.cart.pk, False, False))
+        self.assertEqual(Payment.objects.get(pk=theirs.pk).state, "PENDING")
+        # A refund holding the transaction's key is never returned or updated
+        txn = "upsert-%s" % uuid.uuid4().hex
+        refund = Payment.objects.create(cart=self.cart, amount=Decimal("-1.99"), gateway="PAYPAL",
+                                        state="REFUND", transaction_id=txn,
+                                        transaction_key="PAYPAL:%s" % txn)
+        payment, created, changed = Payment.upsert_by_transaction(self.cart, "PAYPAL", txn,
+                                                                  Decimal("1.99"), "PAID")
+        self.assertTrue(created)
+        self.assertNotEqual(payment, refund)
+        self.assertEqual(Payment.objects.get(pk=refund.pk).state, "REFUND")
+
+    def test_dirty_fields(self):
+        """Test saving an existing cart only writes the fields that changed."""
+        cart = HiiCart.objects.get(pk=self.cart.pk)
+        self.assertEqual(cart.get_dirty_fields(), [])
+        # Changed behind this instance's back, so a full save would undo it
+        HiiCart.objects.filter(pk=cart.pk).update(bill_email="other@example.com")
+        cart.set_state("SUBMITTED")
+        self.assertEqual(cart.get_dirty_fields(), [])
+        saved = HiiCart.objects.get(pk=cart.pk)
+        self.assertEqual(saved.state, "SUBMITTED")
+        self.assertEqual(saved.bill_email, "other@example.com")
+        cart.tax = Decimal("1.00")
+        self.assertEqual(cart.get_dirty_fields(), ["tax"])
+        self.assertTrue(cart._needs_recalc())
+        cart.save()
+        self.assertEqual(HiiCart.objects.get(pk=cart.pk)._total, Decimal("2.99"))
+        item = LineItem.objects.get(pk=self.lineitem.pk)
+        item.quantity = 2
+        self.assertEqual(item.get_dirty_fields(), ["quantity"])
+        item.save()
+        self.assertEqual(LineItem.objects.get(pk=item.pk)._total, Decimal("3.98"))
+
+    def test_cart_batch(self):
+        """Test batch() saves the cart once and sends net state changes after it."""
+        changes = []
+        def on_cart(sender, cart, old_state, new_state, **kwargs):
+            changes.append(("cart", old_state, new_state))
+        def on_payment(sender, payment, old_state, new_state, **kwargs):
+            changes.append(("payment", old_state, new_state))
+        HiiCart.cart_state_changed.connect(on_cart)
+        Payment.payment_state_changed.connect(on_payment)
+        try:
+            with self.cart.batch():
+                self.cart.bill_email = "batch@example.com"
+                self.cart.save()
+                self.cart.set_state("SUBMITTED")
+                payment = Payment(cart=self.cart, amount=Decimal("1.99"), state="PENDING")
+                payment.save()
+                payment.state = "PAID"
+                payment.save()
+                self.cart.update_state()
+                self.assertEqual(HiiCart.objects.get(pk=self.cart.pk).state, "OPEN")
+                self.assertEqual(changes, [])
+        finally:
+            HiiCart.cart_state_changed.disconnect(on_cart)
+            Payment.payment_state_changed.disconnect(on_payment)
+        saved = HiiCart.objects.get(pk=self.cart.pk)
+        self.assertEqual(saved.state, "COMPLETED")
+        self.assertEqual(saved.bill_email, "batch@example.com")
+        self.assertEqual(changes, [("payment", "PENDING", "PAID"),
+                                   ("cart", "OPEN", "COMPLETED")])
+        try:
+            with self.cart.batch():
+                self.cart.set_state("CANCELLED", validate=False)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(HiiCart.objects.get(pk=self.cart.pk).state, "COMPLETED")
+        # Inside a managed transaction the batch doesn't commit it
+        try:
+            with transaction.commit_on_success():
+                with self.cart.batch():
+                    self.cart.bill_email = "outer@example.com"
+                    self.cart.save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(HiiCart.objects.get(pk=self.cart.pk).bill_email, "batch@example.com")
+        # Unsaved changes survive the re-read once the cart is locked
+        HiiCart.objects.filter(pk=self.cart.pk).update(ship_email="other@example.com")
+        self.cart.bill_email = "unsaved@example.com"
+        with self.cart.batch():
+            self.assertEqual(self.cart.bill_email, "unsaved@example.com")
+            self.assertEqual(self.cart.ship_email, "other@example.com")
+        saved = HiiCart.objects.get(pk=self.cart.pk)
+        self.assertEqual(saved.bill_email, "unsaved@example.com")
+        self.assertEqual(saved.ship_email, "other@example.com")
+
+    @unittest.skipIf(_in_memory_db(), "threads can't share an in-memory database")
+    def test_batch_lock(self):
+        """Test concurrent batches on one cart don't lose each other's updates."""
+        pk = self.cart.pk
+        errors = []
+        def work():
+            try:
+                for i in range(5):
+                    cart = HiiCart.objects.get(pk=pk)
+                    with cart.batch():
+                        cart.shipping = (cart.shipping or 0) + 1
+                        cart.save()
+            except Exception, e:
+                errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=work) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(HiiCart.objects.get(pk=pk).shipping, 50)
+
+    def test_transport(self):
+        """Test the HTTP transport reuses connections and calls hooks."""
+        server = base.start_stand_in_server()
+        try:
+            url = "http://127.0.0.1:%i/" % server.server_port
+            http = HTTPTransport(connect_timeout=5, read_timeout=5)
+            responses = []
+            http.add_hook(responses.append)
+            self.assertEqual(http.post(url, "cmd=_notify-validate").body, "VERIFIED")
+            self.assertEqual(http.get(url).body, "VERIFIED")
+            self.assertEqual([r.reused for r in responses], [False, True])
+            self.assertEqual([r.status for r in responses], [200, 200])
+            http.close()
+            # A read timeout isn't retried, even for a GET on a pooled connection
+            http = HTTPTransport(connect_timeout=5, read_timeout=0.2)
+            http.get(url)
+            del base._StandInHandler.paths[:]
+            self.assertRaises(socket.timeout, http.get, url + "slow")
+            self.assertEqual(base._StandInHandler.paths, ["/slow"])
+            http.close()
+        finally:
+            server.shutdown()
+
+    def test_deferred_ipn(self):
+        """Test deferred IPNs are stored and acknowledged, then handled by process()."""
+        del INBOX_CALLS[:]
+        factory = RequestFactory()
+        def post(body):
+            request = factory.post("/hiicart/test/ipn/", body,
+                                   content_type="application/x-www-form-urlencoded",
+                                   HTTP_AUTHORIZATION="Basic c2VjcmV0")
+            return _inbox_view(request)
+        queue = inbox._queue
+        hiicart_settings["IPN_DEFERRED"] = True
+        inbox._queue = inbox.ManualQueue()
+        try:
+            # Bodies are stored byte for byte, whatever their encoding
+            body = "txn_id=1&note=caf\xe9"
+            response = post(body)
+            self.assertEqual((response.status_code, response.content), (200, ""))
+            self.assertEqual(INBOX_CALLS, [])
+            notification = IPNInbox.objects.get(gateway="test")
+            self.assertEqual((notification.status, notification.raw_body), ("PENDING", body))
+            self.assertFalse("HTTP_AUTHORIZATION" in notification.headers)
+            self.assertEqual(inbox.process_pending(), 1)
+            self.assertEqual(INBOX_CALLS, [body])
+            notification = IPNInbox.objects.get(pk=notification.pk)
+            self.assertEqual((notification.status, notification.attempts), ("DONE", 1))
+            # Only PENDING notifications are processed
+            self.assertEqual(inbox.process(notification.pk), None)
+            self.assertEqual(len(INBOX_CALLS), 1)
+            # Errors are retried IPN_MAX_ATTEMPTS times
+            post("fail=1")
+            pk = IPNInbox.objects.get(gateway="test", status="PENDING").pk
+            statuses = [inbox.process(pk) for i in range(hiicart_settings["IPN_MAX_ATTEMPTS"])]
+            self.assertEqual(statuses[-2:], ["PENDING", "FAILED"])
+            self.assertTrue("Handler failed" in IPNInbox.objects.get(pk=pk).last_error)
+            # Error responses aren't retried
+            post("reject=1")
+            self.assertEqual(inbox.process_pending(), 1)
+            self.assertEqual(IPNInbox.objects.filter(gateway="test", status="REJECTED").count(), 1)
+            # Abandoned claims are made PENDING again
+            IPNInbox.objects.filter(pk=pk).update(status="PROCESSING",
+                                                  claimed_at=datetime.now() - timedelta(hours=1))
+            self.assertEqual(inbox.recover(), 1)
+            self.assertEqual(IPNInbox.objects.get(pk=pk).status, "PENDING")
+        finally:
+            hiicart_settings["IPN_DEFERRED"] = False
+            inbox._queue = queue
+            IPNInbox.objects.filter(gateway="test").delete()
+        # Not deferred, views handle requests at once
+        self.assertEqual(post("txn_id=2").content, "Handled")
+
+    def test_ipn_worker(self):
+        """Test workers apply each cart's IPNs in order, and only in their partition."""
+        del INBOX_CALLS[:]
+        keys = ["cart-%i" % i for i in range(10)]
+        key_a = keys[0]
+        key_b = [k for k in keys if inbox.partition_bucket(k) % 2 != inbox.partition_bucket(key_a) % 2][0]
+        def add(key, body):
+            return IPNInbox.objects.create(gateway="test", handler="hiicart.tests.core._inbox_view",
+                                           path="/hiicart/test/ipn/", body=body,
+                                           headers='{"CONTENT_TYPE": "application/x-www-form-urlencoded"}',
+                                           partition_key=key, bucket=inbox.partition_bucket(key))
+        worker_a = inbox.Worker(inbox.partition_bucket(key_a) % 2, 2)
+        worker_b = inbox.Worker(inbox.partition_bucket(key_b) % 2, 2)
+        try:
+            a1 = add(key_a, "n=a1&flaky=1")
+            b1 = add(key_b, "n=b1")
+            a2 = add(key_a, "n=a2")
+            b2 = add(key_b, "n=b2")
+            # a2 waits for a1's retry
+            self.assertEqual(worker_a.drain(), 1)
+            self.assertEqual(INBOX_CALLS, ["n=a1&flaky=1"])
+            a2 = IPNInbox.objects.get(pk=a2.pk)
+            self.assertEqual((a2.status, a2.attempts), ("PENDING", 0))
+            self.assertEqual(worker_a.drain(), 0)
+            IPNInbox.objects.filter(pk=a1.pk).update(available_at=datetime.now() - timedelta(seconds=1))
+            self.assertEqual(worker_a.drain(), 2)
+            self.assertEqual(INBOX_CALLS, ["n=a1&flaky=1", "n=a1&flaky=1", "n=a2"])
+            self.assertEqual(worker_b.drain(), 2)
+            self.assertEqual(INBOX_CALLS[3:], ["n=b1", "n=b2"])
+            self.assertEqual(IPNInbox.objects.filter(gateway="test", status="DONE").count(), 4)
+        finally:
+            IPNInbox.objects.filter(gateway="test").delete()
+
+    def test_idempotent(self):
+        """Test notifications are handled once, and error responses let them be handled again."""
+        del IDEMPOTENT_CALLS[:]
+        factory = RequestFactory()
+        def post(body):
+            return _idempotent_view(factory.post("/hiicart/test/ipn/", body,
+                                    content_type="application/x-www-form-urlencoded"))
+        try:
+            post("id=1")
+            second = post("id=1")
+            self.assertEqual(IDEMPOTENT_CALLS, ["1"])
+            self.assertEqual((second.status_code, second.content, second["X-Handled"]),
+                             (200, "Handled 1", "yes"))
+            post("id=2&reject=1")
+            post("id=2&reject=1")
+            self.assertRaises(ValueError, post, "id=3&fail=1")
+            post("id=3")
+            self.assertEqual(IDEMPOTENT_CALLS, ["1", "2", "2", "3", "3"])
+            self.assertEqual(NotificationKey.objects.filter(gateway="test").count(), 2)
+            # Unverified requests don't use the key up
+            self.assertEqual(post("id=7&forged=1").content, "Ignored")
+            self.assertEqual(post("id=7").content, "Handled 7")
+            self.assertEqual(IDEMPOTENT_CALLS[-2:], ["7", "7"])
+            self.assertEqual(NotificationKey.objects.filter(gateway="test").count(), 3)
+            # Keys claimed inside the caller's transaction go with it
+            try:
+                with transaction.commit_on_success():
+                    post("id=8")
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertFalse(NotificationKey.objects.filter(gateway="test", key="8").exists())
+            # Notifications without a key are always handled
+            post("id=")
+            post("id=")
+            self.assertEqual(IDEMPOTENT_CALLS[-2:], ["", ""])
+            del IDEMPOTENT_CALLS[:]
+            # Another request is handling it
+            NotificationKey.objects.create(gateway="test", key="4", started=datetime.now())
+            wait = hiicart_settings["IPN_IDEMPOTENCY_WAIT"]
+            hiicart_settings["IPN_IDEMPOTENCY_WAIT"] = 0
+            try:
+                self.assertRaises(NotificationInProgress, post, "id=4")
+            finally:
+                hiicart_settings["IPN_IDEMPOTENCY_WAIT"] = wait
+            # ...but for so long it must have died
+            NotificationKey.objects.create(gateway="test", key="5",
+                                           started=datetime.now() - timedelta(hours=1))
+            post("id=5")
+            self.assertEqual(IDEMPOTENT_CALLS, ["5"])
+            if _in_memory_db():
+                return
+            # Concurrent duplicates wait for the first
+            del IDEMPOTENT_CALLS[:]
+            responses = []
+            def work():
+                try:
+                    responses.append(post("id=6&slow=1").content)
+                finally:
+                    connection.close()
+            threads = [threading.Thread(target=work) for i in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(IDEMPOTENT_CALLS, ["6"])
+            self.assertEqual(responses, ["Handled 6"] * 5)
+        finally:
+            NotificationKey.objects.filter(gateway="test").delete()
+
+    def test_archive(self):
+        """Test notifications are archived, read back in order and replayed."""
+        directory = tempfile.mkdtemp()
+        saved = hiicart_settings["IPN_ARCHIVE_DIR"]
+        factory = RequestFactory()
+        def post(body):
+            return _archived_view(factory.post("/hiicart/test/ipn/", body,
+                                  content_type="application/x-www-form-urlencoded",
+                                  HTTP_X_TEST="yes", HTTP_AUTHORIZATION="Basic c2VjcmV0",
+                                  HTTP_COOKIE="sessionid=secret"))
+        try:
+            hiicart_settings["IPN_ARCHIVE_DIR"] = directory
+            archive._writer = None
+            for i in range(archive.INDEX_INTERVAL + 10):
+                post("n=%i" % i)
+            post("n=x&reject=1")
+            archive.writer().close()
+            # A second process's segment, interleaved by time
+            other = archive.ArchiveWriter(directory, 1024)
+            received = [h["received"] for h, b in archive.read_archive(directory)]
+            for t in ((received[5] + received[6]) / 2, received[-1] + 1):
+                other.write({"gateway": "other", "view": "", "path": "/", "meta": {},
+                             "received": t}, "other")
+            other.close()
+            records = list(archive.read_archive(directory))
+            self.assertEqual(len(records), archive.INDEX_INTERVAL + 13)
+            self.assertEqual(records[0][0]["view"], "hiicart.tests.core._archived_view")
+            self.assertEqual(records[0][0]["meta"]["HTTP_X_TEST"], "yes")
+            self.assertFalse("HTTP_AUTHORIZATION" in records[0][0]["meta"])
+            self.assertFalse("HTTP_COOKIE" in records[0][0]["meta"])
+            self.assertEqual([b for h, b in records[:8]],
+                             ["n=0", "n=1", "n=2", "n=3", "n=4", "n=5", "other", "n=6"])
+            self.assertEqual(records[-1][1], "other")
+            # Filtering, from the middle of a segment
+            since = received[archive.INDEX_INTERVAL + 2]
+            self.assertEqual([b for h, b in archive.read_archive(directory, since, gateways=["test"])],
+                             ["n=%i" % i for i in range(archive.INDEX_INTERVAL + 2,
+                                                        archive.INDEX_INTERVAL + 10)] + ["n=x&reject=1"])
+            # Replay through the view, without archiving the notifications again
+            del ARCHIVED_CALLS[:]
+            output = StringIO()
+            call_command("hiicart_replay", directory=directory, gateways=["test"], stdout=output)
+            self.assertEqual(ARCHIVED_CALLS, [b for h, b in records if h["gateway"] == "test"])
+            self.assertTrue("Replayed %i notifications" % (archive.INDEX_INTERVAL + 11) in output.getvalue())
+            self.assertEqual(len(list(archive.read_archive(directory))), archive.INDEX_INTERVAL + 13)
+            self.assertEqual(hiicart_settings["IPN_ARCHIVE_DIR"], directory)
+        finally:
+            hiicart_settings["IPN_ARCHIVE_DIR"] = saved
+            archive._writer = None
+            shutil.rmtree(directory)
+
+    def test_cart_uuid_field(self):
+        """Test cart uuids read from any storage type come back as strings."""
+        field = CartUUIDField()
+        value = str(uuid.uuid4())
+        packed = uuid.UUID(value).bytes
+        self.assertEqual(field.to_python(value), value)
+        self.assertEqual(field.to_python(buffer(packed)), value)
+        self.assertEqual(field.to_python(uuid.UUID(value)), value)
+        self.assertEqual(stored_uuid(packed), value)
+        old = hiicart_settings["UUID_STORAGE"]
+        try:
+            # A 16 character string is only packed bytes in a binary column
+            hiicart_settings["UUID_STORAGE"] = "char"
+            self.assertEqual(field.to_python("0123456789abcdef"), "0123456789abcdef")
+            hiicart_settings["UUID_STORAGE"] = "binary"
+            self.assertEqual(field.to_python(packed), value)
+        finally:
+            hiicart_settings["UUID_STORAGE"] = old
+        self.assertEqual(HiiCart.objects.get(_cart_uuid=self.cart.cart_uuid), self.cart)
+
     def test_lineitem_clone(self):
         """Test line item cloning."""
         newitem = self.lineitem.clone(self.cart)
@@ -75,6 +736,88 @@ class HiiCartTestCase(base.HiiCartTestCase):
         self.assertEqual(self.cart.total, Decimal("11.99"))
         lineitem2.delete()
 
+    def test_lineitem_cache(self):
+        """Test lineitems are cached and invalidated on save and delete."""
+        items = self.cart.lineitems
+        self.assertEqual(len(items), 1)
+        self.assertTrue(self.cart.lineitems[0] is items[0])
+        self.assertTrue(items[0].cart is self.cart)
+        # Saving a cached item keeps the cache
+        items[0].quantity = 2
+        items[0].save()
+        self.assertTrue(self.cart.lineitems[0] is items[0])
+        self.assertEqual(self.cart.total, Decimal("3.98"))
+        # New items invalidate the cache
+        lineitem2 = LineItem.objects.create(cart=self.cart, name="Test 2",
+                                            quantity=1, sku="2",
+                                            unit_price=Decimal("5.00"))
+        self.assertEqual(len(self.cart.lineitems), 2)
+        self.assertEqual(self.cart.lineitems_by_sku["2"].id, lineitem2.id)
+        lineitem2.delete()
+        self.assertEqual(len(self.cart.lineitems), 1)
+        self.assertFalse("2" in self.cart.lineitems_by_sku)
+
+    def test_refresh_lineitems(self):
+        """Test lineitems changed elsewhere show up after refresh_lineitems."""
+        self.assertEqual(self.cart.total, Decimal("1.99"))
+        other = HiiCart.objects.get(pk=self.cart.pk)
+        LineItem.objects.create(cart=other, name="Test 2", quantity=1,
+                                sku="2", unit_price=Decimal("5.00"))
+        self.assertEqual(self.cart.total, Decimal("1.99"))
+        self.cart.refresh_lineitems()
+        self.assertEqual(self.cart.total, Decimal("6.99"))
+
+    def test_recurring_lineitems_by_sku(self):
+        """Test sku lookups of recurring items."""
+        self._add_recurring_item()
+        self.assertEqual(self.cart.recurring_lineitems_by_sku.keys(), ["42"])
+        self.assertEqual(self.cart.recurring_lineitems_by_sku.get("1"), None)
+
+    def test_load_lineitems(self):
+        """Test the UNION loader returns the right classes in order."""
+        ri = self._add_recurring_item()
+        ri.ordering = 1
+        ri.save()
+        self.lineitem.ordering = 2
+        self.lineitem.save()
+        items = load_lineitems([LineItem, RecurringLineItem], [self.cart.pk])
+        self.assertEqual([type(i) for i in items], [RecurringLineItem, LineItem])
+        self.assertEqual(items[0].recurring_price, Decimal("20.00"))
+        self.assertEqual(items[1].unit_price, Decimal("1.99"))
+        self.assertEqual(items[1].total, self.lineitem.total)
+        # Decimals keep all their places, even where the UNION returns floats
+        self.lineitem.unit_price = Decimal("123.4567890123")
+        self.lineitem.save()
+        items = load_lineitems([LineItem, RecurringLineItem], [self.cart.pk])
+        self.assertEqual(items[1].unit_price, Decimal("123.4567890123"))
+        # Every UNION branch binds each id, so ids are split to stay under the limit
+        ids = range(self.cart.pk + 1, self.cart.pk + 4) + [self.cart.pk]
+        old = models.UNION_MAX_PARAMS
+        models.UNION_MAX_PARAMS = 4
+        try:
+            items = load_lineitems([LineItem, RecurringLineItem], ids)
+        finally:
+            models.UNION_MAX_PARAMS = old
+        self.assertEqual([type(i) for i in items], [RecurringLineItem, LineItem])
+
+    def test_prefetch_lineitems(self):
+        """Test bulk loading lineitems for a queryset of carts."""
+        self._submit_recurring()
+        other = HiiCart.objects.create(user=self.test_user)
+        LineItem.objects.create(cart=other, name="Test 2", quantity=2,
+                                sku="2", unit_price=Decimal("5.00"))
+        carts = HiiCart.objects.filter(user=self.test_user).order_by("id")
+        prefetched = list(carts.prefetch_lineitems())
+        self.assertEqual(len(prefetched), 2)
+        for cart, fresh in zip(prefetched, carts):
+            self.assertNotEqual(cart._lineitem_cache, None)
+            self.assertEqual(cart.total, fresh.total)
+            self.assertEqual(len(cart.recurring_lineitems),
+                             len(fresh.recurring_lineitems))
+        self.assertEqual(prefetched[0].get_expiration(),
+                         self.cart.get_expiration())
+        self.assertEqual(prefetch_lineitems([other])[0].total, Decimal("10.00"))
+
     def test_get_expiration(self):
         """Test getting the expiration of a recurring item."""
         self._submit_recurring()
@@ -88,6 +831,36 @@ class HiiCartTestCase(base.HiiCartTestCase):
             date.today() + timedelta(days=366))
         )
 
+    def test_expires_at(self):
+        """Test the stored expiration follows payments and schedule changes."""
+        unpaid = HiiCart.objects.create(user=self.test_user)
+        unpaid = RecurringLineItem.objects.create(cart=unpaid, name="Recurring", quantity=1,
+                                                  sku="42", duration=1, duration_unit="MONTH")
+        self.assertEqual(unpaid.expires_at, None)
+        self.assertTrue(unpaid in RecurringLineItem.objects.due())
+        self._submit_recurring()
+        item = RecurringLineItem.objects.get(cart=self.cart)
+        self.assertEqual(item.expires_at, item.get_expiration())
+        self.assertFalse(item in RecurringLineItem.objects.due())
+        self.assertTrue(item in RecurringLineItem.objects.due(item.expires_at + timedelta(days=1)))
+        item.duration = 1
+        item.save()
+        item = RecurringLineItem.objects.get(pk=item.pk)
+        self.assertEqual(item.expires_at, item.get_expiration())
+        self.assertTrue(item.expires_at.date() < date.today() + timedelta(days=32))
+
+    def test_expired_carts(self):
+        """Test finding carts whose recurring items have all expired."""
+        self._submit_recurring()
+        expiration = self.cart.get_expiration()
+        expired = HiiCart.objects.filter(user=self.test_user)
+        self.assertFalse(self.cart in expired.expired())
+        self.assertTrue(self.cart in expired.expired(expiration + timedelta(seconds=1)))
+        # One unexpired item keeps the cart active
+        RecurringLineItem.objects.create(cart=self.cart, name="Recurring 2", quantity=1,
+                                         sku="43", duration=24, duration_unit="MONTH")
+        self.assertFalse(self.cart in expired.expired(expiration + timedelta(seconds=1)))
+
     def test_adjust_expiration(self):
         """Test adjusting the expiration of a recurring item."""
         self._submit_recurring()
@@ -168,6 +941,99 @@ class HiiCartTestCase(base.HiiCartTestCase):
         self.assertEqual(p.notes.count(), 1)
         self.assertEqual(p.notes.all()[0].text, note)
 
+    def _legacy_next_state(self, cart):
+        """update_state's decision as computed before payments were aggregated in SQL."""
+        newstate = None
+        payments = cart.payments.all()
+        total_paid = sum([p.amount for p in payments if p.state == "PAID"])
+        total_refund = abs(sum([p.amount for p in payments if p.state == "REFUND"]))
+        if cart.total - total_paid <= 0:
+            newstate = "COMPLETED"
+        if total_refund > 0 and total_refund < total_paid:
+            newstate = "PARTREFUND"
+        elif total_refund > 0 and total_refund >= total_paid:
+            newstate = "REFUND"
+        if any([li.is_active for li in cart.recurring_lineitems]):
+            newstate = "RECURRING"
+        elif len(cart.recurring_lineitems) > 0:
+            if newstate == "COMPLETED" and not all([r.is_expired() for r in cart.recurring_lineitems]):
+                newstate = "PENDCANCEL"
+            elif newstate == "COMPLETED" or cart.state == "RECURRING":
+                newstate = "CANCELLED"
+        return (total_paid, total_refund), newstate
+
+    def test_update_state_randomized(self):
+        """Test aggregated update_state against the old one on random payment histories."""
+        rand = random.Random(1234)
+        for i in range(30):
+            cart = HiiCart.objects.create(user=self.test_user,
+                                          _cart_state=rand.choice(["OPEN", "SUBMITTED", "COMPLETED", "RECURRING"]))
+            LineItem.objects.create(cart=cart, name="Item", quantity=1, sku="1",
+                                    unit_price=Decimal(rand.randint(0, 5000)) / 100)
+            if rand.random() < 0.5:
+                RecurringLineItem.objects.create(cart=cart, name="Recurring", quantity=1,
+                                                 sku="42", duration=1, duration_unit="MONTH",
+                                                 is_active=rand.random() < 0.5,
+                                                 recurring_price=Decimal("20.00"))
+            for j in range(rand.randint(0, 8)):
+                state = rand.choice(["PENDING", "PAID", "FAILED", "REFUND", "CANCELLED"])
+                amount = Decimal(rand.randint(1, 3000)) / 100
+                if state == "REFUND":
+                    amount = -amount
+                Payment.objects.create(cart=cart, amount=amount, state=state, gateway="comp")
+            cart = HiiCart.objects.get(pk=cart.pk)
+            totals, expected = self._legacy_next_state(cart)
+            self.assertEqual(cart._payment_totals(), totals)
+            self.assertEqual(cart._next_state(*totals), expected)
+            old_state = cart.state
+            cart.update_state()
+            if expected and expected in VALID_TRANSITIONS[old_state]:
+                self.assertEqual(cart.state, expected)
+            else:
+                self.assertEqual(cart.state, old_state)
+
+    def test_payment_totals(self):
+        """Test payment saves keep the cart's payment totals current."""
+        p1 = Payment.objects.create(cart=self.cart, amount=Decimal("10.00"),
+                                    state="PAID", gateway="comp")
+        p2 = Payment.objects.create(cart=self.cart, amount=Decimal("5.00"),
+                                    state="PENDING", gateway="comp")
+        self.assertEqual(self.cart.paid_total, Decimal("10.00"))
+        self.assertEqual(self.cart.last_paid_at, p1.created)
+        p2.state = "PAID"
+        p2.save()
+        self.assertEqual(self.cart.paid_total, Decimal("15.00"))
+        self.assertEqual(self.cart.last_paid_at, p2.created)
+        p2.state = "REFUND"
+        p2.amount = Decimal("-5.00")
+        p2.save()
+        cart = HiiCart.objects.get(pk=self.cart.pk)
+        self.assertEqual(cart.paid_total, Decimal("10.00"))
+        self.assertEqual(cart.refund_total, Decimal("-5.00"))
+        self.assertEqual(cart.last_paid_at, p1.created)
+        # A stale instance must not overwrite the totals
+        self.cart.paid_total = Decimal("0.00")
+        self.cart.save()
+        self.assertEqual(HiiCart.objects.get(pk=self.cart.pk).paid_total, Decimal("10.00"))
+
+    def test_payment_totals_delete(self):
+        """Test deleting payments, one at a time or in bulk, takes them out of the totals."""
+        p1 = Payment.objects.create(cart=self.cart, amount=Decimal("10.00"),
+                                    state="PAID", gateway="comp")
+        p2 = Payment.objects.create(cart=self.cart, amount=Decimal("5.00"),
+                                    state="PAID", gateway="comp")
+        p3 = Payment.objects.create(cart=self.cart, amount=Decimal("-5.00"),
+                                    state="REFUND", gateway="comp")
+        self.assertEqual((self.cart.paid_total, self.cart.refund_total),
+                         (Decimal("15.00"), Decimal("-5.00")))
+        p2.delete()
+        self.assertEqual(self.cart.paid_total, Decimal("10.00"))
+        self.assertEqual(self.cart.last_paid_at, p1.created)
+        Payment.objects.filter(pk__in=[p1.pk, p3.pk]).delete()
+        cart = HiiCart.objects.get(pk=self.cart.pk)
+        self.assertEqual((cart.paid_total, cart.refund_total, cart.last_paid_at),
+                         (Decimal("0.00"), Decimal("0.00"), None))
+
     def test_state_transitions(self):
         """Test all possible and impossible state transitions."""
         pass
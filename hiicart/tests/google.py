@@ -6,10 +6,24 @@ from django.conf import settings
 from django.contrib.auth.models import User
 
 from hiicart.models import HiiCart, LineItem, RecurringLineItem
+from hiicart.settings import SETTINGS as hiicart_settings
 
 class GoogleCheckoutTestCase(base.HiiCartTestCase):
     """Google Checkout related tests"""
 
+    def setUp(self):
+        super(GoogleCheckoutTestCase, self).setUp()
+        # Handling notifications only needs some credentials, not real ones
+        self._google_settings = hiicart_settings.get("GOOGLE")
+        google = dict(self._google_settings or {})
+        google["MERCHANT_ID"] = google.get("MERCHANT_ID") or "test-merchant"
+        google["MERCHANT_KEY"] = google.get("MERCHANT_KEY") or "test-key"
+        hiicart_settings["GOOGLE"] = google
+
+    def tearDown(self):
+        hiicart_settings["GOOGLE"] = self._google_settings
+        super(GoogleCheckoutTestCase, self).tearDown()
+
     def test_submit(self):
         """Test submitting a cart to Google, checking we get a url back."""
         self.assertEqual(self.cart.state, "OPEN")
@@ -38,3 +52,61 @@ class GoogleCheckoutTestCase(base.HiiCartTestCase):
         self.assertEqual(result.type, "url")
         self.assertNotEqual(result.url, None)
         self.assertEqual(self.cart.state, "SUBMITTED")
+
+    def test_record_payment(self):
+        """Test charges on an order are recorded once each."""
+        from hiicart.gateway.google.ipn import GoogleIPN
+        ipn = GoogleIPN(self.cart)
+        data = {"google-order-number": "g-record-payment",
+                "latest-charge-amount": "1.99", "total-charge-amount": "1.99"}
+        pending = ipn._record_payment(data, state="PENDING")
+        self.assertEqual(ipn._record_payment(data, state="PENDING"), pending)
+        first = ipn._record_payment(data)
+        self.assertEqual(first, pending)
+        self.assertEqual(first.state, "PAID")
+        # Redelivered charge
+        self.assertEqual(ipn._record_payment(data), first)
+        self.assertEqual(self.cart.payments.count(), 1)
+        # Later charge on the same order
+        data["total-charge-amount"] = "3.98"
+        second = ipn._record_payment(data)
+        self.assertNotEqual(second, first)
+        self.assertEqual(ipn._record_payment(data), second)
+        self.assertEqual(self.cart.payments.filter(state="PAID").count(), 2)
+
+    def test_confirm_ipn_auth(self):
+        """Test notifications are checked against the merchant's credentials."""
+        from hiicart.gateway.google.gateway import GoogleGateway
+        from hiicart.gateway.google.ipn import GoogleIPN
+        ipn = GoogleIPN(self.cart)
+        mine = GoogleGateway(self.cart).get_basic_auth()
+        self.assertTrue(ipn.confirm_ipn_auth("Basic %s" % mine))
+        self.assertFalse(ipn.confirm_ipn_auth("Basic bm90Om1pbmU="))
+        self.assertFalse(ipn.confirm_ipn_auth(""))
+
+    def test_deferred_ipn_auth(self):
+        """Test deferred notifications are checked before they're stored without credentials."""
+        from django.test.client import RequestFactory
+        from hiicart import inbox
+        from hiicart.gateway.google.gateway import GoogleGateway
+        from hiicart.gateway.google.views import ipn
+        from hiicart.models import IPNInbox
+        body = ("_type=unknown-notification&serial-number=g-deferred-auth"
+                "&shopping-cart.merchant-private-data=%s" % self.cart.cart_uuid)
+        def post(auth):
+            return ipn(RequestFactory().post("/hiicart/google/ipn/", body,
+                       content_type="application/x-www-form-urlencoded",
+                       HTTP_AUTHORIZATION="Basic %s" % auth))
+        saved = hiicart_settings["IPN_DEFERRED"], inbox._queue
+        hiicart_settings["IPN_DEFERRED"] = True
+        inbox._queue = inbox.ManualQueue()
+        try:
+            self.assertEqual(post("bm90Om1pbmU=").status_code, 401)
+            self.assertEqual(IPNInbox.objects.filter(gateway="google").count(), 0)
+            self.assertEqual(post(GoogleGateway(self.cart).get_basic_auth()).status_code, 200)
+            notification = IPNInbox.objects.get(gateway="google")
+            self.assertFalse("HTTP_AUTHORIZATION" in notification.headers)
+            self.assertEqual(inbox.process(notification.pk), "DONE")
+        finally:
+            hiicart_settings["IPN_DEFERRED"], inbox._queue = saved
+            IPNInbox.objects.filter(gateway="google").delete()
@@ -0,0 +1,219 @@
+"""
+HTTP transport shared by all gateways.
+
+Gateways send their API calls through transport(), a process-wide
+HTTPTransport. It keeps a pool of persistent (keep-alive) connections per
+host, so most calls skip the TCP and TLS handshakes, and every call has
+connect and read timeouts, so a slow gateway can't hang a worker.
+Connections are checked out by one thread at a time and returned to the
+pool once their response has been read.
+
+A request whose pooled connection turns out to be closed by the server is
+retried once on a new connection if sending it failed, or if the method is
+idempotent. POSTs that may have reached the gateway are never resent, and
+nothing is resent after a timeout, which means the gateway is slow rather
+than the connection closed. Redirects aren't followed.
+
+Settings:
+
+ * *HTTP_CONNECT_TIMEOUT* -- Seconds to wait for a connection. [default: 10]
+ * *HTTP_READ_TIMEOUT* -- Seconds to wait for each read of a response.
+            [default: 30]
+ * *HTTP_POOL_SIZE* -- Idle connections kept per host. [default: 4]
+ * *HTTP_TIMING_FN* -- Function called after every request with the
+            Response, e.g. to record gateway latency. [default: None]
+
+Hooks can also be added with transport().add_hook(fn).
+"""
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+from hiicart.settings import SETTINGS as hiicart_settings
+
+
+log = logging.getLogger("hiicart.transport")
+
+
+class Response(object):
+    """A fully read HTTP response."""
+
+    def __init__(self, method, url, status, reason, headers, body, elapsed, reused):
+        self.method = method
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        # Seconds from sending the request to reading the whole response
+        self.elapsed = elapsed
+        # Whether the request went over a connection from the pool
+        self.reused = reused
+
+    def __repr__(self):
+        return "<Response %s %s: %i in %.3fs>" % (self.method, self.url,
+                                                 self.status, self.elapsed)
+
+
+# Methods that are safe to resend if a pooled connection failed
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class HTTPTransport(object):
+    """Thread-safe pools of keep-alive connections, one per host."""
+
+    def __init__(self, connect_timeout=10, read_timeout=30, pool_size=4,
+                 idle_timeout=15, ssl_context=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        # Pooled connections idle longer than this are closed, not reused,
+        # since servers drop idle keep-alive connections after a while
+        self.idle_timeout = idle_timeout
+        # Passed to HTTPSConnection where supported (python >= 2.7.9)
+        self.ssl_context = ssl_context
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._hooks = []
+
+    def add_hook(self, fn):
+        """Call fn(response) after every request."""
+        self._hooks.append(fn)
+
+    def _connect(self, scheme, host, port):
+        if scheme == "https":
+            kwargs = {}
+            if self.ssl_context is not None:
+                kwargs["context"] = self.ssl_context
+            conn = httplib.HTTPSConnection(host, port, timeout=self.connect_timeout, **kwargs)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        # httplib writes headers and body separately; without this a reused
+        # connection waits on the peer's delayed ACK before sending the body
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _checkout(self, key):
+        """An idle connection for key, or None."""
+        now = time.time()
+        stale = []
+        conn = None
+        self._lock.acquire()
+        try:
+            pool = self._pools.get(key, [])
+            while pool:
+                candidate, last_used = pool.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        finally:
+            self._lock.release()
+        for candidate in stale:
+            candidate.close()
+        return conn
+
+    def _checkin(self, key, conn):
+        self._lock.acquire()
+        try:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        """Close every pooled connection."""
+        self._lock.acquire()
+        try:
+            pools, self._pools = self._pools, {}
+        finally:
+            self._lock.release()
+        for pool in pools.values():
+            for conn, last_used in pool:
+                conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request and return its Response. Raises socket.error and httplib errors."""
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers or {})
+        if body is not None and "content-type" not in [k.lower() for k in headers]:
+            headers["Content-type"] = "application/x-www-form-urlencoded"
+        start = time.time()
+        conn = self._checkout(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self._connect(scheme, parts.hostname, port)
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except socket.timeout:
+                conn.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused or (sent and method.upper() not in IDEMPOTENT_METHODS):
+                    raise
+                # The server closed a pooled connection; retry on a new one
+                conn = None
+                reused = False
+        if resp.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+        response = Response(method, url, resp.status, resp.reason,
+                            dict(resp.getheaders()), data, time.time() - start, reused)
+        for hook in self._hooks:
+            try:
+                hook(response)
+            except Exception:
+                log.exception("HTTP timing hook failed")
+        return response
+
+    def get(self, url, headers=None):
+        return self.request("GET", url, headers=headers)
+
+    def post(self, url, body, headers=None):
+        return self.request("POST", url, body, headers)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def transport():
+    """The HTTPTransport shared by this process, set up from settings."""
+    global _transport
+    if _transport is None:
+        _transport_lock.acquire()
+        try:
+            if _transport is None:
+                instance = HTTPTransport(hiicart_settings["HTTP_CONNECT_TIMEOUT"],
+                                         hiicart_settings["HTTP_READ_TIMEOUT"],
+                                         hiicart_settings["HTTP_POOL_SIZE"])
+                if hiicart_settings["HTTP_TIMING_FN"]:
+                    from hiicart.utils import get_func
+                    instance.add_hook(get_func(hiicart_settings["HTTP_TIMING_FN"]))
+                _transport = instance
+        finally:
+            _transport_lock.release()
+    return _transport
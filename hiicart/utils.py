@@ -1,17 +1,33 @@
 import logging
+import os
 import traceback
 from django.http import HttpResponse
-from hiicart.models import CART_TYPES
+from hiicart.models import find_cart, search_carts
 
 
 log = logging.getLogger("hiicart")
 
+# Request headers carrying credentials, never written out with a notification
+SECRET_HEADERS = ("HTTP_AUTHORIZATION", "HTTP_COOKIE")
+
+
+# Functions found by get_func(), by dotted name
+_funcs = {}
+
+
+def get_func(name):
+    """Get a function from its dotted [str] name. Lookups are cached."""
+    func = _funcs.get(name)
+    if func is None:
+        parts = name.split('.')
+        module = __import__(".".join(parts[:-1]), fromlist=[parts[-1]])
+        func = _funcs[name] = getattr(module, parts[-1])
+    return func
+
 
 def call_func(name, *args, **kwargs):
     """Call a function when all you have is the [str] name and arguments."""
-    parts = name.split('.')
-    module = __import__(".".join(parts[:-1]), fromlist=[parts[-1]])
-    return getattr(module, parts[-1])(*args, **kwargs)
+    return get_func(name)(*args, **kwargs)
 
 
 def format_exceptions(method):
@@ -34,21 +50,42 @@ def format_exceptions(method):
     return wrapper
 
 
+def request_meta(request, names=()):
+    """A request's HTTP_* headers and the META variables in names, less SECRET_HEADERS."""
+    return dict([(k, v) for k, v in request.META.items()
+                 if isinstance(v, basestring) and k not in SECRET_HEADERS
+                 and (k.startswith("HTTP_") or k in names)])
+
+
 def cart_by_uuid(uuid):
-    for Cart in CART_TYPES:
-        try:
-            return Cart.objects.get(_cart_uuid=uuid)
-        except Cart.DoesNotExist:
-            pass
+    return find_cart(uuid)
 
 def cart_by_email(email):
-    for Cart in CART_TYPES:
-        try:
-            return Cart.objects.get(bill_email=email)
-        except Cart.DoesNotExist:
-            pass
-    for Cart in CART_TYPES:
-        try:
-            return Cart.objects.get(ship_email=email)
-        except Cart.DoesNotExist:
-            pass
+    """The newest cart, of any type, with email as its bill or ship email, or None."""
+    carts = search_carts(email=email)[:1]
+    if carts:
+        return carts[0]
+    return None
+
+
+def read_checkpoint(path):
+    """Last cart id done per cart type, from a checkpoint file."""
+    checkpoint = {}
+    if path and os.path.exists(path):
+        for line in open(path):
+            if line.strip():
+                label, last_id = line.split()
+                checkpoint[label] = int(last_id)
+    return checkpoint
+
+
+def write_checkpoint(path, checkpoint):
+    """Save the last cart id done per cart type, replacing the file atomically."""
+    tmp = path + ".tmp"
+    f = open(tmp, "w")
+    try:
+        for label, last_id in sorted(checkpoint.items()):
+            f.write("%s %i\n" % (label, last_id))
+    finally:
+        f.close()
+    os.rename(tmp, path)